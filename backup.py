@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+
+from motor import motor_asyncio
+
+from bot.backup import COLLECTIONS, FORMATS, export_all, import_all
+
+
+def parse_collections(s: str) -> tuple[str, ...]:
+  names = tuple(name.strip() for name in s.split(",") if name.strip())
+  for name in names:
+    if name not in COLLECTIONS:
+      raise argparse.ArgumentTypeError(f"unknown collection `{name}`, expected some of {', '.join(COLLECTIONS)}")
+  return names
+
+
+async def run(args: argparse.Namespace):
+  client = motor_asyncio.AsyncIOMotorClient(args.url)
+  db = client[args.database]
+  try:
+    if args.command == "export":
+      results = await export_all(
+        db, args.directory, args.format, args.collections,
+        chunk_docs=args.chunk_docs, batch_size=args.batch_size, compresslevel=args.compresslevel
+      )
+    else:
+      results = await import_all(
+        db, args.directory, args.collections,
+        batch_size=args.batch_size, concurrency=args.concurrency, replace=args.replace
+      )
+  finally:
+    client.close()
+
+  for r in results:
+    print(r.summary(), flush=True)
+  documents = sum(r.documents for r in results)
+  seconds = sum(r.seconds for r in results)
+  print(f"{args.command} total   {documents:>10} docs in {seconds:>7.2f}s{documents / seconds if seconds else 0:>12,.0f} docs/s")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Export or import the ShroomDB collections")
+  parser.add_argument("command", choices=("export", "import"))
+  parser.add_argument("directory", help="the export directory, an unfinished export there is resumed")
+  parser.add_argument("--url", default=os.getenv("MONGO_URL", "localhost"), help="defaults to MONGO_URL")
+  parser.add_argument("--database", default="ShroomDB")
+  parser.add_argument("--collections", type=parse_collections, default=COLLECTIONS, help="e.g. `Farm,Users`")
+  parser.add_argument("--batch-size", type=int, default=1000, help="documents per cursor batch or bulk write")
+
+  ex = parser.add_argument_group("export")
+  ex.add_argument("--format", choices=FORMATS, default="ndjson")
+  ex.add_argument("--chunk-docs", type=int, default=100_000, help="documents per chunk file")
+  ex.add_argument("--compresslevel", type=int, default=6, help="gzip level, 1 is fastest")
+
+  im = parser.add_argument_group("import")
+  im.add_argument("--concurrency", type=int, default=4, help="bulk writes in flight at once")
+  im.add_argument("--replace", action="store_true", help="overwrite documents that already exist instead of skipping them")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+  asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+  main()
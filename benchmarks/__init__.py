@@ -0,0 +1,5 @@
+"""
+Benchmarks for the farm pipeline
+
+Run with `python -m benchmarks --help`
+"""
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from benchmarks import gateway, macro, memory, micro, replay
+from benchmarks.results import compare, dump
+
+
+def parse_ints(s: str) -> tuple[int, ...]:
+  return tuple(int(x) for x in s.split(","))
+
+
+def main():
+  parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the farm pipeline")
+  parser.add_argument("suite", choices=("micro", "macro", "gateway", "fastpath", "memory", "replay", "all"), nargs="?", default="all")
+  parser.add_argument("-o", "--output", help="also write the JSON results here, otherwise only the summaries are printed")
+  parser.add_argument("--compare", metavar="PATH", help="a previous JSON result to compare throughput against")
+  parser.add_argument("--iterations", type=int, default=20_000, help="iterations per microbenchmark")
+  parser.add_argument("--events", type=int, default=200, help="farm events per guild in macrobenchmarks")
+  parser.add_argument("--guilds", type=parse_ints, default=(1, 10, 100))
+  parser.add_argument("--users", type=parse_ints, default=(2, 50))
+  parser.add_argument("--days", type=parse_ints, default=(0, 6), help="days of stats history")
+  parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+  parser.add_argument("--uvloop", action="store_true", help="run the async suites on uvloop")
+
+  gw = parser.add_argument_group("gateway", "options for the fake gateway load test")
+  gw.add_argument("--ignored", type=int, default=0, help="non-farm messages sent before every 🍄")
+  gw.add_argument("--interactions", type=int, default=0, help="app commands invoked per guild")
+  gw.add_argument("--latency-ms", type=float, default=0.0, help="latency of every stub REST call")
+  gw.add_argument("--jitter-ms", type=float, default=0.0)
+  gw.add_argument("--rate-limit", metavar="LIMIT/WINDOW", help="e.g. `5/5` for 5 requests per 5 seconds per channel")
+  gw.add_argument("--surprise-429", action="store_true", help="do not advertise rate limit headers")
+
+  mem = parser.add_argument_group("memory", "options for measuring RSS in normal and lean mode")
+  mem.add_argument("--members", type=parse_ints, default=(100, 1000), help="members per guild")
+  mem.add_argument("--messages", type=int, default=10_000, help="chatter messages spread over all guilds, also used by `fastpath`")
+
+  rp = parser.add_argument_group("replay", "options for replaying a recorded traffic log")
+  rp.add_argument("--log", help="a log written by the bot with TRAFFIC_LOG set")
+  rp.add_argument("--speed", default="max", help="`max`, or a multiple of the recorded pace such as 1 or 10")
+  args = parser.parse_args()
+
+  if args.uvloop:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+  results = []
+  if args.suite in ("micro", "all"):
+    results += micro.run(args.iterations, guilds=args.guilds, contributors=args.users)
+  if args.suite in ("macro", "all"):
+    results += asyncio.run(macro.run(args.events, args.guilds, args.users, args.days, args.backend))
+  if args.suite in ("gateway", "all"):
+    rate_limit = None
+    if args.rate_limit:
+      limit, window = args.rate_limit.split("/")
+      rate_limit = gateway.RateLimit(int(limit), float(window), advertise=not args.surprise_429)
+    for g in args.guilds:
+      for u in args.users:
+        results += asyncio.run(gateway.run_load(
+          g, u, args.events, args.ignored, args.interactions,
+          args.latency_ms / 1000, args.jitter_ms / 1000, rate_limit,
+          storage_backend=args.backend
+        ))
+
+  if args.suite in ("fastpath", "all"):
+    results += asyncio.run(gateway.run_ignored(args.messages, max(args.guilds), storage_backend=args.backend))
+
+  if args.suite in ("memory", "all"):
+    results += memory.run(args.guilds, args.members, args.messages)
+
+  if args.suite == "replay" or (args.suite == "all" and args.log):
+    if not args.log:
+      parser.error("replaying needs --log")
+    speed = None if args.speed == "max" else float(args.speed)
+    results += asyncio.run(replay.replay(args.log, speed, storage_backend=args.backend))
+
+  for r in results:
+    print(r.summary(), flush=True)
+  if args.compare:
+    print("\n".join(compare(args.compare, results)))
+  if args.output:
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,80 @@
+"""
+Stand-ins for the discord.py objects the farm pipeline touches
+"""
+
+from __future__ import annotations
+
+import os
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import discord
+
+from bot import ShroomBot
+from bot.config import Config
+
+
+@dataclass
+class FakeUser:
+  id: int
+  name: str = "farmer"
+  bot: bool = False
+
+  @property
+  def mention(self) -> str:
+    return f"<@{self.id}>"
+
+
+@dataclass
+class FakeGuild:
+  id: int
+  shard_id: int = 0
+
+
+@dataclass
+class FakeChannel:
+  id: int
+  sent: int = 0
+
+  async def send(self, *args: Any, **kwargs: Any):
+    self.sent += 1
+
+
+@dataclass
+class FakeMessage:
+  """Just enough of a `discord.Message` for `ShroomBot.farm` and `ShroomBot.on_message`"""
+  author: FakeUser
+  guild: FakeGuild | None
+  channel: FakeChannel
+  content: str = "🍄"
+  reactions: list[str] = field(default_factory=list)
+  replies: int = 0
+
+  async def add_reaction(self, emoji: str):
+    self.reactions.append(emoji)
+
+  async def reply(self, *args: Any, **kwargs: Any):
+    self.replies += 1
+
+
+def make_config(**kwargs: Any) -> Config:
+  kwargs.setdefault("storage_backend", "memory")
+  kwargs.setdefault("loop_lag_threshold_ms", 0) # The harness blocks the loop on purpose
+  kwargs.setdefault("snapshot_path", None)
+  kwargs.setdefault("rollover_journal", None)
+  kwargs.setdefault("command_sync_state", None)
+  return Config(token="", dev_server_id=0, **kwargs)
+
+
+@contextmanager
+def scratch_sqlite() -> Iterator[str]:
+  """A path for a throwaway SQLite database, the directory holding it is removed afterwards"""
+  with tempfile.TemporaryDirectory(prefix="shroom-bench-") as tmp:
+    yield os.path.join(tmp, "shroom.db")
+
+
+def make_bot(**kwargs: Any) -> ShroomBot:
+  """Creates a `ShroomBot` that never logs in, using the in-memory backend by default"""
+  return ShroomBot(config=make_config(**kwargs), intents=discord.Intents.default())
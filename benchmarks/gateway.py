@@ -0,0 +1,534 @@
+"""
+A fake Discord for end-to-end load tests
+
+`StubDiscord` is a local HTTP server that answers the REST calls a `ShroomBot`
+makes, with configurable latency and 429 behaviour. `GatewayHarness` logs a real
+`ShroomBot` into it and feeds synthetic MESSAGE_CREATE and INTERACTION_CREATE
+payloads through the same parsers the websocket uses, then times how long it
+takes for each event to get its reply. Nothing leaves localhost.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import json
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any
+
+from aiohttp import web
+from discord.ext import commands
+from discord.http import Route
+from discord.utils import _from_json
+
+from bot import ShroomBot, bot_class, client_options
+
+from benchmarks.fakes import make_config, scratch_sqlite
+from benchmarks.results import Result
+
+BOT_ID = 1_000_000_000_000_001
+APPLICATION_ID = 1_000_000_000_000_002
+OWNER_ID = 1_000_000_000_000_003
+EPOCH = "2023-01-01T00:00:00.000000+00:00"
+
+_snowflakes = itertools.count(2_000_000_000_000_000)
+
+
+def snowflake() -> int:
+  return next(_snowflakes)
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict[str, Any]:
+  return {
+    "id": str(user_id),
+    "username": f"user{user_id}",
+    "discriminator": "0",
+    "global_name": None,
+    "avatar": None,
+    "bot": bot
+  }
+
+
+def member_payload(user_id: int) -> dict[str, Any]:
+  return {
+    "user": user_payload(user_id),
+    "roles": [],
+    "joined_at": EPOCH,
+    "deaf": False,
+    "mute": False,
+    "flags": 0
+  }
+
+
+def message_payload(message_id: int, channel_id: int, author_id: int, content: str, guild_id: int | None = None) -> dict[str, Any]:
+  data = {
+    "id": str(message_id),
+    "channel_id": str(channel_id),
+    "author": user_payload(author_id, bot=author_id == BOT_ID),
+    "content": content,
+    "timestamp": EPOCH,
+    "edited_timestamp": None,
+    "tts": False,
+    "mention_everyone": False,
+    "mentions": [],
+    "mention_roles": [],
+    "attachments": [],
+    "embeds": [],
+    "pinned": False,
+    "type": 0
+  }
+  if guild_id is not None:
+    data["guild_id"] = str(guild_id)
+    data["member"] = {k: v for k, v in member_payload(author_id).items() if k != "user"}
+  return data
+
+
+def interaction_payload(
+  interaction_id: int,
+  guild_id: int,
+  channel_id: int,
+  user_id: int,
+  command: str,
+  subcommand: str | None = None
+) -> dict[str, Any]:
+  data: dict[str, Any] = {"id": str(snowflake()), "name": command, "type": 1}
+  if subcommand is not None:
+    data["options"] = [{"name": subcommand, "type": 1, "options": []}]
+  return {
+    "id": str(interaction_id),
+    "application_id": str(APPLICATION_ID),
+    "type": 2,
+    "token": "harness",
+    "version": 1,
+    "guild_id": str(guild_id),
+    "channel_id": str(channel_id),
+    "channel": {"id": str(channel_id), "type": 0, "guild_id": str(guild_id)},
+    "member": {**member_payload(user_id), "permissions": "8"},
+    "app_permissions": "8",
+    "attachment_size_limit": 10_485_760,
+    "locale": "en-US",
+    "guild_locale": "en-US",
+    "entitlements": [],
+    "authorizing_integration_owners": {"0": str(guild_id)},
+    "context": 0,
+    "data": data
+  }
+
+
+def presence_payload(user_id: int) -> dict[str, Any]:
+  return {
+    "user": {"id": str(user_id)},
+    "status": "online",
+    "activities": [{"name": "Farming", "type": 0, "created_at": 1672531200000}],
+    "client_status": {"desktop": "online"}
+  }
+
+
+def guild_payload(guild_id: int, channel_id: int, members: int) -> dict[str, Any]:
+  return {
+    "id": str(guild_id),
+    "name": f"guild{guild_id}",
+    "owner_id": str(OWNER_ID),
+    "unavailable": False,
+    "member_count": members,
+    "large": members > 250,
+    "features": [],
+    "emojis": [],
+    "stickers": [],
+    "roles": [{
+      "id": str(guild_id),
+      "name": "@everyone",
+      "permissions": "0",
+      "position": 0,
+      "color": 0,
+      "hoist": False,
+      "managed": False,
+      "mentionable": False
+    }],
+    "channels": [{
+      "id": str(channel_id),
+      "type": 0,
+      "name": "farm",
+      "position": 0,
+      "permission_overwrites": [],
+      "guild_id": str(guild_id)
+    }],
+    "members": [member_payload(guild_id * 100_000 + i) for i in range(members)],
+    # Discord only sends the online members' presences, assume a third of them are
+    "presences": [presence_payload(guild_id * 100_000 + i) for i in range(0, members, 3)],
+    "voice_states": [],
+    "threads": []
+  }
+
+
+def json_response(data: Any, status: int = 200, headers: dict[str, str] | None = None) -> web.Response:
+  # discord.py only decodes bodies whose content type is exactly `application/json`
+  return web.Response(
+    body=json.dumps(data).encode(),
+    status=status,
+    headers={**(headers or {}), "Content-Type": "application/json"}
+  )
+
+
+@dataclass
+class RateLimit:
+  """Allows `limit` requests per `window` seconds for each channel or interaction
+
+  With `advertise` off the X-RateLimit headers are left out of successful
+  responses, so the bot cannot back off pre-emptively and runs into 429s.
+  """
+  limit: int = 5
+  window: float = 5.0
+  is_global: bool = False
+  advertise: bool = True
+
+
+class StubDiscord:
+  """Answers the REST API calls the bot makes while under load"""
+
+  def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: RateLimit | None = None, seed: int = 0):
+    self.latency = latency
+    self.jitter = jitter
+    self.rate_limit = rate_limit
+    self._rng = random.Random(seed)
+
+    self.requests = 0
+    self.rate_limited = 0
+    self.quotes_served = 0
+    self.replies: dict[int, float] = {} # Event ID -> time the reply arrived
+    self._waiters: dict[int, asyncio.Future[float]] = {}
+    self._windows: dict[str, tuple[float, int]] = defaultdict(lambda: (0.0, 0))
+
+    self._runner: web.AppRunner | None = None
+    self.url: str | None = None
+
+    app = web.Application()
+    app.router.add_get("/api/v10/users/@me", self.get_me)
+    app.router.add_get("/api/v10/oauth2/applications/@me", self.get_application)
+    app.router.add_post("/api/v10/channels/{channel_id}/messages", self.create_message)
+    app.router.add_put("/api/v10/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me", self.no_content)
+    app.router.add_post("/api/v10/interactions/{interaction_id}/{token}/callback", self.interaction_callback)
+    app.router.add_put("/api/v10/applications/{application_id}/commands", self.sync_commands)
+    app.router.add_put("/api/v10/applications/{application_id}/guilds/{guild_id}/commands", self.sync_commands)
+    app.router.add_get("/quotes/random", self.random_quote) # Stands in for the /jerome quote API
+    self.app = app
+
+  async def start(self) -> str:
+    self._runner = web.AppRunner(self.app, access_log=None)
+    await self._runner.setup()
+    site = web.TCPSite(self._runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1] # type: ignore
+    self.url = f"http://127.0.0.1:{port}"
+    return self.url
+
+  async def close(self):
+    if self._runner is not None:
+      await self._runner.cleanup()
+
+  def expect(self, event_id: int) -> asyncio.Future[float]:
+    fut = asyncio.get_running_loop().create_future()
+    self._waiters[event_id] = fut
+    return fut
+
+  def _resolve(self, event_id: int):
+    now = time.perf_counter()
+    self.replies[event_id] = now
+    fut = self._waiters.pop(event_id, None)
+    if fut is not None and not fut.done():
+      fut.set_result(now)
+
+  async def _delay(self):
+    if self.latency or self.jitter:
+      await asyncio.sleep(max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)))
+
+  def _check_rate_limit(self, bucket: str) -> web.Response | dict[str, str]:
+    rl = self.rate_limit
+    if rl is None:
+      return {}
+    now = time.monotonic()
+    start, count = self._windows[bucket]
+    if now - start >= rl.window:
+      start, count = now, 0
+    reset_after = rl.window - (now - start)
+    headers = {
+      "X-RateLimit-Limit": str(rl.limit),
+      "X-RateLimit-Bucket": bucket,
+      "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+      "X-RateLimit-Reset": f"{time.time() + reset_after:.3f}",
+      "Via": "1.1 google"
+    }
+    if count >= rl.limit:
+      self.rate_limited += 1
+      headers["X-RateLimit-Remaining"] = "0"
+      headers["X-RateLimit-Scope"] = "global" if rl.is_global else "user"
+      return json_response(
+        {"message": "You are being rate limited.", "retry_after": reset_after, "global": rl.is_global},
+        429,
+        headers
+      )
+    self._windows[bucket] = (start, count + 1)
+    if not rl.advertise:
+      return {}
+    headers["X-RateLimit-Remaining"] = str(rl.limit - count - 1)
+    return headers
+
+  async def _handle(self, bucket: str) -> web.Response | dict[str, str]:
+    self.requests += 1
+    await self._delay()
+    return self._check_rate_limit("global" if self.rate_limit and self.rate_limit.is_global else bucket)
+
+
+
+  async def get_me(self, request: web.Request):
+    return json_response(user_payload(BOT_ID, bot=True))
+
+  async def get_application(self, request: web.Request):
+    return json_response({
+      "id": str(APPLICATION_ID),
+      "name": "ShroomBot",
+      "description": "",
+      "icon": None,
+      "bot_public": True,
+      "bot_require_code_grant": False,
+      "owner": user_payload(OWNER_ID),
+      "verify_key": "",
+      "flags": 0
+    })
+
+  async def random_quote(self, request: web.Request):
+    self.quotes_served += 1
+    await self._delay()
+    return json_response({"content": f"Quote number {self.quotes_served}", "author": "Jerome"})
+
+  async def sync_commands(self, request: web.Request):
+    payload = await request.json()
+    # Context menus are sent without a description, Discord fills in an empty one
+    return json_response([
+      {"description": "", **cmd, "id": str(snowflake()), "application_id": str(APPLICATION_ID)}
+      for cmd in payload
+    ])
+
+  async def no_content(self, request: web.Request):
+    headers = await self._handle(f"reactions:{request.match_info['channel_id']}")
+    if isinstance(headers, web.Response):
+      return headers
+    return web.Response(status=204, headers=headers)
+
+  async def create_message(self, request: web.Request):
+    channel_id = int(request.match_info["channel_id"])
+    headers = await self._handle(f"messages:{channel_id}")
+    if isinstance(headers, web.Response):
+      return headers
+    if request.content_type == "application/json":
+      body = await request.json()
+    else:
+      body = json.loads((await request.post())["payload_json"]) # type: ignore
+    reference = body.get("message_reference")
+    if reference is not None:
+      self._resolve(int(reference["message_id"]))
+    data = message_payload(snowflake(), channel_id, BOT_ID, body.get("content") or "")
+    return json_response(data, headers=headers)
+
+  async def interaction_callback(self, request: web.Request):
+    interaction_id = int(request.match_info["interaction_id"])
+    headers = await self._handle(f"interactions:{interaction_id}")
+    if isinstance(headers, web.Response):
+      return headers
+    self._resolve(interaction_id)
+    return json_response(
+      {"interaction": {"id": str(interaction_id), "type": 2}},
+      headers=headers
+    )
+
+
+class GatewayHarness:
+  """Drives a real `ShroomBot` against a `StubDiscord`"""
+
+  def __init__(self, stub: StubDiscord, bot: ShroomBot | None = None, **config: Any):
+    self.stub = stub
+    self._scratch = contextlib.ExitStack() # Removes the SQLite database of a bot made here on close
+    if bot is None:
+      config.setdefault("sqlite_path", self._scratch.enter_context(scratch_sqlite()))
+      bot_config = make_config(**config)
+      bot = bot_class(bot_config)(config=bot_config, owner_ids=(OWNER_ID,), **client_options(bot_config))
+    self.bot = bot
+    self.guilds: dict[int, int] = {} # Guild ID -> farm channel ID
+    self._old_base = Route.BASE
+
+  async def start(self, guilds: int, members: int = 0, farms: bool = True):
+    url = await self.stub.start()
+    Route.BASE = f"{url}/api/v10"
+    self.bot.config.quote_api_url = f"{url}/quotes/random"
+    await self.bot.login("harness")
+    if isinstance(self.bot, commands.AutoShardedBot):
+      # Normally set when the shards launch, which the harness never does
+      self.bot._connection.shard_count = self.bot.shard_count # type: ignore
+    await self.bot.caches_warm.wait()
+    for guild_id in range(1, guilds + 1):
+      channel_id = 10_000_000 + guild_id
+      self.add_guild(guild_id, channel_id, members)
+      if farms:
+        await self.bot.shroom_farm.create_farm(guild_id, channel_id)
+
+  def add_guild(self, guild_id: int, channel_id: int, members: int = 0):
+    self.bot._connection._add_guild_from_data(guild_payload(guild_id, channel_id, members)) # type: ignore
+    self.guilds[guild_id] = channel_id
+
+  async def close(self):
+    self.bot.update_stats_loop.cancel()
+    self.bot.update_presence_loop.cancel()
+    await self.bot.close()
+    await self.stub.close()
+    Route.BASE = self._old_base
+    self._scratch.close()
+
+  def dispatch(self, event: str, data: dict[str, Any]):
+    """Runs a payload through the same path as a websocket frame, JSON decoding included"""
+    raw = json.dumps(data)
+    self.bot._connection.parsers[event](_from_json(raw)) # type: ignore
+
+  def message_create(self, guild_id: int, author_id: int, content: str = "🍄", channel_id: int | None = None, message_id: int | None = None) -> int:
+    message_id = message_id or snowflake()
+    channel_id = channel_id or self.guilds[guild_id]
+    self.dispatch("MESSAGE_CREATE", message_payload(message_id, channel_id, author_id, content, guild_id))
+    return message_id
+
+  def interaction_create(self, guild_id: int, user_id: int, command: str = "mini", subcommand: str | None = None, interaction_id: int | None = None) -> int:
+    interaction_id = interaction_id or snowflake()
+    self.dispatch(
+      "INTERACTION_CREATE",
+      interaction_payload(interaction_id, guild_id, self.guilds[guild_id], user_id, command, subcommand)
+    )
+    return interaction_id
+
+  async def drain(self):
+    """Waits until every event handler the bot has scheduled has finished"""
+    current = asyncio.current_task()
+    while True:
+      pending = [
+        t for t in asyncio.all_tasks()
+        if t is not current and not t.done() and t.get_name().startswith("discord.py: ")
+      ]
+      if not pending:
+        return
+      await asyncio.wait(pending)
+
+
+
+async def run_load(
+  guilds: int = 10,
+  users: int = 5,
+  events: int = 100,
+  ignored: int = 0,
+  interactions: int = 0,
+  latency: float = 0.0,
+  jitter: float = 0.0,
+  rate_limit: RateLimit | None = None,
+  timeout: float = 60.0,
+  **config: Any
+) -> list[Result]:
+  """Sends `events` 🍄 per guild (plus `ignored` chatter messages and `interactions` /farm farmstats,
+  /mini and /jerome calls per guild) and times every event until the stub receives its reply
+  """
+  stub = StubDiscord(latency, jitter, rate_limit)
+  harness = GatewayHarness(stub, **config)
+  await harness.start(guilds)
+  params = {
+    "guilds": guilds,
+    "users": users,
+    "ignored": ignored,
+    "latency_ms": latency * 1000,
+    "rate_limited": rate_limit is not None
+  }
+
+  farm_samples: list[float] = []
+  interaction_samples: list[float] = []
+
+  async def guild_worker(guild_id: int):
+    for i in range(events):
+      for _ in range(ignored):
+        harness.message_create(guild_id, guild_id * 100_000 + i % users, "just chatting")
+      # Wait for each reply so the next farmer is never the last farmer
+      t = time.perf_counter()
+      fut = stub.expect(message_id := snowflake())
+      harness.message_create(guild_id, guild_id * 100_000 + i % users, message_id=message_id)
+      farm_samples.append(await asyncio.wait_for(fut, timeout) - t)
+    for i in range(interactions):
+      command, sub = (("farm", "farmstats"), ("mini", None), ("jerome", None))[i % 3]
+      t = time.perf_counter()
+      fut = stub.expect(interaction_id := snowflake())
+      harness.interaction_create(guild_id, guild_id * 100_000, command, sub, interaction_id)
+      interaction_samples.append(await asyncio.wait_for(fut, timeout) - t)
+
+  start = time.perf_counter()
+  try:
+    await asyncio.gather(*(guild_worker(g) for g in range(1, guilds + 1)))
+    await harness.drain()
+  finally:
+    elapsed = time.perf_counter() - start
+    await harness.close()
+
+  results = [Result.from_samples("gateway_farm", params, [int(s * 1e9) for s in farm_samples], elapsed)]
+  if interaction_samples:
+    results.append(Result.from_samples("gateway_interaction", params, [int(s * 1e9) for s in interaction_samples], elapsed))
+  for r in results:
+    r.counters = {"requests": stub.requests, "429s": stub.rate_limited}
+  if harness.bot.quotes is not None and harness.bot.quotes.hits + harness.bot.quotes.misses:
+    results[-1].counters["quote_hit_ratio"] = round(harness.bot.quotes.hit_ratio, 3)
+  return results
+
+
+
+IGNORED_KINDS = ("chatter", "command", "shroom")
+
+
+async def run_ignored(messages: int = 10_000, guilds: int = 10, **config: Any) -> list[Result]:
+  """Measures the CPU time the bot spends on messages it ignores, with the gateway fast path on and off
+
+  Each kind is sent on its own, `chatter` is plain text, `command` is a
+  prefix command from someone who isn't an owner and `shroom` is a 🍄 outside
+  the farm channel. CPU time is that of the whole process, so it includes
+  the JSON decoding that every payload gets either way and, for commands
+  without the fast path, the stub answering the error reply.
+  """
+  results = []
+  cost: dict[str, float] = {}
+  for fast_path in (False, True):
+    stub = StubDiscord()
+    harness = GatewayHarness(stub, gateway_fast_path=fast_path, **config)
+    await harness.start(guilds)
+    try:
+      for kind in IGNORED_KINDS:
+        payloads = []
+        for i in range(messages):
+          guild_id = i % guilds + 1
+          channel_id = harness.guilds[guild_id]
+          content = {"chatter": "just chatting", "command": "$help", "shroom": "🍄"}[kind]
+          if kind == "shroom":
+            channel_id += 1 # Not the farm channel
+          payloads.append(json.dumps(message_payload(snowflake(), channel_id, guild_id * 100_000 + i, content, guild_id)))
+        parse = harness.bot._connection.parsers["MESSAGE_CREATE"] # type: ignore
+        start, cpu = time.perf_counter(), time.process_time()
+        for raw in payloads:
+          parse(_from_json(raw))
+        await harness.drain()
+        await asyncio.sleep(0) # Let the stub finish the error replies it was sent
+        cpu = time.process_time() - cpu
+        elapsed = time.perf_counter() - start
+
+        per_1k = cpu / messages * 1000 * 1000 # ms
+        result = Result("gateway_ignored", {"kind": kind, "fast_path": fast_path}, messages, elapsed)
+        result.counters = {"cpu_ms_per_1k": round(per_1k, 2)}
+        if fast_path:
+          result.counters["saved_ms_per_1k"] = round(cost[kind] - per_1k, 2)
+        else:
+          cost[kind] = per_1k
+        results.append(result)
+    finally:
+      await harness.close()
+  return results
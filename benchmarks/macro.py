@@ -0,0 +1,95 @@
+"""
+Macrobenchmarks driving N guilds x M users through `ShroomBot.on_message`
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import time
+
+from bot.shroom.stats import DailyStats
+
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakeUser, make_bot, scratch_sqlite
+from benchmarks.micro import make_daily_stats
+from benchmarks.results import Result
+
+
+async def seed_history(bot, guilds: int, contributors: int, days: int):
+  """Inserts `days` days of previous stats so weekly lookups have something to scan"""
+  for day in range(days, 0, -1):
+    stats, _ = make_daily_stats(guilds, contributors, seed=day)
+    stats.date = datetime.datetime.utcnow() - datetime.timedelta(days=day)
+    await bot.shroom_farm.backend.insert_stats(stats.to_dict())
+
+
+async def farm_pipeline(
+  guilds: int,
+  users: int,
+  events: int,
+  days: int = 0,
+  backend: str = "memory",
+  weekly_cache: bool = True,
+  **config
+) -> Result:
+  """Every guild farms `events` mushrooms concurrently, rotating through `users` farmers
+
+  Without `weekly_cache`, every weekly lookup scans the `days` of history.
+  A SQLite backend gets a fresh database for every run, removed afterwards.
+  """
+  with scratch_sqlite() as sqlite_path:
+    bot = make_bot(storage_backend=backend, sqlite_path=sqlite_path, **config)
+    await bot.shroom_farm.setup()
+    await seed_history(bot, guilds, users, days)
+    if weekly_cache:
+      await bot.shroom_farm.prewarm_weekly_totals() # Pick up the seeded history
+    else:
+      bot.shroom_farm._weekly = None
+    bot.shroom_farm.daily_stats = DailyStats()
+    bot.caches_warm.set()
+
+    for guild_id in range(1, guilds + 1):
+      await bot.shroom_farm.create_farm(guild_id, channel=guild_id)
+
+    samples: list[int] = []
+    perf = time.perf_counter_ns
+
+    async def guild_worker(guild_id: int):
+      guild = FakeGuild(guild_id)
+      channel = FakeChannel(guild_id)
+      for i in range(events):
+        # Users take turns, so nobody farms twice in a row
+        author = FakeUser(guild_id * 100_000 + i % users)
+        message = FakeMessage(author, guild, channel) # type: ignore
+        t = perf()
+        await bot.on_message(message) # type: ignore
+        samples.append(perf() - t)
+
+    start = perf()
+    await asyncio.gather(*(guild_worker(g) for g in range(1, guilds + 1)))
+    elapsed = (perf() - start) / 1e9
+
+    await bot.shroom_farm.close()
+  return Result.from_samples(
+    "farm_pipeline",
+    {"backend": backend, "guilds": guilds, "users": users, "days": days, "weekly_cache": weekly_cache},
+    samples,
+    elapsed
+  )
+
+
+async def run(
+  events: int = 200,
+  guilds: tuple[int, ...] = (1, 10, 100),
+  users: tuple[int, ...] = (2, 50),
+  days: tuple[int, ...] = (0, 6),
+  backend: str = "memory"
+) -> list[Result]:
+  results = []
+  for g in guilds:
+    for u in users:
+      for d in days:
+        # The cache only makes a difference when there is history to scan
+        for weekly_cache in ((True, False) if d else (True,)):
+          results.append(await farm_pipeline(g, u, events, d, backend, weekly_cache))
+  return results
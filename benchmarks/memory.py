@@ -0,0 +1,83 @@
+"""
+Resident memory of the discord.py caches
+
+Each measurement logs a fresh `ShroomBot` into the stub in its own process, so
+earlier runs cannot inflate the numbers. The bot receives guilds full of
+members and presences, then chatter from those members, the same way the
+gateway would send them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gc
+import multiprocessing
+import os
+import random
+import resource
+import time
+
+from benchmarks.gateway import GatewayHarness, StubDiscord
+from benchmarks.results import Result
+
+
+def rss() -> int:
+  """The current resident set size in bytes"""
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except OSError:
+    # Peak rather than current, but the closest thing outside Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def _measure(guilds: int, members: int, messages: int, lean: bool) -> dict[str, int]:
+  harness = GatewayHarness(StubDiscord(), lean=lean)
+  gc.collect()
+  baseline = rss()
+  start = time.perf_counter()
+  await harness.start(guilds, members, farms=False)
+  gc.collect()
+  after_guilds = rss()
+
+  rng = random.Random(0)
+  for _ in range(messages):
+    guild_id = rng.randint(1, guilds)
+    harness.message_create(guild_id, guild_id * 100_000 + rng.randrange(max(members, 1)), "just chatting")
+  await harness.drain()
+  gc.collect()
+  after_messages = rss()
+  elapsed = time.perf_counter() - start
+
+  state = harness.bot._connection # type: ignore
+  cached_members = sum(len(g._members) for g in state._guilds.values())
+  cached_messages = len(state._messages) if state._messages is not None else 0
+  await harness.close()
+  return {
+    "elapsed_ms": int(elapsed * 1000),
+    "guilds_kb": (after_guilds - baseline) // 1024,
+    "messages_kb": (after_messages - after_guilds) // 1024,
+    "rss_kb": after_messages // 1024,
+    "cached_members": cached_members,
+    "cached_messages": cached_messages
+  }
+
+
+def _measure_in_process(args: tuple[int, int, int, bool]) -> dict[str, int]:
+  return asyncio.run(_measure(*args))
+
+
+def run(guilds: tuple[int, ...], members: tuple[int, ...], messages: int) -> list[Result]:
+  """Measures normal and lean mode for every combination of guild and member counts"""
+  results = []
+  ctx = multiprocessing.get_context("spawn")
+  for g in guilds:
+    for m in members:
+      for lean in (False, True):
+        with ctx.Pool(1) as pool:
+          counters = pool.apply(_measure_in_process, ((g, m, messages, lean),))
+        params = {"guilds": g, "members": m, "lean": lean}
+        result = Result("rss", params, messages, counters.pop("elapsed_ms") / 1000)
+        result.counters = counters
+        results.append(result)
+  return results
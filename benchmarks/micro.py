@@ -0,0 +1,179 @@
+"""
+Microbenchmarks for the pieces of the farm pipeline that do not touch storage
+"""
+
+from __future__ import annotations
+
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable
+
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+from bot.rates import RateTracker
+from bot.shroom.farm import Farm
+from bot.shroom.ranks import RANKS
+from bot.shroom.rollover import RolloverScheduler
+from bot.shroom.stats import DailyStats
+from bot.shroom.storage.base import project
+from bot.shroom.user import User
+
+from benchmarks.results import Result
+
+
+def _timed(name: str, params: dict, iterations: int, func: Callable[[int], object]) -> Result:
+  samples = []
+  perf = time.perf_counter_ns
+  start = perf()
+  for i in range(iterations):
+    t = perf()
+    func(i)
+    samples.append(perf() - t)
+  return Result.from_samples(name, params, samples, (perf() - start) / 1e9)
+
+
+def _peak_bytes(func: Callable[[int], object]) -> int:
+  """How much memory one call to `func` allocates at its peak"""
+  func(0)
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    func(0)
+    return tracemalloc.get_traced_memory()[1] - before
+  finally:
+    tracemalloc.stop()
+
+
+def make_daily_stats(guilds: int, contributors: int, seed: int = 0) -> tuple[DailyStats, list[Farm]]:
+  """Builds a `DailyStats` where every guild already has `contributors` contributors"""
+  rng = random.Random(seed)
+  stats = DailyStats()
+  farms = [Farm(guild_id, daily_goal=contributors * 10) for guild_id in range(1, guilds + 1)]
+  for farm in farms:
+    for user_id in range(contributors):
+      stats.inc_shroom_count(farm, 10_000 + user_id, rng.randint(1, 5))
+  return stats, farms
+
+
+def bench_inc_shroom_count(guilds: int, contributors: int, iterations: int) -> Result:
+  stats, farms = make_daily_stats(guilds, contributors)
+  rng = random.Random(1)
+  events = [(rng.choice(farms), 10_000 + rng.randrange(contributors)) for _ in range(iterations)]
+  return _timed(
+    "inc_shroom_count",
+    {"guilds": guilds, "contributors": contributors},
+    iterations,
+    lambda i: stats.inc_shroom_count(*events[i])
+  )
+
+
+def bench_stats_roundtrip(guilds: int, contributors: int, iterations: int) -> Result:
+  stats, _ = make_daily_stats(guilds, contributors)
+  return _timed(
+    "daily_stats_roundtrip",
+    {"guilds": guilds, "contributors": contributors},
+    iterations,
+    lambda _: DailyStats.from_db(stats.to_dict())
+  )
+
+
+def bench_latest_stats(guilds: int, contributors: int, iterations: int, decode: str) -> Result:
+  """Reads the `_id` and `date` of a stats document the way `save_daily_stats` does
+
+  `dict` decodes the whole reply and builds a `DailyStats` like before,
+  `raw` reads the two fields from a `RawBSONDocument` like the Mongo backend.
+  """
+  stats, _ = make_daily_stats(guilds, contributors)
+  data = bson.encode({"_id": ObjectId(), **stats.to_dict()})
+  def read_dict(_: int):
+    latest = DailyStats.from_db(bson.decode(data))
+    return latest._id, latest.date
+  def read_raw(_: int):
+    latest = RawBSONDocument(data)
+    return latest["_id"], latest["date"]
+  func = read_raw if decode == "raw" else read_dict
+  result = _timed("latest_stats", {"guilds": guilds, "contributors": contributors, "decode": decode}, iterations, func)
+  result.counters["peak_bytes"] = _peak_bytes(func)
+  return result
+
+
+def bench_weekly_lookup(guilds: int, contributors: int, iterations: int, projection: str) -> Result:
+  """Decodes one day of a farm's weekly total, from a reply projected to `farms` or to `farms.<id>`"""
+  stats, farms = make_daily_stats(guilds, contributors)
+  doc = {"_id": ObjectId(), **stats.to_dict()}
+  doc["farms"], doc["open"] = doc["open"], {}
+  farm_id = farms[len(farms) // 2]._id
+  fields = (f"farms.{farm_id}",) if projection == "farm" else ("farms",)
+  data = bson.encode(project(doc, fields))
+  def lookup(_: int):
+    return bson.decode(data)["farms"].get(str(farm_id))
+  result = _timed("weekly_lookup", {"guilds": guilds, "contributors": contributors, "projection": projection}, iterations, lookup)
+  result.counters["reply_bytes"] = len(data)
+  result.counters["peak_bytes"] = _peak_bytes(lookup)
+  return result
+
+
+def bench_farm_decode(iterations: int) -> Result:
+  """Builds a `Farm` from the BSON of one document, as `get_farm` does"""
+  data = bson.encode(Farm(1 << 60, 10, 3, 5, 1 << 50, 1 << 55, 20).to_dict())
+  func = lambda _: Farm(**bson.decode(data))
+  result = _timed("farm_decode", {}, iterations, func)
+  result.counters["peak_bytes"] = _peak_bytes(func)
+  return result
+
+
+def bench_rank_update(iterations: int) -> Result:
+  rng = random.Random(2)
+  top = RANKS[-1].requirement * 2
+  users = [User(i, farmed=rng.randrange(top), rank_enum=rng.randrange(len(RANKS))) for i in range(iterations)]
+  def update(i: int):
+    user = users[i]
+    if user.ranked_up or user.farmed < user.rank.requirement:
+      user.update_rank()
+  return _timed("rank_update", {}, iterations, update)
+
+
+def bench_rollover(farms: int, iterations: int) -> Result:
+  """Ends one farm day and schedules its next one, with `farms` days running"""
+  rng = random.Random(3)
+  start = datetime(2024, 1, 1)
+  scheduler = RolloverScheduler()
+  scheduler.reset((start + timedelta(seconds=rng.random() * 86400), farm_id) for farm_id in range(farms))
+  def rollover(_: int):
+    for ends, farm_id in scheduler.pop_due(scheduler.next_due): # type: ignore
+      scheduler.schedule(ends + timedelta(days=1), farm_id)
+  return _timed("rollover", {"farms": farms}, iterations, rollover)
+
+
+def bench_rate_record(keys: int, iterations: int) -> Result:
+  """Records one event for a random farm, with `keys` farms tracked"""
+  rng = random.Random(4)
+  tracker: RateTracker[int] = RateTracker(max_keys=keys)
+  for key in range(keys):
+    tracker.record(key)
+  farm_ids = [rng.randrange(keys * 2) for _ in range(iterations)] # Half of them get evicted or evict another
+  result = _timed("rate_record", {"keys": keys}, iterations, lambda i: tracker.record(farm_ids[i]))
+  result.counters["evicted"] = tracker.evicted
+  return result
+
+
+def run(iterations: int = 20_000, guilds: tuple[int, ...] = (10, 1000), contributors: tuple[int, ...] = (10, 200)) -> list[Result]:
+  results = []
+  for g in guilds:
+    for c in contributors:
+      results.append(bench_inc_shroom_count(g, c, iterations))
+      results.append(bench_stats_roundtrip(g, c, max(50, iterations // 100)))
+      for decode in ("dict", "raw"):
+        results.append(bench_latest_stats(g, c, max(50, iterations // 100), decode))
+      for projection in ("farms", "farm"):
+        results.append(bench_weekly_lookup(g, c, max(50, iterations // 100), projection))
+  results.append(bench_farm_decode(iterations))
+  results.append(bench_rank_update(iterations))
+  for g in guilds:
+    results.append(bench_rollover(g * 10, iterations))
+    results.append(bench_rate_record(g * 10, iterations))
+  return results
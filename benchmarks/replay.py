@@ -0,0 +1,145 @@
+"""
+Deterministic replay of a traffic log captured by `bot.recorder.TrafficRecorder`
+
+Events are fed through `ShroomBot.on_message` against a scratch backend, either
+at the recorded pace scaled by `speed` or as fast as possible. Every guild is
+replayed in order by its own worker so the final state only depends on the log,
+which makes the state checksum comparable between runs and commits.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import Counter
+from typing import TYPE_CHECKING
+
+from bot.recorder import SHROOM, TrafficEvent, read_events
+
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakeUser, make_bot, scratch_sqlite
+from benchmarks.results import Result
+
+if TYPE_CHECKING:
+  from bot import ShroomBot
+  from bot.shroom import ShroomFarm
+  from bot.shroom.stats import DailyFarmStatsDict
+
+
+async def state_checksum(shroom_farm: ShroomFarm) -> str:
+  """Hashes every farm, user and today's stats, running farm days included, leaving out wall clock timestamps"""
+  backend = shroom_farm.backend
+  farms = await backend.top_farms("_id", 2**31)
+  users = await backend.top_users("_id", 2**31)
+  stats = shroom_farm.daily_stats
+
+  def farm_days(days: dict[int, DailyFarmStatsDict]) -> dict[str, dict]:
+    return {str(farm_id): {k: v for k, v in d.items() if k != "ends"} for farm_id, d in days.items()}
+
+  doc = {
+    "farms": sorted(({k: v for k, v in f.items() if k != "updated"} for f in farms), key=lambda d: d["_id"]),
+    "users": sorted(({k: v for k, v in u.items() if k != "joined"} for u in users), key=lambda d: d["_id"]),
+    "daily": {
+      "total": stats.total,
+      "open": farm_days(stats.farms), # Farm days still running
+      "closed": farm_days(stats.closed),
+      "users": stats.to_dict()["users"]
+    }
+  }
+  return hashlib.sha256(json.dumps(doc, sort_keys=True, default=str).encode()).hexdigest()
+
+
+async def _replay_interaction(bot: ShroomBot, event: TrafficEvent) -> bool:
+  """Issues the storage calls behind the app commands that read farm state"""
+  shroom_farm = bot.shroom_farm
+  if event.cls == "/farm farmstats" and event.guild is not None:
+    if await shroom_farm.get_farm(event.guild) is not None:
+      shroom_farm.get_server_farmed_today(event.guild)
+      await shroom_farm.get_server_weekly_farmed(event.guild)
+  elif event.cls in ("/farm userstats", "/User Stats"):
+    if await shroom_farm.get_user(event.user_id) is not None:
+      shroom_farm.get_user_farmed_today(event.user_id)
+      await shroom_farm.get_user_weekly_farmed(event.user_id)
+  else:
+    return False
+  return True
+
+
+async def replay(path: str, speed: float | None = None, **config) -> list[Result]:
+  """Replays the log at `path`, `speed` of `None` means as fast as possible"""
+  with scratch_sqlite() as sqlite_path:
+    config.setdefault("sqlite_path", sqlite_path)
+    return await _replay(path, speed, make_bot(**config))
+
+
+async def _replay(path: str, speed: float | None, bot: ShroomBot) -> list[Result]:
+  await bot.shroom_farm.setup()
+  bot.caches_warm.set()
+
+  queues: dict[int | None, asyncio.Queue[TrafficEvent | None]] = {}
+  workers: list[asyncio.Task] = []
+  farm_samples: list[int] = []
+  interaction_samples: list[int] = []
+  skipped: Counter[str] = Counter()
+  farms_created: set[int] = set()
+  perf = time.perf_counter_ns
+
+  async def guild_worker(queue: asyncio.Queue[TrafficEvent | None]):
+    channels: dict[int, FakeChannel] = {}
+    while (event := await queue.get()) is not None:
+      t = perf()
+      if event.kind == "interaction":
+        if await _replay_interaction(bot, event):
+          interaction_samples.append(perf() - t)
+        else:
+          skipped[event.cls] += 1
+        continue
+
+      if event.cls != SHROOM or event.guild is None or event.channel is None:
+        skipped[event.cls] += 1
+        continue
+      if event.guild not in farms_created:
+        # The first channel anyone farmed in becomes the farm channel
+        farms_created.add(event.guild)
+        if await bot.shroom_farm.get_farm(event.guild) is None:
+          await bot.shroom_farm.create_farm(event.guild, event.channel)
+        t = perf()
+      channel = channels.setdefault(event.channel, FakeChannel(event.channel))
+      message = FakeMessage(FakeUser(event.user_id), FakeGuild(event.guild), channel)
+      await bot.on_message(message) # type: ignore
+      farm_samples.append(perf() - t)
+
+  first_t: float | None = None
+  start = time.perf_counter()
+  events = 0
+
+  for event in read_events(path):
+    events += 1
+    if first_t is None:
+      first_t = event.t
+    if speed is not None:
+      delay = (event.t - first_t) / speed - (time.perf_counter() - start)
+      if delay > 0:
+        await asyncio.sleep(delay)
+    queue = queues.get(event.guild)
+    if queue is None:
+      queue = queues[event.guild] = asyncio.Queue()
+      workers.append(asyncio.create_task(guild_worker(queue)))
+    queue.put_nowait(event)
+
+  for queue in queues.values():
+    queue.put_nowait(None)
+  await asyncio.gather(*workers)
+  elapsed = time.perf_counter() - start
+
+  checksum = await state_checksum(bot.shroom_farm)
+  await bot.shroom_farm.close()
+
+  params = {"log": path, "speed": "max" if speed is None else speed, "backend": bot.config.storage_backend}
+  results = [Result.from_samples("replay_farm", params, farm_samples, elapsed)]
+  if interaction_samples:
+    results.append(Result.from_samples("replay_interaction", params, interaction_samples, elapsed))
+  for r in results:
+    r.counters = {"events": events, "guilds": len(queues), "skipped": dict(skipped), "checksum": checksum}
+  return results
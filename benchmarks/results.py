@@ -0,0 +1,101 @@
+"""
+Timing helpers and the machine-readable result format
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(sorted_samples: list[int], p: float) -> int:
+  if not sorted_samples:
+    return 0
+  k = min(len(sorted_samples) - 1, round(p / 100 * (len(sorted_samples) - 1)))
+  return sorted_samples[k]
+
+
+@dataclass
+class Result:
+  """The result of one benchmark, latencies are in nanoseconds"""
+  name: str
+  params: dict[str, Any]
+  operations: int
+  elapsed_s: float
+  latency_ns: dict[str, int] = field(default_factory=dict)
+  counters: dict[str, Any] = field(default_factory=dict) # Anything else worth recording, not compared
+
+  @property
+  def throughput(self) -> float:
+    return self.operations / self.elapsed_s if self.elapsed_s else 0.0
+
+  @classmethod
+  def from_samples(cls, name: str, params: dict[str, Any], samples: list[int], elapsed_s: float) -> Result:
+    samples = sorted(samples)
+    latency = {f"p{p:g}": percentile(samples, p) for p in PERCENTILES}
+    if samples:
+      latency["max"] = samples[-1]
+      latency["mean"] = sum(samples) // len(samples)
+    return cls(name, params, len(samples), elapsed_s, latency)
+
+  def to_dict(self) -> dict[str, Any]:
+    d = asdict(self)
+    d["throughput"] = round(self.throughput, 2)
+    return d
+
+  def summary(self) -> str:
+    lat = " ".join(f"{k}={v / 1000:.1f}us" for k, v in self.latency_ns.items())
+    params = ",".join(f"{k}={v}" for k, v in self.params.items())
+    counters = "".join(f" {k}={v}" for k, v in self.counters.items())
+    return f"{self.name}[{params}] {self.throughput:,.0f} ops/s {lat}{counters}"
+
+
+def git_revision() -> str | None:
+  try:
+    return subprocess.check_output(
+      ("git", "rev-parse", "--short", "HEAD"), stderr=subprocess.DEVNULL, text=True
+    ).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def dump(results: list[Result], path: str | None):
+  doc = {
+    "revision": git_revision(),
+    "timestamp": time.time(),
+    "python": sys.version.split()[0],
+    "platform": platform.platform(),
+    "loop": type(asyncio.get_event_loop_policy()).__module__.split(".")[0],
+    "results": [r.to_dict() for r in results]
+  }
+  text = json.dumps(doc, indent=2)
+  if path is None or path == "-":
+    print(text)
+  else:
+    with open(path, "w") as f:
+      f.write(text)
+
+
+def compare(old_path: str, results: list[Result]) -> list[str]:
+  """Returns a line per benchmark showing the throughput change from a previous run"""
+  with open(old_path) as f:
+    old = {
+      (r["name"], json.dumps(r["params"], sort_keys=True)): r
+      for r in json.load(f)["results"]
+    }
+  lines = []
+  for r in results:
+    prev = old.get((r.name, json.dumps(r.params, sort_keys=True)))
+    if prev is None or not prev["throughput"]:
+      continue
+    change = (r.throughput - prev["throughput"]) / prev["throughput"] * 100
+    lines.append(f"{r.name}: {prev['throughput']:,.0f} -> {r.throughput:,.0f} ops/s ({change:+.1f}%)")
+  return lines
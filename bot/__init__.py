@@ -1,8 +1,11 @@
 
 __all__ = (
   "ShroomBot",
+  "ShardedShroomBot",
+  "bot_class",
+  "client_options",
   "get_config_from_env"
 )
 
-from bot.bot import ShroomBot
+from bot.bot import ShardedShroomBot, ShroomBot, bot_class, client_options
 from bot.config import get_config_from_env
\ No newline at end of file
@@ -0,0 +1,333 @@
+"""
+Streaming export and import of the ShroomDB collections
+
+An export is a directory with one folder per collection, holding gzipped
+chunk files of at most `chunk_docs` documents each, and a `manifest.json`.
+Documents are read with a batched cursor sorted by `_id` and written as they
+arrive, so memory use does not grow with the collection. The manifest is
+rewritten after every finished chunk with the last `_id` in it, and an
+interrupted export picks up from there with `{"_id": {"$gt": last_id}}`.
+
+Chunks are either NDJSON in canonical Extended JSON, which keeps every BSON
+type (`Int64` snowflakes, dates, `ObjectId`s) and is readable with `zcat`,
+or raw concatenated BSON, which is copied straight from the server's reply
+without being decoded and is a lot faster both ways.
+
+Imports read the chunks back and insert them with unordered `bulk_write`
+batches, `concurrency` of them in flight at once. Documents that are already
+there are skipped, so an interrupted import can simply be run again.
+`Stats` is the exception, the bot finds the latest day by insertion order, so
+it is imported in order one batch at a time.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Iterator
+
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+if TYPE_CHECKING:
+  from motor import motor_asyncio
+
+_log = logging.getLogger(__name__)
+
+COLLECTIONS = ("Farm", "Users", "Stats")
+FORMATS = ("ndjson", "bson")
+ORDERED = {"Stats"} # Collections read back in insertion order by the bot
+MANIFEST = "manifest.json"
+
+RAW = CodecOptions(document_class=RawBSONDocument, tz_aware=True)
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS
+
+
+@dataclass
+class Throughput:
+  collection: str
+  direction: str # "export" or "import"
+  documents: int
+  seconds: float
+  skipped: int = 0 # Imported documents that were already there
+
+  @property
+  def docs_per_second(self) -> float:
+    return self.documents / self.seconds if self.seconds else 0.0
+
+  def summary(self) -> str:
+    skipped = f", {self.skipped} already there" if self.skipped else ""
+    return (
+      f"{self.direction} {self.collection:<8}{self.documents:>10} docs in {self.seconds:>7.2f}s"
+      f"{self.docs_per_second:>12,.0f} docs/s{skipped}"
+    )
+
+
+class Manifest:
+  """What an export contains so far, kept in `<directory>/manifest.json`"""
+
+  def __init__(self, directory: str, data: dict[str, Any]):
+    self.directory = directory
+    self.data = data
+
+  @property
+  def format(self) -> str:
+    return self.data["format"]
+
+  @classmethod
+  def open(cls, directory: str, fmt: str, database: str) -> Manifest:
+    """Loads the manifest of an unfinished export, or starts a new one"""
+    try:
+      manifest = cls.load(directory)
+    except FileNotFoundError:
+      os.makedirs(directory, exist_ok=True)
+      return cls(directory, {
+        "format": fmt,
+        "database": database,
+        "started": datetime.now(timezone.utc).isoformat(),
+        "collections": {}
+      })
+    if manifest.format != fmt:
+      raise ValueError(f"`{directory}` holds a {manifest.format} export, can't resume it as {fmt}")
+    return manifest
+
+  @classmethod
+  def load(cls, directory: str) -> Manifest:
+    with open(os.path.join(directory, MANIFEST)) as f:
+      return cls(directory, json_util.loads(f.read(), json_options=JSON_OPTIONS))
+
+  def save(self):
+    path = os.path.join(self.directory, MANIFEST)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+      f.write(json.dumps(json.loads(json_util.dumps(self.data, json_options=JSON_OPTIONS)), indent=2))
+    os.replace(tmp, path)
+
+  def collection(self, name: str) -> dict[str, Any]:
+    return self.data["collections"].setdefault(name, {"parts": [], "count": 0, "last_id": None, "done": False})
+
+
+def encode(doc: RawBSONDocument, fmt: str) -> bytes:
+  if fmt == "bson":
+    return doc.raw
+  return json_util.dumps(doc, json_options=JSON_OPTIONS).encode() + b"\n"
+
+
+def read_chunk(path: str, fmt: str) -> Iterator[RawBSONDocument | dict[str, Any]]:
+  """Streams the documents of one chunk file"""
+  with gzip.open(path, "rb") as f:
+    if fmt == "bson":
+      yield from bson.decode_file_iter(f, codec_options=RAW)
+    else:
+      for line in f:
+        if line.strip():
+          yield json_util.loads(line, json_options=JSON_OPTIONS)
+
+
+class ChunkWriter:
+  """Writes one chunk file, which only gets its real name once it is complete"""
+
+  def __init__(self, path: str, compresslevel: int):
+    self.path = path
+    self.count = 0
+    self._tmp = f"{path}.tmp"
+    self._file = gzip.open(self._tmp, "wb", compresslevel=compresslevel)
+
+  def write(self, data: bytes):
+    self._file.write(data)
+    self.count += 1
+
+  def close(self):
+    self._file.close()
+    os.replace(self._tmp, self.path)
+
+
+async def export_collection(
+    db: motor_asyncio.AsyncIOMotorDatabase,
+    name: str,
+    manifest: Manifest,
+    chunk_docs: int = 100_000,
+    batch_size: int = 1000,
+    compresslevel: int = 6
+) -> Throughput:
+  """|coro|
+
+  Exports one collection, continuing after the last chunk in `manifest`
+  """
+  state = manifest.collection(name)
+  if state["done"]:
+    _log.info(f"`{name}` was already exported, skipping it")
+    return Throughput(name, "export", 0, 0.0)
+
+  os.makedirs(os.path.join(manifest.directory, name), exist_ok=True)
+  query = {"_id": {"$gt": state["last_id"]}} if state["last_id"] is not None else {}
+  cursor = db.get_collection(name, codec_options=RAW).find(query, sort=[("_id", 1)], batch_size=batch_size)
+
+  exported = 0
+  writer: ChunkWriter | None = None
+  last_id = None
+
+  def finish_chunk():
+    nonlocal writer
+    assert writer is not None
+    writer.close()
+    state["parts"].append(os.path.relpath(writer.path, manifest.directory))
+    state["count"] += writer.count
+    state["last_id"] = last_id
+    manifest.save()
+    writer = None
+
+  start = perf_counter()
+  async for doc in cursor:
+    if writer is None:
+      part = f"part-{len(state['parts']):05}.{manifest.format}.gz"
+      writer = ChunkWriter(os.path.join(manifest.directory, name, part), compresslevel)
+    writer.write(encode(doc, manifest.format))
+    last_id = doc["_id"]
+    exported += 1
+    if writer.count >= chunk_docs:
+      finish_chunk()
+      _log.info(f"Exported {state['count']} `{name}` documents")
+  if writer is not None:
+    finish_chunk()
+  state["done"] = True
+  manifest.save()
+  return Throughput(name, "export", exported, perf_counter() - start)
+
+
+async def export_all(
+    db: motor_asyncio.AsyncIOMotorDatabase,
+    directory: str,
+    fmt: str = "ndjson",
+    collections: tuple[str, ...] = COLLECTIONS,
+    **kwargs: Any
+) -> list[Throughput]:
+  """|coro|
+
+  Exports `collections` into `directory`, resuming the export already there
+  """
+  manifest = Manifest.open(directory, fmt, db.name)
+  results = [await export_collection(db, name, manifest, **kwargs) for name in collections]
+  manifest.data["finished"] = datetime.now(timezone.utc).isoformat()
+  manifest.save()
+  return results
+
+
+async def write_batch(
+    collection: motor_asyncio.AsyncIOMotorCollection,
+    batch: list[Any],
+    ordered: bool = False,
+    replace: bool = False
+) -> tuple[int, int]:
+  """|coro|
+
+  Writes one batch with `bulk_write`, returns how many documents were written
+  and how many were skipped because they were already there
+  """
+  written = skipped = 0
+  while batch:
+    if replace:
+      requests: list[Any] = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch]
+    else:
+      requests = [InsertOne(doc) for doc in batch]
+    try:
+      await collection.bulk_write(requests, ordered=ordered)
+    except BulkWriteError as e:
+      errors = e.details.get("writeErrors", [])
+      if any(error["code"] != 11000 for error in errors):
+        raise
+      if ordered:
+        # An ordered write stops at the first duplicate, carry on after it
+        index = errors[0]["index"]
+        written += index
+        skipped += 1
+        batch = batch[index + 1:]
+        continue
+      return written + len(batch) - len(errors), skipped + len(errors)
+    return written + len(batch), skipped
+  return written, skipped
+
+
+async def import_collection(
+    db: motor_asyncio.AsyncIOMotorDatabase,
+    name: str,
+    manifest: Manifest,
+    batch_size: int = 1000,
+    concurrency: int = 4,
+    replace: bool = False
+) -> Throughput:
+  """|coro|
+
+  Imports one collection from an export
+
+  With `replace` documents that are already there are overwritten instead of
+  skipped.
+  """
+  state = manifest.data["collections"].get(name)
+  if state is None:
+    _log.warning(f"The export has no `{name}` collection, skipping it")
+    return Throughput(name, "import", 0, 0.0)
+  if not state["done"]:
+    _log.warning(f"The export of `{name}` is unfinished, importing the {state['count']} documents that were exported")
+
+  ordered = name in ORDERED
+  workers = 1 if ordered else max(concurrency, 1)
+  collection = db.get_collection(name, codec_options=RAW)
+  # Bounded, so reading the chunks never gets more than a few batches ahead of the writes
+  queue: asyncio.Queue[list[Any] | None] = asyncio.Queue(maxsize=workers * 2)
+  written = skipped = 0
+
+  async def reader():
+    batch: list[Any] = []
+    for part in state["parts"]:
+      for doc in read_chunk(os.path.join(manifest.directory, part), manifest.format):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+          await queue.put(batch)
+          batch = []
+      _log.info(f"Read `{part}`, {written + skipped} `{name}` documents written so far")
+    if batch:
+      await queue.put(batch)
+    for _ in range(workers):
+      await queue.put(None)
+
+  async def writer():
+    nonlocal written, skipped
+    while (batch := await queue.get()) is not None:
+      w, s = await write_batch(collection, batch, ordered, replace)
+      written += w
+      skipped += s
+
+  start = perf_counter()
+  tasks = [asyncio.create_task(reader())] + [asyncio.create_task(writer()) for _ in range(workers)]
+  try:
+    await asyncio.gather(*tasks)
+  finally:
+    # A failed write must not leave the reader waiting on a full queue
+    for task in tasks:
+      task.cancel()
+  return Throughput(name, "import", written, perf_counter() - start, skipped)
+
+
+async def import_all(
+    db: motor_asyncio.AsyncIOMotorDatabase,
+    directory: str,
+    collections: tuple[str, ...] = COLLECTIONS,
+    **kwargs: Any
+) -> list[Throughput]:
+  """|coro|
+
+  Imports `collections` from the export in `directory`
+  """
+  manifest = Manifest.load(directory)
+  return [await import_collection(db, name, manifest, **kwargs) for name in collections]
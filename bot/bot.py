@@ -1,48 +1,129 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
 import logging
-from typing import TYPE_CHECKING
+import time
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Awaitable, TypeVar
 
+import aiohttp
 import discord
+from aiohttp import web
 from discord import app_commands
 from discord.ext import commands, tasks
 
+from bot.cluster import Cluster, create_cluster
 from bot.constants import EXTENSIONS
 from bot.embeds import UNDER_MAINTENANCE
 from bot.errors import UnderMaintenance
 from bot.manager import FarmingManager
-from bot.shroom import ShroomFarm
+from bot.metrics import METRICS, start_metrics_server
+from bot.quotes import QuoteBuffer
+from bot.rates import RateTracker
+from bot.recorder import TrafficRecorder
+from bot.shards import ShardRates, count_event, count_farmed, parse_shard_ids, shard_for
+from bot.shroom import ShroomFarm, snapshot
+from bot.shroom.storage import create_backend
+from bot.shroom.storage.mongo import redact_url
+from bot.shroom.storage.monitoring import COMMANDS
+from bot.sync import CommandSyncer
+from bot.tracing import start_trace
 from bot.utils import int_to_ordinal
+from bot.watchdog import LoopWatchdog
 
 if TYPE_CHECKING:
   from discord import Message
 
   from bot.config import Config
   from bot.shroom.farm import Farm
+  from bot.shroom.storage import StorageBackend
+
+T = TypeVar("T")
 
 SHROOM_RESET_TIME = datetime.time(hour=0, minute=0, tzinfo=datetime.timezone.utc) # We should move this to constants
 
 _log = logging.getLogger(__name__)
 
 
+def client_options(config: Config) -> dict[str, Any]:
+  """The intents and cache settings to create a `ShroomBot` with
+
+  Farming only needs guilds, message content and interactions. In lean mode
+  members and presences are neither requested nor cached, so the few places
+  that need a member have to use `ShroomBot.get_or_fetch_member`.
+
+  When sharded the shard count and range are passed on too, so the options
+  are meant for `bot_class(config)`.
+  """
+  options: dict[str, Any] = {}
+  if config.sharded:
+    options["shard_count"] = config.shard_count
+    options["shard_ids"] = parse_shard_ids(config.shard_ids)
+  if not config.lean:
+    options["intents"] = discord.Intents.all()
+    return options
+  intents = discord.Intents.none()
+  intents.guilds = True
+  intents.guild_messages = True
+  intents.dm_messages = True # Owner commands
+  intents.message_content = True
+  options.update(
+    intents=intents,
+    member_cache_flags=discord.MemberCacheFlags.none(),
+    max_messages=None,
+    chunk_guilds_at_startup=False
+  )
+  return options
+
+
+def bot_class(config: Config) -> type[ShroomBot]:
+  return ShardedShroomBot if config.sharded else ShroomBot
+
 
 class ShroomBot(commands.Bot):
-  def __init__(self, config: Config, *args, **kwargs):
+  def __init__(self, config: Config, *args, backend: StorageBackend | None = None, **kwargs):
     self.config = config
 
     self.dev_server: discord.Object = discord.Object(config.dev_server_id)
     self.token: str = config.token
     self.prefix: str = str(config.prefix)
     self.maintenance_mode = config.maintenance_mode
-    url: str = config.mongo_url
-
-    print(f"Connecting to database at: {url}")
-
-    self.shroom_farm = ShroomFarm(url)
+    if config.storage_backend == "mongo":
+      _log.info(f"Connecting to database at: {redact_url(config.mongo_url)}")
+
+    if backend is None:
+      backend = create_backend(config)
+    self.cluster: Cluster | None = (
+      create_cluster(config, backend, kwargs.get("shard_ids"))
+      if config.cluster else None
+    )
+    self.shroom_farm = ShroomFarm(
+      backend,
+      kwargs.get("shard_count"),
+      kwargs.get("shard_ids"),
+      self.cluster.process_id if self.cluster is not None else None,
+      # Memory backends are empty after a restart, so there'd be nothing to save the journal to
+      config.rollover_journal if config.storage_backend != "memory" else None
+    )
     self.manager = FarmingManager()
+    self.recorder: TrafficRecorder | None = (
+      TrafficRecorder(config.traffic_log, self.prefix)
+      if config.traffic_log else None
+    )
 
     self.presence_selector = True
+    self._metrics_runner: web.AppRunner | None = None
+    self.http_session: aiohttp.ClientSession | None = None # For everything that isn't Discord
+    self.quotes: QuoteBuffer | None = None
+    self.watchdog = LoopWatchdog(config.loop_lag_threshold_ms / 1000)
+    self.caches_warm = asyncio.Event() # 🍄 is ignored until this is set
+    self.shard_rates = ShardRates()
+    # Sliding-window rates for spotting hot farms, and for anything that wants to throttle them
+    self.farm_rates: RateTracker[int] = RateTracker(config.rate_tracker_keys) # 🍄 farmed per farm
+    self.channel_rates: RateTracker[int] = RateTracker(config.rate_tracker_keys) # Messages per channel, ignored ones too
+    self._warm_task: asyncio.Task | None = None
+    self._rollover_task: asyncio.Task | None = None
 
     super().__init__(
       command_prefix=commands.when_mentioned_or(self.prefix),
@@ -53,6 +134,13 @@ class ShroomBot(commands.Bot):
     self.default_tree_on_error = self.tree.on_error # this needs to be after __init__ since it is created in there
     self.tree.error(self.on_tree_error)
 
+    if config.gateway_fast_path:
+      # Every shard's websocket dispatches through this same dict
+      parsers = self._connection.parsers
+      self._parse_message_create = parsers["MESSAGE_CREATE"]
+      parsers["MESSAGE_CREATE"] = self.parse_message_create
+    self.syncer = CommandSyncer(self.tree, config.command_sync_state)
+
     self.add_check(self.global_command_check)
 
 
@@ -61,24 +149,113 @@ class ShroomBot(commands.Bot):
     return self.maintenance_mode
 
 
+  async def get_or_fetch_member(self, guild: discord.Guild, user_id: int) -> discord.Member | None:
+    """Gets a member from the cache, asking Discord for it when it is not cached"""
+    member = guild.get_member(user_id)
+    if member is not None:
+      return member
+    try:
+      return await guild.fetch_member(user_id)
+    except discord.NotFound:
+      return None
+
+
   async def global_command_check(self, ctx: commands.Context):
     if not await self.is_owner(ctx.author):
       raise commands.NotOwner("You do not own this bot.")
     return True
 
 
+  @property
+  def shard_latencies(self) -> list[tuple[int, float]]:
+    """`(shard_id, latency)` of every shard this process runs"""
+    return [(0, self.latency)]
+
+
   def run(self, **kwargs):
     super().run(self.token, **kwargs)
 
 
+  @property
+  def storage_source(self) -> str | None:
+    """What a snapshot has to match to be restored, `None` when snapshots are off"""
+    config = self.config
+    if not config.snapshot_path or config.storage_backend == "memory":
+      return None # Memory backends are empty after a restart, so a snapshot would never match
+    if config.storage_backend == "sqlite":
+      source = f"sqlite:{config.sqlite_path}"
+    else:
+      source = f"{config.storage_backend}:{config.mongo_url}"
+    if config.sharded:
+      # A snapshot only holds the farms of the shards that were running
+      source += f"#{config.shard_count or 'auto'}:{config.shard_ids or 'all'}"
+    return source
+
+
+  async def write_snapshot(self):
+    source = self.storage_source
+    if source is None or not self.caches_warm.is_set():
+      return
+    try:
+      await asyncio.to_thread(snapshot.write, self.config.snapshot_path, self.shroom_farm, source) # type: ignore
+    except (snapshot.SnapshotError, OSError) as e:
+      _log.warning(f"Could not write a snapshot: {e}")
+    else:
+      _log.info(f"Wrote a snapshot to `{self.config.snapshot_path}`")
+
+
+  async def close(self) -> None:
+    await super().close()
+    if self._warm_task is not None:
+      self._warm_task.cancel()
+    if self._rollover_task is not None:
+      self._rollover_task.cancel()
+    self.watchdog.stop()
+    if self.quotes is not None:
+      self.quotes.stop()
+    if self.http_session is not None:
+      await self.http_session.close()
+    await self.write_snapshot()
+    if self.cluster is not None:
+      await self.cluster.stop()
+    await self.shroom_farm.close()
+    if self.recorder is not None:
+      self.recorder.close()
+    if self._metrics_runner is not None:
+      await self._metrics_runner.cleanup()
+
+
   @tasks.loop(time=SHROOM_RESET_TIME)
   async def update_stats_loop(self):
-    _log.info("Attempting to update daily stats")
-    result = await self.shroom_farm.update_daily_stats()
-    if result:
-      _log.info("Daily Stats updated successfully")
-    else:
-      _log.warn("Daily Stats update was unsuccessful")
+    _log.info("Starting a new day, the one that ended is saved in the background")
+    journaled = await self.shroom_farm.update_daily_stats()
+    if not journaled:
+      _log.warning("The day that ended is not in the rollover journal, it is lost if the bot stops before it is saved")
+
+
+  async def rollover_farms_loop(self):
+    """Ends each farm's day at midnight in its timezone
+
+    Sleeps until the next farm day ends, or until a farm starts a day that
+    ends sooner than that.
+    """
+    rollovers = self.shroom_farm.rollovers
+    while True:
+      rollovers.wake.clear()
+      due = rollovers.next_due
+      timeout = max(0.0, (due - datetime.datetime.utcnow()).total_seconds()) if due is not None else None
+      try:
+        await asyncio.wait_for(rollovers.wake.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+      try:
+        ended = await self.shroom_farm.rollover_farms()
+      except Exception:
+        # They are ended in memory already, so the next save catches up
+        _log.exception("Saving ended farm days failed")
+      else:
+        if ended:
+          _log.info(f"Ended the day of {ended} farms")
 
 
   @tasks.loop(minutes=1)
@@ -89,31 +266,118 @@ class ShroomBot(commands.Bot):
         status=discord.Status.idle
       )
     if self.presence_selector:
-      n = await self.shroom_farm.get_total_weekly_farmed() # technically we could just cache this and just add total to it
-      msg = f"{n} farmed this week"                        # but I'm too lazy
+      n = await self.shroom_farm.get_total_weekly_farmed()
+      msg = f"{n} farmed this week"
     else:
       n = self.shroom_farm.daily_stats.total
       msg = f"{n} farmed today"
     self.presence_selector = not self.presence_selector
+    # Without a `shard_id` this sets the presence of every shard at once, so
+    # the total is only worked out once rather than once per shard
     await self.change_presence(activity=discord.Game(name=msg))
 
   @update_presence_loop.before_loop
   async def before_presence_loop(self):
     await self.wait_until_ready()
+    await self.caches_warm.wait()
+
+
+  async def _startup_phase(self, name: str, coro: Awaitable[T]) -> T:
+    with METRICS.span(f"startup.{name}") as span:
+      result = await coro
+    _log.info(f"Startup phase `{name}` took {span.elapsed * 1000:.1f}ms")
+    return result
+
+
+  async def load_extensions(self):
+    for ext in EXTENSIONS:
+      _log.info(f"Loading extention `{ext}`")
+      await self.load_extension(ext)
+
+
+  async def connect_storage(self) -> bool:
+    """Connects to the database and restores today's stats, returns whether that came from a snapshot"""
+    await self._startup_phase("connect", self.shroom_farm.connect())
+    await self._startup_phase("recover_days", self.shroom_farm.recover_pending_days())
+    source = self.storage_source
+    if source is not None:
+      restored = await self._startup_phase(
+        "load_snapshot",
+        asyncio.to_thread(snapshot.load, self.config.snapshot_path, source, self.config.snapshot_max_age) # type: ignore
+      )
+      if restored is not None:
+        self.shroom_farm.restore_snapshot(restored)
+        _log.info(f"Restored {len(restored.farms)} farms from a snapshot taken {time.time() - restored.created:.0f}s ago")
+        return True
+    await self._startup_phase("restore_stats", self.shroom_farm.restore_daily_stats())
+    return False
+
+
+  async def warm_caches(self):
+    """Fills the farm and weekly caches, then starts accepting 🍄
+
+    This runs in the background, so the bot can already connect to the
+    gateway and answer commands while it does.
+    """
+    start = perf_counter()
+    try:
+      await asyncio.gather(
+        self._startup_phase("prewarm_farms", self.shroom_farm.prewarm_farms()),
+        self._startup_phase("prewarm_weekly", self.shroom_farm.prewarm_weekly_totals())
+      )
+    except Exception:
+      # Lookups fall back to the database, so farming still works, just slower
+      _log.exception("Warming up caches failed")
+    self.caches_warm.set()
+    _log.info(f"Caches warmed up in {(perf_counter() - start) * 1000:.1f}ms, now accepting 🍄")
+
+
+  async def auto_sync(self):
+    guilds = (self.dev_server,) if self.tree.get_commands(guild=self.dev_server) else ()
+    try:
+      await self.syncer.sync_changed(guilds)
+    except Exception:
+      # Stale commands are better than not starting at all
+      _log.exception("Syncing commands on startup failed")
 
 
   async def setup_hook(self) -> None:
-    await self.shroom_farm.setup()
+    if self.config.loop_lag_threshold_ms > 0:
+      self.watchdog.start()
+
+    if self.config.metrics_port is not None:
+      self._metrics_runner = await start_metrics_server(self.config.metrics_port)
+
+    self.http_session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300),
+      timeout=aiohttp.ClientTimeout(total=10)
+    )
+    self.quotes = QuoteBuffer(self.http_session, self.config.quote_api_url, self.config.quote_buffer_size)
+    self.quotes.start()
+
+    # Extensions don't touch the database, so they can load while it connects
+    from_snapshot, _ = await asyncio.gather(
+      self.connect_storage(),
+      self._startup_phase("load_extensions", self.load_extensions())
+    )
+    if self.cluster is not None:
+      self.cluster.on_gained = self.shroom_farm.reload_shards # type: ignore
+      await self._startup_phase("join_cluster", self.cluster.start())
+
+    if from_snapshot:
+      self.caches_warm.set()
+    else:
+      self._warm_task = asyncio.create_task(self.warm_caches())
+
+    if self.config.auto_sync:
+      await self._startup_phase("sync_commands", self.auto_sync())
 
     # This might be a problem if the bot is started at exactly
     # 12am which could make an empty `DailyStats` object be inserted
     # into the database, but I'm sure it's fine...
     self.update_stats_loop.start()
     self.update_presence_loop.start()
-
-    for ext in EXTENSIONS:
-      _log.info(f"Loading extention `{ext}`")
-      await self.load_extension(ext)
+    self._rollover_task = asyncio.create_task(self.rollover_farms_loop(), name="shroom-rollover")
 
 
   async def on_tree_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
@@ -168,12 +432,22 @@ class ShroomBot(commands.Bot):
       amount: int = 1,
       ignore_last: bool = False
   ):
-    await self.manager.acquire_farm(farm._id) # Ensure that a server is only processed one at a time
+    with METRICS.span("farm.lock_wait") as span:
+      await self.manager.acquire_farm(farm._id) # Ensure that a server is only processed one at a time
+      if self.cluster is not None:
+        # And across processes, then catch up on what the last holder wrote
+        if not await self.cluster.acquire_farm(farm._id):
+          self.manager.release_farm(farm._id)
+          _log.warning(f"Timed out waiting for the lease on farm {farm._id}, dropping the farm")
+          return
+        await self.shroom_farm.reload_farm(farm)
+    _log.debug("Acquired farm %s after %.2fms", farm._id, span.elapsed * 1000)
     try:
 
       user_id = user_id or message.author.id
 
       if not ignore_last and farm.last_farmer == user_id:
+        METRICS.inc("farm.rejected")
         embed = discord.Embed(
           title="You cannot farm mushrooms now",
           description="You can only farm mushrooms one at a time",
@@ -188,10 +462,13 @@ class ShroomBot(commands.Bot):
         except discord.NotFound:
           await message.channel.send(message.author.mention, embed=embed, silent=True)
         finally:
-          self.manager.release_farm(farm._id)
-          return
+          return # Released below, after the lease
 
-      result = await self.shroom_farm.farm(farm, user_id, amount)
+      with METRICS.span("farm.shroom_farm") as span:
+        result = await self.shroom_farm.farm(farm, user_id, amount)
+      METRICS.inc("farm.farmed")
+      count_farmed(message.guild.shard_id, amount) # type: ignore
+      _log.debug("User %s farmed %s in farm %s in %.2fms", user_id, amount, farm._id, span.elapsed * 1000)
 
       embeds = []
       embed = discord.Embed(
@@ -218,48 +495,151 @@ class ShroomBot(commands.Bot):
           )
         )
       if result.user_ranked_up:
+        name = message.author.name
+        if user_id != message.author.id and message.guild is not None:
+          member = await self.get_or_fetch_member(message.guild, user_id)
+          name = member.name if member is not None else str(user_id)
         embeds.append(
           discord.Embed(
-            title=f"{message.author.name} ranked up!", # This will be incorrect if user_id is specified, but it's fine
+            title=f"{name} ranked up!",
             description=f"Your rank is now `{result.user.rank.name}`!",
             colour=discord.Colour.green()
           )
         )
       
-      try:
-        await message.add_reaction("🍄")
-        await message.reply(embeds=embeds, mention_author=False)
-      except discord.NotFound:
-        # Message probably got deleted
-        await message.channel.send(message.author.mention, embeds=embeds, silent=True)
+      with METRICS.span("farm.reply") as span:
+        try:
+          await message.add_reaction("🍄")
+          await message.reply(embeds=embeds, mention_author=False)
+        except discord.NotFound:
+          # Message probably got deleted
+          await message.channel.send(message.author.mention, embeds=embeds, silent=True)
+      _log.debug("Replied to farm %s in %.2fms", farm._id, span.elapsed * 1000)
     finally:
-      self.manager.release_farm(farm._id)
+      try:
+        # Leases are per process, so this has to happen before anything
+        # else here can take the farm
+        if self.cluster is not None:
+          await self.cluster.release_farm(farm._id)
+      finally:
+        self.manager.release_farm(farm._id)
+
+
+  async def on_interaction(self, interaction: discord.Interaction):
+    if interaction.guild is not None:
+      count_event(interaction.guild.shard_id)
+    if self.recorder is not None and interaction.type is discord.InteractionType.application_command:
+      self.recorder.record_interaction(interaction)
+
+
+  def parse_message_create(self, data: dict[str, Any]):
+    """Stands in for discord.py's MESSAGE_CREATE parser, only passing on `wanted_message`s"""
+    if self.wanted_message(data):
+      self._parse_message_create(data)
+
+
+  def wanted_message(self, data: dict[str, Any]) -> bool:
+    """Whether `on_message` would act on the raw MESSAGE_CREATE payload `data`
+
+    Nearly every message is chatter that `on_message` ignores, and building
+    its `Message` costs more than everything else done with it. Messages
+    that are ignored are counted and recorded here straight from the payload
+    instead. Those are messages from bots, 🍄 that wouldn't be farmed or
+    answered going by the caches, and anything else except commands from
+    owners. Whatever can't be ruled out this way gets a `Message` as before.
+    """
+    author = data["author"]
+    if author.get("bot"):
+      return False
+    content: str = data.get("content", "")
+    guild_id = int(data["guild_id"]) if "guild_id" in data else None
+    channel_id = int(data["channel_id"])
+    if content == "🍄":
+      if (
+        guild_id is not None
+        and self.caches_warm.is_set()
+        and (self.cluster is None or self.cluster.owns(guild_id))
+        and not self.shroom_farm.ignores_shroom(guild_id, channel_id)
+      ):
+        return True
+    elif content.startswith((self.prefix, "<@")):
+      # Every prefix command is owner only, see `global_command_check`. The
+      # owners are only known once `is_owner` has asked Discord, until then
+      # commands take the slow path.
+      owner_ids = self.owner_ids or ({self.owner_id} if self.owner_id is not None else None)
+      if owner_ids is None or int(author["id"]) in owner_ids:
+        return True
+
+    METRICS.inc("gateway.messages_skipped")
+    if self.recorder is not None:
+      self.recorder.record_raw_message(guild_id, channel_id, int(author["id"]), content)
+    if guild_id is not None:
+      count_event(shard_for(guild_id, self._connection.shard_count or 1))
+      self.channel_rates.record(channel_id)
+    return False
 
 
   async def on_message(self, message: Message):
     if message.author.bot:
       return
 
+    if self.recorder is not None:
+      self.recorder.record_message(message)
+
+    if message.guild is not None:
+      count_event(message.guild.shard_id)
+      self.channel_rates.record(message.channel.id)
+
     if message.content == "🍄":
-      if message.guild is None:
+      if message.guild is None or not self.caches_warm.is_set():
         return
-      farm = await self.shroom_farm.get_farm(message.guild.id)
-      if farm is None or farm.farm_channel is None:
-        embed = discord.Embed(
-          title="Farm not set up!",
-          description="Use `/setup` to setup your server and start farming!",
-          colour=discord.Colour.red()
-        )
-      elif farm.farm_channel != message.channel.id:
-        return
-      elif self.under_maintenance:
-        embed = UNDER_MAINTENANCE
-      else:
-        return await self.farm(farm, message)
+      if self.cluster is not None and not self.cluster.owns(message.guild.id):
+        return # Another process runs this shard too and is the one farming it
+      trace = start_trace()
       try:
-        await message.reply(embed=embed, mention_author=False)
-      except discord.NotFound:
-        # Message got deleted
-        await message.channel.send(message.author.mention, embed=embed, silent=True)
+        with METRICS.span("on_message"):
+          await self.handle_shroom(message)
+      finally:
+        COMMANDS.end_trace(trace)
+    else:
+      with METRICS.span("on_message.process_commands"):
+        await self.process_commands(message)
+
+
+  async def handle_shroom(self, message: Message):
+    with METRICS.span("on_message.get_farm"):
+      farm = await self.shroom_farm.get_farm(message.guild.id) # type: ignore
+    if farm is None or farm.farm_channel is None:
+      embed = discord.Embed(
+        title="Farm not set up!",
+        description="Use `/setup` to setup your server and start farming!",
+        colour=discord.Colour.red()
+      )
+    elif farm.farm_channel != message.channel.id:
+      return
+    elif self.under_maintenance:
+      embed = UNDER_MAINTENANCE
     else:
-      await self.process_commands(message)
+      self.farm_rates.record(farm._id)
+      return await self.farm(farm, message)
+    try:
+      await message.reply(embed=embed, mention_author=False)
+    except discord.NotFound:
+      # Message got deleted
+      await message.channel.send(message.author.mention, embed=embed, silent=True)
+
+
+class ShardedShroomBot(ShroomBot, commands.AutoShardedBot):
+  """A `ShroomBot` that runs `shard_count` shards, or the `shard_ids` range of them"""
+
+  @property
+  def shard_latencies(self) -> list[tuple[int, float]]:
+    return self.latencies
+
+
+  async def launch_shards(self) -> None:
+    await super().launch_shards()
+    # Without a configured count, Discord's recommendation is only known now
+    if self.shard_count != self.shroom_farm.shard_count:
+      _log.info(f"Partitioning the farm cache into {self.shard_count} shards")
+      self.shroom_farm.assign_shards(self.shard_count, self.shard_ids) # type: ignore
@@ -0,0 +1,307 @@
+"""
+Running several bot processes against one database
+
+Every process runs a range of shards (see `bot.shards`), so Discord already
+sends each guild's events to one process. What they share is the database,
+which is kept consistent three ways:
+
+- Farm documents carry a `version` that every write bumps, and
+  `ShroomFarm.save_farm` only writes if the version is still the one it read.
+  A write based on a stale read fails and is retried on top of the new one.
+- Farming a farm holds a lease on it in the `Locks` collection, the cross
+  process version of `FarmingManager`. Leases expire, so a crashed process
+  never holds a farm forever, and the version check catches the writes of a
+  process whose lease ran out mid-farm.
+- Every process registers its shards in the `Cluster` collection and keeps
+  that fresh with a heartbeat. That is the guild to process ownership map.
+  During a rolling restart two processes can run the same shards for a
+  while, only the one that registered first farms their guilds.
+
+Lease and heartbeat expiry use the database server's clock, so the clocks of
+the processes don't have to agree. `LocalClusterStore` keeps the same state
+in memory, for running several bots in one process in tests and benchmarks.
+`create_cluster` only ever uses Mongo, the other backends give no safety
+between processes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import timezone
+from typing import TYPE_CHECKING, Awaitable, Callable, Protocol
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from bot.metrics import METRICS
+from bot.shards import shard_for
+from bot.shroom.storage import MongoBackend
+
+if TYPE_CHECKING:
+  from motor import motor_asyncio
+
+  from bot.config import Config
+  from bot.shroom.storage import StorageBackend
+
+_log = logging.getLogger(__name__)
+
+
+@dataclass
+class Member:
+  process_id: str
+  shard_count: int
+  shard_ids: list[int] | None # `None` runs every shard
+  started: float = 0.0 # Set by the store when the process first registers
+
+
+class ClusterStore(Protocol):
+  """Where leases and cluster members are kept"""
+
+  async def setup(self) -> None:
+    ...
+
+  async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+    """Takes the lease on `key` for `ttl` seconds unless someone else holds it, renewing it if `owner` does"""
+    ...
+
+  async def release_lease(self, key: str, owner: str) -> None:
+    ...
+
+  async def heartbeat(self, member: Member, ttl: float) -> None:
+    """Registers `member`, or keeps it registered for another `ttl` seconds"""
+    ...
+
+  async def leave(self, process_id: str) -> None:
+    ...
+
+  async def members(self) -> list[Member]:
+    """Every member whose heartbeat has not expired"""
+    ...
+
+
+class MongoClusterStore:
+  """Keeps leases in `Locks` and members in `Cluster`, needs MongoDB 4.2+ for pipeline updates"""
+
+  def __init__(self, database: motor_asyncio.AsyncIOMotorDatabase):
+    self.locks: motor_asyncio.AsyncIOMotorCollection = database["Locks"]
+    self.cluster: motor_asyncio.AsyncIOMotorCollection = database["Cluster"]
+
+  async def setup(self) -> None:
+    # Expired documents are harmless, these just stop them from piling up
+    await self.locks.create_index("expires", expireAfterSeconds=60)
+    await self.cluster.create_index("expires", expireAfterSeconds=3600)
+
+  async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+    try:
+      await self.locks.update_one(
+        {"_id": key, "$or": [{"owner": owner}, {"$expr": {"$lte": ["$expires", "$$NOW"]}}]},
+        [{"$set": {"owner": owner, "expires": {"$add": ["$$NOW", int(ttl * 1000)]}}}],
+        upsert=True
+      )
+    except DuplicateKeyError:
+      # Someone else holds it, so the filter didn't match and the insert clashed
+      return False
+    return True
+
+  async def release_lease(self, key: str, owner: str) -> None:
+    await self.locks.delete_one({"_id": key, "owner": owner})
+
+  async def heartbeat(self, member: Member, ttl: float) -> None:
+    await self.cluster.update_one(
+      {"_id": member.process_id},
+      [{"$set": {
+        "shard_count": member.shard_count,
+        "shard_ids": member.shard_ids,
+        "started": {"$ifNull": ["$started", "$$NOW"]},
+        "expires": {"$add": ["$$NOW", int(ttl * 1000)]}
+      }}],
+      upsert=True
+    )
+
+  async def leave(self, process_id: str) -> None:
+    await self.cluster.delete_one({"_id": process_id})
+
+  async def members(self) -> list[Member]:
+    cursor = self.cluster.find({"$expr": {"$gt": ["$expires", "$$NOW"]}})
+    return [
+      # BSON dates come back naive, but they are UTC
+      Member(d["_id"], d["shard_count"], d["shard_ids"], d["started"].replace(tzinfo=timezone.utc).timestamp())
+      async for d in cursor
+    ]
+
+
+class LocalClusterStore:
+  """A `ClusterStore` in memory, shared by every bot in the process that is given it"""
+
+  def __init__(self):
+    self.leases: dict[str, tuple[str, float]] = {} # Key -> (owner, expires)
+    self.registered: dict[str, tuple[Member, float]] = {} # Process ID -> (member, expires)
+
+  async def setup(self) -> None:
+    pass
+
+  async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+    now = time.monotonic()
+    lease = self.leases.get(key)
+    if lease is not None and lease[0] != owner and lease[1] > now:
+      return False
+    self.leases[key] = (owner, now + ttl)
+    return True
+
+  async def release_lease(self, key: str, owner: str) -> None:
+    lease = self.leases.get(key)
+    if lease is not None and lease[0] == owner:
+      del self.leases[key]
+
+  async def heartbeat(self, member: Member, ttl: float) -> None:
+    old = self.registered.get(member.process_id)
+    member.started = old[0].started if old is not None else time.time()
+    self.registered[member.process_id] = (member, time.monotonic() + ttl)
+
+  async def leave(self, process_id: str) -> None:
+    self.registered.pop(process_id, None)
+
+  async def members(self) -> list[Member]:
+    now = time.monotonic()
+    return [member for member, expires in self.registered.values() if expires > now]
+
+
+class Cluster:
+  def __init__(
+      self,
+      store: ClusterStore,
+      shard_count: int,
+      shard_ids: list[int] | None,
+      process_id: str,
+      lease_ttl: float = 10.0
+  ):
+    self.store = store
+    self.member = Member(process_id, shard_count, shard_ids)
+    self.lease_ttl = lease_ttl
+    self.members: list[Member] = []
+    self._owners: dict[int, str] = {} # Shard ID -> process that farms it
+    self._loaded = False
+    self._task: asyncio.Task | None = None
+    # Called with the shards this process took over from another one, whose
+    # cached state may be out of date
+    self.on_gained: Callable[[list[int]], Awaitable[None]] | None = None
+
+  @property
+  def process_id(self) -> str:
+    return self.member.process_id
+
+  def owner_of(self, guild_id: int) -> str | None:
+    """The process that farms `guild_id`, `None` if no live process runs its shard"""
+    return self._owners.get(shard_for(guild_id, self.member.shard_count))
+
+  def owns(self, guild_id: int) -> bool:
+    """Whether this process should farm `guild_id`
+
+    Until the map has been loaded, Discord sending us the guild's events is
+    taken as ownership.
+    """
+    owner = self.owner_of(guild_id)
+    return owner is None or owner == self.member.process_id
+
+  def _rebuild(self, members: list[Member]) -> list[int]:
+    """Rebuilds the ownership map, returns the shards this process took over"""
+    owners: dict[int, str] = {}
+    # The longest running process keeps its shards, so a new one can't take
+    # them over before the old one has stopped farming them
+    for member in sorted(members, key=lambda m: (m.started, m.process_id)):
+      if member.shard_count != self.member.shard_count:
+        _log.warning(
+          f"Cluster member `{member.process_id}` runs {member.shard_count} shards "
+          f"instead of {self.member.shard_count}, ignoring it"
+        )
+        continue
+      for shard_id in member.shard_ids if member.shard_ids is not None else range(member.shard_count):
+        owners.setdefault(shard_id, member.process_id)
+    me = self.member.process_id
+    gained = []
+    if owners != self._owners:
+      mine = sorted(shard_id for shard_id, owner in owners.items() if owner == me)
+      _log.info(f"Cluster has {len(members)} members, this process farms shards {mine}")
+      if self._loaded:
+        gained = [shard_id for shard_id in mine if self._owners.get(shard_id) != me]
+    self.members = members
+    self._owners = owners
+    self._loaded = True
+    return gained
+
+  async def refresh(self):
+    await self.store.heartbeat(self.member, self.lease_ttl * 3)
+    gained = self._rebuild(await self.store.members())
+    if gained and self.on_gained is not None:
+      _log.info(f"Took over shards {gained} from other processes")
+      await self.on_gained(gained)
+
+  async def _heartbeat(self):
+    while True:
+      await asyncio.sleep(self.lease_ttl)
+      try:
+        await self.refresh()
+      except PyMongoError as e:
+        # The map just goes stale, the leases and versions keep farming safe
+        _log.warning(f"Cluster heartbeat failed: {e}")
+
+  async def start(self):
+    await self.store.setup()
+    await self.refresh()
+    if self._task is None:
+      self._task = asyncio.create_task(self._heartbeat(), name="shroom-cluster")
+
+  async def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+    try:
+      await self.store.leave(self.member.process_id)
+    except PyMongoError as e:
+      _log.warning(f"Could not leave the cluster: {e}")
+
+  async def acquire_farm(self, farm_id: int, timeout: float = 5.0) -> bool:
+    """|coro|
+
+    Takes the lease on a farm, waiting up to `timeout` seconds for another
+    process to release it. Returns whether it was taken.
+    """
+    key = f"farm:{farm_id}"
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    with METRICS.span("cluster.lease_wait"):
+      while not await self.store.acquire_lease(key, self.member.process_id, self.lease_ttl):
+        if time.monotonic() + delay > deadline:
+          METRICS.inc("cluster.lease_timeouts")
+          return False
+        METRICS.inc("cluster.lease_contended")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return True
+
+  async def release_farm(self, farm_id: int):
+    await self.store.release_lease(f"farm:{farm_id}", self.member.process_id)
+
+  def summary(self) -> str:
+    lines = [f"{'process':<32}{'shards':>10}  started"]
+    for member in self.members:
+      shards = sorted(shard_id for shard_id, owner in self._owners.items() if owner == member.process_id)
+      marker = " (this process)" if member.process_id == self.member.process_id else ""
+      started = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(member.started))
+      lines.append(f"{member.process_id:<32}{len(shards):>10}  {started}{marker}")
+    return "\n".join(lines)
+
+
+def create_cluster(config: Config, backend: StorageBackend, shard_ids: list[int] | None) -> Cluster:
+  """A `Cluster` kept in the Mongo database"""
+  if not config.sharded or config.shard_count is None:
+    raise ValueError("clustering needs SHARDED=TRUE and a fixed SHARD_COUNT shared by every process")
+  if not isinstance(backend, MongoBackend):
+    # The other backends only keep writes in order within one process
+    raise ValueError(f"clustering needs the mongo backend, not `{config.storage_backend}`")
+  if not config.process_id:
+    # It also names the process's `Stats` document, a new one every restart would start today's counts from zero
+    raise ValueError("clustering needs a PROCESS_ID that is unique to the process and stays the same across restarts")
+  return Cluster(MongoClusterStore(backend.shroom_db), config.shard_count, shard_ids, str(config.process_id), config.lease_ttl)
@@ -56,17 +56,21 @@ class CommandManager(commands.Cog):
 
   @commands.command()
   @commands.is_owner()
-  async def sync(self, ctx: commands.Context, option: Optional[Literal["to_server", "clear_server"]] = None):
+  async def sync(self, ctx: commands.Context, option: Optional[Literal["to_server", "clear_server", "force"]] = None):
+    syncer = self.bot.syncer
     if option == "to_server":
       self.bot.tree.copy_global_to(guild=self.bot.dev_server)
-      synced = await self.bot.tree.sync(guild=self.bot.dev_server)
+      result = await syncer.sync(guild=self.bot.dev_server)
     elif option == "clear_server":
       self.bot.tree.clear_commands(guild=self.bot.dev_server)
-      await self.bot.tree.sync(guild=self.bot.dev_server)
-      synced = []
+      result = await syncer.sync(guild=self.bot.dev_server)
     else:
-      synced = await self.bot.tree.sync()
-    await ctx.reply(f"Synced {len(synced)} commands {'globally' if option is None else 'to development server'}")
+      result = await syncer.sync(force=option == "force")
+    where = "to development server" if option in ("to_server", "clear_server") else "globally"
+    if result.skipped:
+      await ctx.reply(f"Commands {where} are already up to date, use `sync force` to sync anyway")
+    else:
+      await ctx.reply(f"Synced {result.synced} commands {where}")
 
 
 async def setup(bot: ShroomBot):
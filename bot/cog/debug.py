@@ -3,14 +3,20 @@ from __future__ import annotations
 import contextlib
 import os
 import re
-from io import StringIO
+from io import BytesIO, StringIO
 import traceback
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Literal, Optional
 
 import discord
 from discord.ext import commands
 
 from bot.embeds import FARM_ALREADY_EXISTS, FARM_CREATE_SUCCESS
+from bot import loadtest
+from bot.metrics import METRICS
+from bot.profiler import MAX_DURATION, profile_loop
+from bot.shroom.storage import MongoBackend
+from bot.shroom.storage.mongo import EXPLAINABLE, summarise_plan
+from bot.shroom.storage.monitoring import COMMANDS, POOL
 
 if TYPE_CHECKING:
   from bot import ShroomBot
@@ -18,6 +24,7 @@ if TYPE_CHECKING:
 class Debug(commands.Cog):
   def __init__(self, bot: ShroomBot):
     self.bot = bot
+    self._load_testing = False
   
   @commands.command(aliases=["eval"])
   @commands.is_owner() # We leave this here just in case
@@ -167,6 +174,151 @@ class Debug(commands.Cog):
     await self.bot.farm(farm, ctx.message, user_id, amount, True)
 
 
+  @commands.command()
+  async def perf(self, ctx: commands.Context, option: Optional[Literal["reset"]] = None):
+    if option == "reset":
+      METRICS.reset()
+      self.bot.shard_rates.reset()
+      return await ctx.reply("Performance metrics have been reset")
+    summary = METRICS.summary()
+    if len(summary) > 1900:
+      await ctx.reply(file=discord.File(BytesIO(summary.encode()), filename="perf.txt"))
+    else:
+      await ctx.reply(f"```\n{summary}```")
+
+
+  @commands.command()
+  async def queries(self, ctx: commands.Context, option: Optional[Literal["reset"]] = None):
+    if option == "reset":
+      COMMANDS.reset()
+      return await ctx.reply("Query stats have been reset")
+    summary = COMMANDS.summary()
+    if len(summary) > 1900:
+      await ctx.reply(file=discord.File(BytesIO(summary.encode()), filename="queries.txt"))
+    else:
+      await ctx.reply(f"```\n{summary}```")
+
+
+  @commands.command()
+  async def pool(self, ctx: commands.Context, option: Optional[Literal["reset"]] = None):
+    if not isinstance(self.bot.shroom_farm.backend, MongoBackend):
+      return await ctx.reply("Connection pool stats are only available on the Mongo backend")
+    if option == "reset":
+      POOL.reset()
+      return await ctx.reply("Connection pool stats have been reset")
+    await ctx.reply(f"```\n{POOL.summary()}```")
+
+
+  @commands.command()
+  async def loaders(self, ctx: commands.Context, option: Optional[Literal["reset"]] = None):
+    shroom_farm = self.bot.shroom_farm
+    stats = (shroom_farm.farm_loader.stats, shroom_farm.user_loader.stats)
+    if option == "reset":
+      for s in stats:
+        s.reset()
+      return await ctx.reply("Loader stats have been reset")
+    await ctx.reply("```\n" + "\n".join(s.summary() for s in stats) + "```")
+
+
+  @commands.command()
+  async def quotes(self, ctx: commands.Context):
+    if self.bot.quotes is None:
+      return await ctx.reply("The quote buffer has not started yet")
+    await ctx.reply(self.bot.quotes.summary())
+
+
+  @commands.command()
+  async def shards(self, ctx: commands.Context):
+    shroom_farm = self.bot.shroom_farm
+    summary = self.bot.shard_rates.summary(self.bot.shard_latencies)
+    summary += (
+      f"\n\n{shroom_farm.cached_farm_count} farms cached in "
+      f"{len(shroom_farm._partitions)}/{shroom_farm.shard_count} partitions"
+    )
+    await ctx.reply(f"```\n{summary}```")
+
+
+  @commands.command()
+  async def hot(self, ctx: commands.Context, n: int = 10, window: Literal["1s", "1m", "15m"] = "1m"):
+    bot = self.bot
+    top = bot.farm_rates.top(min(max(n, 1), 50), window)
+    if not top:
+      return await ctx.reply("Nothing has been farmed recently")
+    lines = [f"{'farm':<21}{'1s':>8}{'1m':>8}{'15m':>8}{'channel 1m':>12}"]
+    for farm_id, rates in top:
+      farm = bot.shroom_farm.cached_farm(farm_id)
+      channel = bot.channel_rates.rates(farm.farm_channel).minute if farm is not None and farm.farm_channel else 0.0
+      lines.append(f"{farm_id:<21}{rates.second:>8.2f}{rates.minute:>8.2f}{rates.quarter:>8.2f}{channel:>12.2f}")
+    lines.append(
+      f"\n🍄/s per farm by {window}, messages/s in the farm channel. "
+      f"{len(bot.farm_rates)} farms and {len(bot.channel_rates)} channels tracked"
+    )
+    await ctx.reply("```\n" + "\n".join(lines) + "```")
+
+
+  @commands.command()
+  async def cluster(self, ctx: commands.Context):
+    cluster = self.bot.cluster
+    if cluster is None:
+      return await ctx.reply("Not running in a cluster")
+    await cluster.refresh()
+    await ctx.reply(f"```\n{cluster.summary()}```")
+
+
+  @commands.command()
+  async def explain(self, ctx: commands.Context, method: str):
+    backend = self.bot.shroom_farm.backend
+    if not isinstance(backend, MongoBackend):
+      return await ctx.reply("Explaining queries is only supported on the Mongo backend")
+    if method not in EXPLAINABLE:
+      return await ctx.reply(f"Unknown method, try one of: {', '.join(f'`{m}`' for m in EXPLAINABLE)}")
+    result = await backend.explain(method)
+    await ctx.reply(f"```\n{summarise_plan(result)}```")
+
+
+  @commands.command()
+  async def profile(self, ctx: commands.Context, seconds: float = 10.0, interval_ms: float = 5.0):
+    if not 0 < seconds <= MAX_DURATION:
+      return await ctx.reply(f"Profiles can last between 0 and {MAX_DURATION:g} seconds")
+    await ctx.reply(f"Profiling the event loop for {seconds:g} seconds...")
+    try:
+      result = await profile_loop(seconds, interval_ms / 1000)
+    except RuntimeError as e:
+      return await ctx.reply(str(e))
+    await ctx.reply(
+      f"Profiled {result.samples} samples",
+      files=[
+        discord.File(BytesIO(result.collapsed().encode()), filename="profile.collapsed"),
+        discord.File(BytesIO(result.report().encode()), filename="top.txt")
+      ]
+    )
+
+
+  @commands.command()
+  async def loadtest(
+      self,
+      ctx: commands.Context,
+      guilds: int = 10,
+      users: int = 50,
+      rate: float = 0.0,
+      seconds: float = 10.0
+  ):
+    """Farms in a sandbox database at `rate` events per second (0 for as fast as possible)"""
+    if self._load_testing:
+      return await ctx.reply("A load test is already running")
+    if not 0 < seconds <= loadtest.MAX_DURATION:
+      return await ctx.reply(f"Load tests can last between 0 and {loadtest.MAX_DURATION:g} seconds")
+    if not 0 < guilds <= loadtest.MAX_GUILDS or users < 2 or rate < 0:
+      return await ctx.reply(f"Load tests need 1 to {loadtest.MAX_GUILDS} guilds, at least 2 users and a rate of 0 or more")
+    self._load_testing = True
+    try:
+      await ctx.reply(f"Load testing {guilds} guilds x {users} users for {seconds:g} seconds...")
+      result = await loadtest.run_load_test(self.bot.config, guilds, users, rate or None, seconds)
+    finally:
+      self._load_testing = False
+    await ctx.reply(f"```\n{result.summary()}```")
+
+
   @commands.command()
   async def toggle_maintenance_mode(self, ctx: commands.Context):
     m = self.bot.maintenance_mode = not self.bot.maintenance_mode
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import datetime
+import zoneinfo
 
 from discord import app_commands
 from discord.ext import commands
@@ -14,8 +15,11 @@ from bot.embeds import (
   CHANNEL_CHANGE_SUCCESS,
   FARM_ALREADY_EXISTS,
   FARM_CREATE_SUCCESS,
+  FARM_NOT_SAVED,
   FARM_NOT_SET_UP,
-  SET_DAILY_GOAL_SUCCESS
+  SET_DAILY_GOAL_SUCCESS,
+  SET_TIMEZONE_SUCCESS,
+  ERROR_MESSAGE
 )
 
 if TYPE_CHECKING:
@@ -26,6 +30,7 @@ if TYPE_CHECKING:
 class Farm(commands.GroupCog, group_name="farm"):
   def __init__(self, bot: ShroomBot):
     self.bot = bot
+    self.timezones = sorted(zoneinfo.available_timezones())
     self.ctx_menu = app_commands.ContextMenu(
       name="User Stats", callback=self.user_stats_ctx_menu
     )
@@ -65,11 +70,11 @@ class Farm(commands.GroupCog, group_name="farm"):
   ):
     """Change the the farm channel for your server"""
     try:
-      await self.bot.shroom_farm.set_farm_channel(interaction.guild_id, channel.id) # type: ignore
+      saved = await self.bot.shroom_farm.set_farm_channel(interaction.guild_id, channel.id) # type: ignore
     except ValueError:
       embed = CHANGE_FARM_CHANNEL_NOT_SET_UP
     else:
-      embed = CHANNEL_CHANGE_SUCCESS(channel.id)
+      embed = CHANNEL_CHANGE_SUCCESS(channel.id) if saved else FARM_NOT_SAVED
     await interaction.response.send_message(embed=embed)
 
 
@@ -84,14 +89,44 @@ class Farm(commands.GroupCog, group_name="farm"):
   ):
     """Set the daily goal for server members to work towards"""
     try:
-      await self.bot.shroom_farm.set_daily_goal(interaction.guild_id, goal) # type: ignore
+      saved = await self.bot.shroom_farm.set_daily_goal(interaction.guild_id, goal) # type: ignore
     except ValueError:
       embed = FARM_NOT_SET_UP
     else:
-      embed = SET_DAILY_GOAL_SUCCESS(goal)
+      embed = SET_DAILY_GOAL_SUCCESS(goal) if saved else FARM_NOT_SAVED
     await interaction.response.send_message(embed=embed)
 
 
+  @app_commands.command(name="settimezone")
+  @app_commands.describe(timezone="The timezone your farm's day starts at midnight in, like Europe/London")
+  @under_maintenance()
+  @app_commands.checks.has_permissions(administrator=True)
+  async def set_timezone(
+    self,
+    interaction: discord.Interaction,
+    timezone: str
+  ):
+    """Set the timezone your server's farming day follows"""
+    if timezone not in self.timezones:
+      embed = ERROR_MESSAGE(f"`{timezone}` is not a timezone, pick one of the suggestions")
+    else:
+      try:
+        saved = await self.bot.shroom_farm.set_farm_timezone(interaction.guild_id, timezone) # type: ignore
+      except ValueError:
+        embed = FARM_NOT_SET_UP
+      else:
+        embed = SET_TIMEZONE_SUCCESS(timezone) if saved else FARM_NOT_SAVED
+    await interaction.response.send_message(embed=embed)
+
+  @set_timezone.autocomplete("timezone")
+  async def timezone_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    current = current.lower()
+    return [
+      app_commands.Choice(name=tz, value=tz)
+      for tz in self.timezones if current in tz.lower()
+    ][:25]
+
+
   @app_commands.command(name="farmstats")
   async def farm_stats(
     self,
@@ -1,4 +1,6 @@
 from __future__ import annotations
+import asyncio
+
 import aiohttp
 
 from discord import app_commands
@@ -25,22 +27,27 @@ class Misc(commands.Cog):
   @app_commands.command(name="jerome")
   async def jerome(self, interaction: discord.Interaction):
     """Get a random quote that Jerome definitely made"""
-    async with aiohttp.ClientSession() as session:
-      async with session.get("https://api.quotable.io/random") as r:
-        if r.status == 200:
-          quote = (await r.json())["content"] # type: ignore
-          embed = discord.Embed(
-            title="Jerome's Quote:",
-            description=quote,
-            colour=discord.Colour.random()
-          )
-          embed.set_author(name='Jerome', icon_url=self.bot.user.display_avatar.url) # type: ignore
-        else:
-          embed = discord.Embed(
-            title="Error",
-            description="An internal error has occurred, please try again later",
-            colour=discord.Colour.red()
-          )
+    quotes = self.bot.quotes
+    quote = quotes.get() if quotes is not None else None
+    if quote is None and quotes is not None:
+      # The buffer ran dry, try the API directly while leaving time to respond
+      try:
+        quote = await quotes.fetch(timeout=2)
+      except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+        pass
+    if quote is not None:
+      embed = discord.Embed(
+        title="Jerome's Quote:",
+        description=quote,
+        colour=discord.Colour.random()
+      )
+      embed.set_author(name='Jerome', icon_url=self.bot.user.display_avatar.url) # type: ignore
+    else:
+      embed = discord.Embed(
+        title="Error",
+        description="An internal error has occurred, please try again later",
+        colour=discord.Colour.red()
+      )
     await interaction.response.send_message(embed=embed)
 
   @app_commands.command(name="whyjerome")
@@ -9,7 +9,43 @@ class Config:
   dev_server_id: int
   prefix: str = "$"
   maintenance_mode: bool = False
+  lean: bool = False # Only request the intents farming needs and skip the member and message caches
+  sharded: bool = False # Run as an `AutoShardedBot`
+  shard_count: int | None = None # Total shards across every process, `None` uses Discord's recommendation
+  shard_ids: str | None = None # Shards this process runs, like "0-3,8", `None` runs all of them
+  cluster: bool = False # Share the database with other processes running other shards
+  process_id: str | None = None # How this process is known to the cluster, required with `cluster` and kept across restarts
+  lease_ttl: int = 10 # Seconds a farm lease and a cluster heartbeat last
   mongo_url: str = "localhost"
+  mongo_database: str = "ShroomDB"
+  mongo_max_pool_size: int = 100 # Connections per server, commands queue for one once they are all checked out
+  mongo_min_pool_size: int = 0 # Connections kept open even when idle
+  mongo_max_idle_ms: int | None = None # Close connections idle for longer than this, `None` never does
+  mongo_wait_queue_timeout_ms: int | None = None # Fail commands that wait longer for a connection, `None` waits forever
+  mongo_compressors: str | None = None # Wire compression, like "zstd,zlib", zstd and snappy need extra packages
+  mongo_server_selection_timeout_ms: int = 30000
+  mongo_connect_timeout_ms: int = 20000
+  mongo_socket_timeout_ms: int | None = None # `None` waits forever for a reply
+  mongo_write_concern: int | str | None = None # `w` for every write, like 1 or "majority", `None` uses the server's default
+  storage_backend: str = "mongo" # One of "mongo", "memory" or "sqlite"
+  sqlite_path: str = "shroom.db"
+  snapshot_path: str | None = "shroom.snapshot" # State is saved here on shutdown for a fast restart
+  snapshot_max_age: int = 900 # Seconds before a snapshot is too old to trust
+  rollover_journal: str | None = "rollover.journal" # Days that ended are kept here until they are saved
+  slow_query_ms: int = 100 # Mongo commands slower than this get logged
+  quote_api_url: str = "https://api.quotable.io/random"
+  quote_buffer_size: int = 20
+  traffic_log: str | None = None # Path of a gzipped event log to record incoming traffic to, a new one per run
+  auto_sync: bool = False # Sync app commands on startup when they changed since the last sync
+  command_sync_state: str | None = "command_sync.json" # Where the hashes of the last synced commands are kept
+  metrics_port: int | None = None # Serve OpenMetrics on 127.0.0.1 at this port
+  loop_lag_threshold_ms: int = 100 # Event loop stalls longer than this get logged with the blocking stack, 0 disables
+  uvloop: bool = False # Run on uvloop instead of the default asyncio loop
+  rate_tracker_keys: int = 10000 # Farms and channels each that sliding-window rates are kept for, the least recently active are dropped past that
+  gateway_fast_path: bool = True # Drop messages that would be ignored before discord.py builds a `Message` for them
+  log_level: str = "INFO"
+  log_json: bool = True # One JSON object per line instead of discord.py's text format
+  log_rate_limit: int = 50 # Records per second per logger and level before sampling kicks in
 
 
 def get_config_from_env() -> Config:
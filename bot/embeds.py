@@ -36,6 +36,12 @@ DAILY_GOAL_REACHED = discord.Embed(
   colour=discord.Colour.green()
 )
 
+FARM_NOT_SAVED = discord.Embed(
+  title="Farm not saved!",
+  description="Your farm kept being changed while saving it, please try again",
+  colour=discord.Colour.red()
+)
+
 UNDER_MAINTENANCE = discord.Embed(
   title="Bot is under maintenance",
   description="Bot is currently under maintenance, please try again later",
@@ -66,6 +72,16 @@ def SET_DAILY_GOAL_SUCCESS(goal: int) -> discord.Embed:
     colour=discord.Colour.green()
   )
 
+def SET_TIMEZONE_SUCCESS(timezone: str) -> discord.Embed:
+  return discord.Embed(
+    title="Success!",
+    description=(
+      f"The timezone has been successfully changed to `{timezone}`\n"
+      "Your farm's day will start at midnight there from tomorrow on!"
+    ),
+    colour=discord.Colour.green()
+  )
+
 def ERROR_MESSAGE(msg: str) -> discord.Embed:
   return discord.Embed(
       title="Error!",
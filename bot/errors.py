@@ -6,4 +6,8 @@ from discord.app_commands import AppCommandError
 
 class UnderMaintenance(AppCommandError):
   """Raised when the check for bot being under maintenance fails"""
-  pass
\ No newline at end of file
+  pass
+
+class DuplicateDocument(Exception):
+  """Raised by storage backends when inserting a document whose ID already exists"""
+  pass
@@ -0,0 +1,275 @@
+"""
+Load testing a running deployment against a sandbox database
+
+`run_load_test` builds a second `ShroomBot` that never logs in, on a fresh
+database next to the real one (a new Mongo database on the same server, a
+temporary SQLite file, or memory), and feeds stub 🍄 messages through its
+`on_message`. Everything from the farm lookup to the reply runs for real,
+only the calls to Discord land on stubs. It runs on the live bot's event
+loop and hardware, so the numbers include whatever else the bot is doing,
+which is the point. The sandbox is dropped afterwards.
+
+The sandbox keeps its own metrics: its Mongo client is not monitored by
+`$queries` and `$pool`, and what it records into `METRICS`, shard counters
+included, goes to a registry of its own.
+
+With `rate` set, events are started on a fixed schedule and their latency
+is counted from when they were due, so time spent queueing behind a slow
+database counts too. Without it, every guild farms back to back.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import TYPE_CHECKING, Any
+
+import discord
+from pymongo import monitoring
+
+from bot.bot import ShroomBot
+from bot.metrics import Histogram, Registry, reset_registry, use_registry
+from bot.shroom.storage import MemoryBackend, MongoBackend, SQLiteBackend, mongo_options
+
+if TYPE_CHECKING:
+  from bot.config import Config
+  from bot.shroom.storage import StorageBackend
+
+_log = logging.getLogger(__name__)
+
+MAX_DURATION = 300.0 # seconds
+MAX_GUILDS = 10_000
+
+
+class RoundTripCounter(monitoring.CommandListener):
+  """Counts the commands sent by the sandbox's Mongo client"""
+
+  def __init__(self):
+    self.count = 0
+    self._lock = threading.Lock()
+
+  def started(self, event: monitoring.CommandStartedEvent):
+    with self._lock:
+      self.count += 1
+
+  def succeeded(self, event: monitoring.CommandSucceededEvent):
+    pass
+
+  def failed(self, event: monitoring.CommandFailedEvent):
+    pass
+
+
+# Just enough of the discord.py models for `ShroomBot.on_message`, nothing is sent anywhere
+
+@dataclass
+class StubUser:
+  id: int
+  name: str = "loadtest"
+  bot: bool = False
+
+  @property
+  def mention(self) -> str:
+    return f"<@{self.id}>"
+
+
+@dataclass
+class StubGuild:
+  id: int
+  shard_id: int = 0
+
+
+@dataclass
+class StubChannel:
+  id: int
+
+  async def send(self, *args: Any, **kwargs: Any):
+    pass
+
+
+@dataclass
+class StubMessage:
+  author: StubUser
+  guild: StubGuild
+  channel: StubChannel
+  content: str = "🍄"
+  reactions: list[str] = field(default_factory=list)
+
+  async def add_reaction(self, emoji: str):
+    self.reactions.append(emoji)
+
+  async def reply(self, *args: Any, **kwargs: Any):
+    pass
+
+
+@dataclass
+class LoadTestResult:
+  backend: str
+  guilds: int
+  users: int
+  rate: float | None # Events per second asked for, `None` for as fast as possible
+  events: int = 0
+  farmed: int = 0
+  rejected: int = 0 # Same user twice in a row, which only happens when events overtake each other
+  failed: int = 0
+  elapsed: float = 0.0
+  latency: Histogram = field(default_factory=lambda: Histogram("loadtest"))
+  round_trips: int | None = None # Only counted on the Mongo backend
+
+  @property
+  def throughput(self) -> float:
+    return self.events / self.elapsed if self.elapsed else 0.0
+
+  def summary(self) -> str:
+    rate = f"{self.rate:g}/s" if self.rate else "max"
+    lat = self.latency
+    lines = [
+      f"{self.guilds} guilds x {self.users} users at {rate} rate on {self.backend}",
+      f"{self.events} events in {self.elapsed:.1f}s: {self.throughput:,.1f} events/s",
+      f"{self.farmed} farmed, {self.rejected} rejected, {self.failed} failed",
+      f"Latency p50 {lat.percentile(50) * 1000:.2f}ms, p90 {lat.percentile(90) * 1000:.2f}ms, "
+      f"p99 {lat.percentile(99) * 1000:.2f}ms, max {lat.max * 1000:.2f}ms"
+    ]
+    if self.round_trips is not None:
+      per_event = self.round_trips / self.events if self.events else 0.0
+      lines.append(f"{self.round_trips} database round trips, {per_event:.2f} per event")
+    return "\n".join(lines)
+
+
+def sandbox_config(config: Config) -> Config:
+  """`config` with everything that would touch the real bot's state or Discord turned off"""
+  return dataclasses.replace(
+    config,
+    maintenance_mode=False,
+    sharded=False,
+    cluster=False,
+    snapshot_path=None,
+    rollover_journal=None,
+    traffic_log=None,
+    auto_sync=False,
+    command_sync_state=None,
+    metrics_port=None,
+    loop_lag_threshold_ms=0
+  )
+
+
+class Sandbox:
+  """A throwaway backend of the same kind as the one in `config`"""
+
+  def __init__(self, config: Config):
+    self.kind = config.storage_backend.lower()
+    self.counter: RoundTripCounter | None = None
+    self._directory: str | None = None
+    if self.kind == "mongo":
+      self.name = f"{config.mongo_database}_loadtest_{int(time.time())}"
+      self.counter = RoundTripCounter()
+      # Kept out of the live client's command and pool monitors, which are
+      # keyed by server address and would mix the two clients up
+      self.backend: StorageBackend = MongoBackend(
+        config.mongo_url, self.name, monitor=False, event_listeners=[self.counter], **mongo_options(config)
+      )
+    elif self.kind == "sqlite":
+      self._directory = tempfile.mkdtemp(prefix="shroom-loadtest-")
+      self.name = os.path.join(self._directory, "loadtest.db")
+      self.backend = SQLiteBackend(self.name)
+    else:
+      self.name = "memory"
+      self.backend = MemoryBackend()
+
+  async def drop(self):
+    try:
+      if isinstance(self.backend, MongoBackend):
+        await self.backend.drop()
+    finally:
+      await self.backend.close()
+      if self._directory is not None:
+        shutil.rmtree(self._directory, ignore_errors=True)
+    _log.info(f"Dropped load test sandbox `{self.name}`")
+
+
+async def run_load_test(
+    config: Config,
+    guilds: int = 10,
+    users: int = 50,
+    rate: float | None = None,
+    duration: float = 10.0
+) -> LoadTestResult:
+  """|coro|
+
+  Farms in `guilds` sandbox farms, each with `users` farmers taking turns,
+  for `duration` seconds at `rate` events per second over all guilds, or
+  as fast as possible without a rate
+  """
+
+  sandbox = Sandbox(config)
+  result = LoadTestResult(f"{sandbox.kind} `{sandbox.name}`", guilds, users, rate or None)
+  _log.info(f"Starting a load test on sandbox `{sandbox.name}`")
+  setup_trips = 0
+  # The sandbox bot's stage timings and shard counters stay out of `$perf` and `$shards`
+  metrics = use_registry(Registry())
+  try:
+    bot = ShroomBot(sandbox_config(config), backend=sandbox.backend, intents=discord.Intents.none())
+    await bot.shroom_farm.setup()
+    for guild_id in range(1, guilds + 1):
+      await bot.shroom_farm.create_farm(guild_id, channel=guild_id)
+    bot.caches_warm.set()
+    if sandbox.counter is not None:
+      setup_trips = sandbox.counter.count
+
+    counts = [0] * (guilds + 1) # Events sent per guild, so users take turns
+
+    async def send(guild_id: int, due: float):
+      n = counts[guild_id]
+      counts[guild_id] += 1
+      author = StubUser(guild_id * 100_000 + n % users)
+      message = StubMessage(author, StubGuild(guild_id), StubChannel(guild_id))
+      try:
+        await bot.on_message(message) # type: ignore
+      except Exception:
+        result.failed += 1
+        _log.exception("Load test event failed")
+      else:
+        if "❌" in message.reactions:
+          result.rejected += 1
+        elif "🍄" in message.reactions:
+          result.farmed += 1
+      result.latency.observe(perf_counter() - due)
+      result.events += 1
+
+    start = perf_counter()
+    deadline = start + duration
+    if rate:
+      # Open loop, events start on schedule however long the earlier ones take
+      interval = 1 / rate
+      in_flight: set[asyncio.Task] = set()
+      due = start
+      i = 0
+      while due < deadline:
+        delay = due - perf_counter()
+        if delay > 0:
+          await asyncio.sleep(delay)
+        task = asyncio.create_task(send(i % guilds + 1, due))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        i += 1
+        due = start + i * interval
+      await asyncio.gather(*in_flight)
+    else:
+      async def guild_worker(guild_id: int):
+        while perf_counter() < deadline:
+          await send(guild_id, perf_counter())
+      await asyncio.gather(*(guild_worker(g) for g in range(1, guilds + 1)))
+    result.elapsed = perf_counter() - start
+    if sandbox.counter is not None:
+      result.round_trips = sandbox.counter.count - setup_trips
+  finally:
+    reset_registry(metrics)
+    await sandbox.drop()
+  return result
@@ -0,0 +1,128 @@
+"""
+Logging that stays off the event loop
+
+Records are put on a queue by `LoopQueueHandler` and formatted and written by
+a `QueueListener` thread, so a slow terminal or disk never blocks the loop.
+Each record carries the trace id of the event it was logged for, and
+`SamplingFilter` bounds how many records get through during floods.
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+from bot.tracing import trace_id
+
+# Same as the one discord.py sets up with `root_logger=True`
+TEXT_FORMAT = "[{asctime}] [{levelname:<8}] {name}: {message}"
+
+
+class JSONFormatter(logging.Formatter):
+  def format(self, record: logging.LogRecord) -> str:
+    doc = {
+      "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+      "level": record.levelname,
+      "logger": record.name,
+      "msg": record.getMessage()
+    }
+    trace = getattr(record, "trace_id", None)
+    if trace is not None:
+      doc["trace"] = trace
+    dropped = getattr(record, "dropped", None)
+    if dropped:
+      doc["dropped"] = dropped
+    if record.exc_info:
+      doc["exc"] = self.formatException(record.exc_info)
+    if record.stack_info:
+      doc["stack"] = self.formatStack(record.stack_info)
+    return json.dumps(doc, default=str)
+
+
+class TraceFilter(logging.Filter):
+  """Tags records with the current trace id, unless one was passed in `extra`"""
+
+  def filter(self, record: logging.LogRecord) -> bool:
+    if getattr(record, "trace_id", None) is None:
+      record.trace_id = trace_id.get()
+    return True
+
+
+class SamplingFilter(logging.Filter):
+  """Lets through at most `rate` records per second for each logger and level
+
+  Past that, only records of 1 in `trace_sample` traces get through, so the
+  ones that do are still complete. Errors always get through. How many records
+  were dropped is attached to the first record of the next second.
+  """
+
+  def __init__(self, rate: int = 50, trace_sample: int = 16):
+    super().__init__()
+    self.rate = rate
+    self.trace_sample = trace_sample
+    # (logger, level) -> [second, records let through, records dropped]
+    self._windows: dict[tuple[str, int], list[int]] = {}
+
+  def filter(self, record: logging.LogRecord) -> bool:
+    if record.levelno >= logging.ERROR:
+      return True
+    second = int(record.created)
+    key = (record.name, record.levelno)
+    window = self._windows.get(key)
+    if window is None or window[0] != second:
+      if window is not None and window[2]:
+        record.dropped = window[2]
+      self._windows[key] = window = [second, 0, 0]
+    if window[1] < self.rate:
+      window[1] += 1
+      return True
+    trace = getattr(record, "trace_id", None)
+    if trace is not None and int(trace, 16) % self.trace_sample == 0:
+      return True
+    window[2] += 1
+    return False
+
+
+class LoopQueueHandler(QueueHandler):
+  """A `QueueHandler` that leaves formatting to the listener thread
+
+  The stock `prepare` formats the whole record, tracebacks included, on the
+  calling thread. Only the message is merged here, since its arguments could
+  change before the listener gets to them.
+  """
+
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    record.msg = record.getMessage()
+    record.args = None
+    return record
+
+
+def setup_logging(level: int | str = logging.INFO, use_json: bool = True, rate: int = 50) -> QueueListener:
+  """Routes the root logger through a queue and returns the started listener
+
+  The listener should be stopped on shutdown so queued records get flushed.
+  """
+  handler = logging.StreamHandler(sys.stderr)
+  if use_json:
+    handler.setFormatter(JSONFormatter())
+  else:
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT, "%Y-%m-%d %H:%M:%S", style="{"))
+
+  queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+  queue_handler = LoopQueueHandler(queue)
+  queue_handler.addFilter(TraceFilter())
+  queue_handler.addFilter(SamplingFilter(rate))
+
+  root = logging.getLogger()
+  for old in root.handlers[:]:
+    root.removeHandler(old)
+  root.addHandler(queue_handler)
+  root.setLevel(level)
+
+  listener = QueueListener(queue, handler, respect_handler_level=True)
+  listener.start()
+  return listener
@@ -0,0 +1,178 @@
+"""
+Lightweight latency histograms and counters
+
+Histograms use fixed buckets, so memory stays the same no matter how many
+events are observed. Stage names are fixed in the code, so the number of
+histograms is bounded too.
+"""
+
+from __future__ import annotations
+
+import bisect
+import logging
+import math
+from contextvars import ContextVar, Token
+from time import perf_counter
+
+from aiohttp import web
+
+_log = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from 50us up to 10s
+BUCKETS = (
+  0.00005, 0.0001, 0.00025, 0.0005,
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+  0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf
+)
+
+
+class Histogram:
+  __slots__ = ("name", "counts", "sum", "count", "max")
+
+  def __init__(self, name: str):
+    self.name = name
+    self.counts = [0] * len(BUCKETS)
+    self.sum = 0.0
+    self.count = 0
+    self.max = 0.0
+
+  def observe(self, seconds: float):
+    self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+    self.sum += seconds
+    self.count += 1
+    if seconds > self.max:
+      self.max = seconds
+
+  def percentile(self, p: float) -> float:
+    """Estimates the `p`th percentile by interpolating inside its bucket"""
+    if not self.count:
+      return 0.0
+    rank = p / 100 * self.count
+    seen = 0
+    for i, n in enumerate(self.counts):
+      if n and seen + n >= rank:
+        lower = BUCKETS[i-1] if i else 0.0
+        upper = min(BUCKETS[i], self.max)
+        return lower + (upper - lower) * max(0.0, rank - seen) / n
+      seen += n
+    return self.max
+
+
+class Span:
+  """Times the enclosed block into a histogram, awaits inside the block included"""
+  __slots__ = ("histogram", "start", "elapsed")
+
+  def __init__(self, histogram: Histogram):
+    self.histogram = histogram
+
+  def __enter__(self) -> Span:
+    self.start = perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.elapsed = perf_counter() - self.start
+    self.histogram.observe(self.elapsed)
+
+
+class Registry:
+  """Stage histograms and counters
+
+  Recording goes to the registry set with `use_registry` for the current
+  task, if there is one, so a sandboxed bot can run next to the live one
+  without showing up in its metrics.
+  """
+
+  def __init__(self):
+    self.histograms: dict[str, Histogram] = {}
+    self.counters: dict[str, int] = {}
+
+  def histogram(self, name: str) -> Histogram:
+    scoped = _scoped.get()
+    if scoped is not None and scoped is not self:
+      return scoped.histogram(name)
+    try:
+      return self.histograms[name]
+    except KeyError:
+      self.histograms[name] = hist = Histogram(name)
+      return hist
+
+  def span(self, name: str) -> Span:
+    return Span(self.histogram(name))
+
+  def inc(self, name: str, amount: int = 1):
+    scoped = _scoped.get()
+    if scoped is not None and scoped is not self:
+      return scoped.inc(name, amount)
+    try:
+      self.counters[name] += amount
+    except KeyError:
+      self.counters[name] = amount
+
+  def reset(self):
+    self.histograms.clear()
+    self.counters.clear()
+
+  def summary(self, percentiles: tuple[float, ...] = (50, 90, 99)) -> str:
+    """A plain text table of every stage, latencies in milliseconds"""
+    header = f"{'stage':<30}{'count':>8}" + "".join(f"{f'p{p:g}':>9}" for p in percentiles) + f"{'max':>9}"
+    lines = [header]
+    for name, hist in sorted(self.histograms.items()):
+      lines.append(
+        f"{name:<30}{hist.count:>8}"
+        + "".join(f"{hist.percentile(p) * 1000:>9.2f}" for p in percentiles)
+        + f"{hist.max * 1000:>9.2f}"
+      )
+    if self.counters:
+      lines.append("")
+      lines.extend(f"{name:<30}{n:>8}" for name, n in sorted(self.counters.items()))
+    return "\n".join(lines)
+
+  def openmetrics(self) -> str:
+    lines = ["# TYPE shroom_stage_seconds histogram", "# UNIT shroom_stage_seconds seconds"]
+    for name, hist in sorted(self.histograms.items()):
+      cumulative = 0
+      for bound, n in zip(BUCKETS, hist.counts):
+        cumulative += n
+        le = "+Inf" if bound == math.inf else repr(bound)
+        lines.append(f'shroom_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+      lines.append(f'shroom_stage_seconds_count{{stage="{name}"}} {hist.count}')
+      lines.append(f'shroom_stage_seconds_sum{{stage="{name}"}} {hist.sum}')
+    lines.append("# TYPE shroom_events counter")
+    for name, n in sorted(self.counters.items()):
+      lines.append(f'shroom_events_total{{name="{name}"}} {n}')
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+_scoped: ContextVar[Registry | None] = ContextVar("metrics_registry", default=None)
+
+
+def use_registry(registry: Registry | None) -> Token:
+  """Records into `registry` instead of `METRICS` for the current task and the tasks it starts from now on
+
+  Every task runs in a copy of its parent's context, so this never leaks
+  into other events. Returns a token for `reset_registry`.
+  """
+  return _scoped.set(registry)
+
+
+def reset_registry(token: Token):
+  _scoped.reset(token)
+
+
+async def start_metrics_server(port: int, registry: Registry = METRICS) -> web.AppRunner:
+  """Serves `registry` in the OpenMetrics text format at http://127.0.0.1:`port`/metrics"""
+  async def metrics(request: web.Request):
+    return web.Response(
+      body=registry.openmetrics().encode(),
+      headers={"Content-Type": "application/openmetrics-text; version=1.0.0; charset=utf-8"}
+    )
+
+  app = web.Application()
+  app.router.add_get("/metrics", metrics)
+  runner = web.AppRunner(app, access_log=None)
+  await runner.setup()
+  await web.TCPSite(runner, "127.0.0.1", port).start()
+  _log.info(f"Serving metrics at http://127.0.0.1:{port}/metrics")
+  return runner
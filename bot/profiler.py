@@ -0,0 +1,125 @@
+"""
+A sampling profiler for the running event loop
+
+A helper thread periodically reads the stack of the event loop thread through
+`sys._current_frames()`. Nothing is traced per call, so the loop itself only
+pays for the GIL hand-offs, which keeps it safe to run in production.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from types import FrameType
+
+MAX_DURATION = 120.0 # seconds
+MIN_INTERVAL = 0.001 # seconds
+
+_lock = threading.Lock() # Only one profile may run at a time
+
+
+def _label(frame: FrameType) -> str:
+  code = frame.f_code
+  filename = code.co_filename
+  for prefix in (os.getcwd(), sys.prefix, sys.base_prefix):
+    if filename.startswith(prefix):
+      filename = filename[len(prefix):].lstrip(os.sep)
+      break
+  return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+@dataclass
+class Profile:
+  duration: float
+  interval: float
+  samples: int = 0
+  stacks: Counter[tuple[str, ...]] = field(default_factory=Counter)
+
+  def collapsed(self) -> str:
+    """Stacks in the collapsed format read by flamegraph.pl, speedscope and friends"""
+    return "\n".join(f"{';'.join(stack)} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+  def top_self(self, limit: int = 20) -> list[tuple[str, int]]:
+    """The frames that were on top of the stack the most"""
+    leaves: Counter[str] = Counter()
+    for stack, n in self.stacks.items():
+      leaves[stack[-1]] += n
+    return leaves.most_common(limit)
+
+  def report(self, limit: int = 20) -> str:
+    lines = [
+      f"{self.samples} samples over {self.duration:.1f}s every {self.interval * 1000:g}ms",
+      "",
+      f"{'self %':>7}  {'samples':>8}  frame"
+    ]
+    for label, n in self.top_self(limit):
+      lines.append(f"{n / max(self.samples, 1) * 100:>6.1f}%  {n:>8}  {label}")
+    return "\n".join(lines)
+
+
+class SamplingProfiler:
+  def __init__(self, thread_id: int, interval: float = 0.005):
+    self.thread_id = thread_id
+    self.interval = max(interval, MIN_INTERVAL)
+    self._stop = threading.Event()
+    self._thread: threading.Thread | None = None
+    self._start = 0.0
+    self.profile = Profile(0.0, self.interval)
+
+  def _sample(self):
+    interval = self.interval
+    stacks = self.profile.stacks
+    last = time.perf_counter()
+    while not self._stop.wait(interval):
+      frame = sys._current_frames().get(self.thread_id)
+      # While the loop holds the GIL we wake up late, so each sample is weighted
+      # by the time it covers. Otherwise busy code would be under-reported.
+      now = time.perf_counter()
+      weight = max(1, round((now - last) / interval))
+      last = now
+      stack = []
+      while frame is not None:
+        stack.append(_label(frame))
+        frame = frame.f_back
+      if stack:
+        stack.reverse()
+        stacks[tuple(stack)] += weight
+        self.profile.samples += weight
+
+  def start(self):
+    if not _lock.acquire(blocking=False):
+      raise RuntimeError("a profile is already running")
+    self._start = time.perf_counter()
+    self._thread = threading.Thread(target=self._sample, name="shroom-profiler", daemon=True)
+    self._thread.start()
+
+  def stop(self) -> Profile:
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+      _lock.release()
+    self.profile.duration = time.perf_counter() - self._start
+    return self.profile
+
+
+async def profile_loop(duration: float, interval: float = 0.005) -> Profile:
+  """|coro|
+
+  Samples the thread running the current event loop for `duration` seconds
+  """
+  profiler = SamplingProfiler(threading.get_ident(), interval)
+  profiler.start()
+  try:
+    await asyncio.sleep(min(duration, MAX_DURATION))
+  finally:
+    result = profiler.stop()
+  return result
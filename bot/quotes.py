@@ -0,0 +1,110 @@
+"""
+A buffer of quotes for `/jerome`, refilled in the background
+
+The command takes a quote from memory instead of waiting on the quote API,
+so it never risks the 3 second interaction deadline. A task tops the buffer
+back up whenever it runs low, backing off while the API is failing.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import deque
+from time import perf_counter
+
+import aiohttp
+
+from bot.metrics import METRICS
+
+_log = logging.getLogger(__name__)
+
+MAX_BACKOFF = 60.0 # seconds
+
+
+class QuoteBuffer:
+  def __init__(self, session: aiohttp.ClientSession, url: str, size: int = 20, low_water: int | None = None):
+    self.session = session
+    self.url = url
+    self.size = size
+    self.low_water = low_water if low_water is not None else size // 2
+    self.quotes: deque[str] = deque(maxlen=size)
+
+    self.hits = 0
+    self.misses = 0
+    self.fetched = 0
+    self.failures = 0
+    self._started = perf_counter()
+    self._wake = asyncio.Event()
+    self._task: asyncio.Task | None = None
+
+  @property
+  def hit_ratio(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+  @property
+  def refill_rate(self) -> float:
+    """Quotes fetched per minute since the buffer started"""
+    elapsed = perf_counter() - self._started
+    return self.fetched / elapsed * 60 if elapsed else 0.0
+
+  async def fetch(self, timeout: float | None = None) -> str:
+    """|coro|
+
+    Fetches one quote straight from the API
+    """
+    with METRICS.span("quotes.fetch"):
+      async with self.session.get(self.url, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+        r.raise_for_status()
+        quote = (await r.json(content_type=None))["content"]
+    self.fetched += 1
+    METRICS.inc("quotes.fetched")
+    return quote
+
+  def get(self) -> str | None:
+    """Takes a quote from the buffer, `None` if it is empty"""
+    if len(self.quotes) <= self.low_water:
+      self._wake.set()
+    try:
+      quote = self.quotes.popleft()
+    except IndexError:
+      self.misses += 1
+      METRICS.inc("quotes.miss")
+      return None
+    self.hits += 1
+    METRICS.inc("quotes.hit")
+    return quote
+
+  async def _refill(self):
+    backoff = 1.0
+    while True:
+      while len(self.quotes) < self.size:
+        try:
+          self.quotes.append(await self.fetch(timeout=10))
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+          self.failures += 1
+          METRICS.inc("quotes.failed")
+          _log.warning(f"Fetching a quote failed, retrying in {backoff:.0f}s: {e!r}")
+          await asyncio.sleep(backoff)
+          backoff = min(backoff * 2, MAX_BACKOFF)
+        else:
+          backoff = 1.0
+      self._wake.clear()
+      await self._wake.wait()
+
+  def start(self):
+    if self._task is None:
+      self._task = asyncio.create_task(self._refill(), name="shroom-quotes")
+
+  def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+
+  def summary(self) -> str:
+    return (
+      f"{len(self.quotes)}/{self.size} quotes buffered, {self.hit_ratio:.1%} hit ratio "
+      f"({self.hits} hits, {self.misses} misses), {self.refill_rate:.1f} quotes/min fetched, "
+      f"{self.failures} failed fetches"
+    )
@@ -0,0 +1,151 @@
+"""
+Sliding-window event rates per farm and per channel
+
+Every key gets a `WindowCounter` of fixed size: the counts of the current
+and the previous second, and a ring of the last 16 one-minute buckets. Rates
+over the last second, minute and 15 minutes are estimated the way a sliding
+window counter does it, by adding up the buckets inside the window and
+weighting the oldest one by how much of it is still inside. Recording is
+O(1) and a counter never grows, however busy its key is.
+
+A `RateTracker` keeps at most `max_keys` counters, roughly 400 bytes each.
+Past that the least recently active key is dropped, so thousands of quiet
+farms can't push memory up, and a key that comes back starts from zero.
+"""
+
+from __future__ import annotations
+
+import heapq
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Generic, Hashable, Iterator, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+MINUTES = 16 # Minute buckets per counter, one more than the longest window
+WINDOWS = ("1s", "1m", "15m")
+
+
+@dataclass(slots=True)
+class Rates:
+  """Events per second over each window"""
+  second: float
+  minute: float
+  quarter: float # 15 minutes
+
+  def window(self, name: str) -> float:
+    if name == "1s":
+      return self.second
+    if name == "1m":
+      return self.minute
+    if name == "15m":
+      return self.quarter
+    raise ValueError(f"unknown window `{name}`, expected one of {', '.join(WINDOWS)}")
+
+
+class WindowCounter:
+  __slots__ = ("second", "current", "previous", "minute", "minutes")
+
+  def __init__(self, now: float):
+    self.second = int(now) # The second `current` counts
+    self.current = 0
+    self.previous = 0 # Count of the second before `second`
+    self.minute = self.second // 60 # Newest minute in `minutes`
+    self.minutes = [0] * MINUTES # Ring of per-minute counts, indexed by minute % MINUTES
+
+  def record(self, now: float, n: int = 1):
+    second = int(now)
+    if second != self.second:
+      self.previous = self.current if second == self.second + 1 else 0
+      self.current = 0
+      self.second = second
+      minute = second // 60
+      if minute != self.minute:
+        # Clear the buckets of the minutes that went by without events
+        for m in range(max(self.minute + 1, minute - MINUTES + 1), minute + 1):
+          self.minutes[m % MINUTES] = 0
+        self.minute = minute
+    self.current += n
+    self.minutes[self.minute % MINUTES] += n
+
+  def _minute_count(self, minute: int) -> int:
+    if self.minute - MINUTES < minute <= self.minute:
+      return self.minutes[minute % MINUTES]
+    return 0
+
+  def rates(self, now: float) -> Rates:
+    second = int(now)
+    left = 1 - (now - second) # How much of the oldest bucket is still in the window
+    if second == self.second:
+      per_second = self.current + self.previous * left
+    elif second == self.second + 1:
+      per_second = self.current * left
+    else:
+      per_second = 0.0
+
+    minute = second // 60
+    left = 1 - (now - minute * 60) / 60
+    count = self._minute_count
+    per_minute = (count(minute) + count(minute - 1) * left) / 60
+    if minute - self.minute >= MINUTES:
+      per_quarter = 0.0
+    else:
+      # Every bucket holds one of the last 16 minutes up to `self.minute`, only
+      # those older than the window are taken back out
+      total = sum(self.minutes)
+      for m in range(self.minute - MINUTES + 1, minute - 15):
+        total -= self.minutes[m % MINUTES]
+      per_quarter = (total - count(minute - 15) * (1 - left)) / 900
+    return Rates(float(per_second), per_minute, per_quarter)
+
+
+class RateTracker(Generic[K]):
+  def __init__(self, max_keys: int = 10_000, clock: Callable[[], float] = time.monotonic):
+    self.max_keys = max_keys
+    self.clock = clock
+    self.evicted = 0
+    # Ordered by when each key's current second started, so the first one is the least recently active
+    self._counters: OrderedDict[K, WindowCounter] = OrderedDict()
+
+  def __len__(self) -> int:
+    return len(self._counters)
+
+  def __contains__(self, key: K) -> bool:
+    return key in self._counters
+
+  def record(self, key: K, n: int = 1):
+    now = self.clock()
+    counters = self._counters
+    counter = counters.get(key)
+    if counter is None:
+      if len(counters) >= self.max_keys:
+        counters.popitem(last=False)
+        self.evicted += 1
+      counters[key] = counter = WindowCounter(now)
+    elif int(now) != counter.second:
+      # At most once a second per key, keeps the counters in order of activity
+      counters.move_to_end(key)
+    counter.record(now, n)
+
+  def rates(self, key: K) -> Rates:
+    """The rates of `key`, all 0 if it has not been seen or was dropped"""
+    counter = self._counters.get(key)
+    if counter is None:
+      return Rates(0.0, 0.0, 0.0)
+    return counter.rates(self.clock())
+
+  def items(self) -> Iterator[tuple[K, Rates]]:
+    now = self.clock()
+    for key, counter in list(self._counters.items()):
+      yield key, counter.rates(now)
+
+  def top(self, n: int = 10, window: str = "1m") -> list[tuple[K, Rates]]:
+    """The `n` keys with the highest rate over `window`, in O(keys)"""
+    Rates(0.0, 0.0, 0.0).window(window) # Fails early on a bad window
+    top = heapq.nlargest(n, self.items(), key=lambda item: item[1].window(window))
+    return [(key, rates) for key, rates in top if rates.window(window) > 0]
+
+  def clear(self):
+    self._counters.clear()
+    self.evicted = 0
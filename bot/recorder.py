@@ -0,0 +1,147 @@
+"""
+Opt-in capture of incoming traffic for replaying later
+
+Only the shape of the traffic is kept, message contents are reduced to a
+class and user IDs are replaced with a salted hash.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import IO, TYPE_CHECKING, Iterator
+
+if TYPE_CHECKING:
+  from discord import Interaction, Message
+
+_log = logging.getLogger(__name__)
+
+SHROOM = "shroom"
+COMMAND = "command"
+OTHER = "other"
+
+
+@dataclass
+class TrafficEvent:
+  t: float # Unix time
+  kind: str # "message" or "interaction"
+  guild: int | None
+  channel: int | None
+  user: str # Salted hash of the user ID
+  cls: str # `SHROOM`, `COMMAND`, `OTHER` or the qualified name of an app command
+
+  @property
+  def user_id(self) -> int:
+    """A stand-in user ID derived from the hash, stable within one log"""
+    return int(self.user, 16)
+
+  def to_dict(self) -> dict:
+    return {"t": self.t, "k": self.kind, "g": self.guild, "c": self.channel, "u": self.user, "cls": self.cls}
+
+  @classmethod
+  def from_dict(cls, d: dict) -> TrafficEvent:
+    return cls(d["t"], d["k"], d["g"], d["c"], d["u"], d["cls"])
+
+
+def open_new_log(path: str) -> tuple[str, IO[str]]:
+  """Creates a log at `path`, or next to it with the current time in its name
+  if an earlier run left one there. Returns the path used and the open file.
+  """
+  directory, name = os.path.split(path)
+  stem, dot, extensions = name.partition(".")
+  stamp = time.strftime("%Y%m%d-%H%M%S")
+  candidate = path
+  taken = 0
+  while True:
+    try:
+      return candidate, gzip.open(candidate, "xt", encoding="utf-8") # type: ignore
+    except FileExistsError:
+      # Two runs can start within the same second
+      suffix = f"-{taken}" if taken else ""
+      candidate = os.path.join(directory, f"{stem}-{stamp}{suffix}{dot}{extensions}")
+      taken += 1
+
+
+class TrafficRecorder:
+  """Writes a gzipped NDJSON log of every message and app command the bot receives
+
+  The salt of the user hashes is never written down, so every run starts a
+  new log. Appending to an earlier one would mix two hashes for each user.
+  """
+
+  def __init__(self, path: str, prefix: str = "$", salt: bytes | None = None, buffer_size: int = 256):
+    self.path, self._file = open_new_log(path)
+    self.prefix = prefix
+    self._salt = salt if salt is not None else os.urandom(16)
+    self._buffer: list[str] = []
+    self._buffer_size = buffer_size
+    self.recorded = 0
+    _log.info(f"Recording traffic to `{self.path}`")
+
+  def _hash(self, user_id: int) -> str:
+    return hashlib.blake2b(user_id.to_bytes(8, "big"), digest_size=7, key=self._salt).hexdigest()
+
+  def _write(self, event: TrafficEvent):
+    self._buffer.append(json.dumps(event.to_dict(), separators=(",", ":")))
+    self.recorded += 1
+    if len(self._buffer) >= self._buffer_size:
+      self.flush()
+
+  def classify(self, content: str) -> str:
+    if content == "🍄":
+      return SHROOM
+    if content.startswith(self.prefix) or content.startswith("<@"):
+      return COMMAND
+    return OTHER
+
+  def record_message(self, message: Message):
+    self.record_raw_message(
+      message.guild.id if message.guild is not None else None,
+      message.channel.id,
+      message.author.id,
+      message.content
+    )
+
+  def record_raw_message(self, guild_id: int | None, channel_id: int, author_id: int, content: str):
+    """Records a message straight from its gateway payload, for messages no `Message` is built for"""
+    self._write(TrafficEvent(
+      round(time.time(), 3),
+      "message",
+      guild_id,
+      channel_id,
+      self._hash(author_id),
+      self.classify(content)
+    ))
+
+  def record_interaction(self, interaction: Interaction):
+    command = interaction.command
+    self._write(TrafficEvent(
+      round(time.time(), 3),
+      "interaction",
+      interaction.guild_id,
+      interaction.channel_id,
+      self._hash(interaction.user.id),
+      "/" + command.qualified_name if command is not None else "/unknown"
+    ))
+
+  def flush(self):
+    if self._buffer:
+      self._file.write("\n".join(self._buffer) + "\n")
+      self._buffer.clear()
+    self._file.flush()
+
+  def close(self):
+    self.flush()
+    self._file.close()
+
+
+def read_events(path: str) -> Iterator[TrafficEvent]:
+  with gzip.open(path, "rt", encoding="utf-8") as f:
+    for line in f:
+      if line.strip():
+        yield TrafficEvent.from_dict(json.loads(line))
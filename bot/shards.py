@@ -0,0 +1,102 @@
+"""
+Shard helpers and per-shard metrics
+
+Discord puts a guild on shard `(guild_id >> 22) % shard_count`. The same rule
+partitions the farm cache, so a shard only ever touches the farms of its own
+guilds. Events and farms are counted per shard into `METRICS` counters and
+`ShardRates` turns those into rates between two reports.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from time import perf_counter
+
+from bot.metrics import METRICS
+
+
+def shard_for(guild_id: int, shard_count: int) -> int:
+  """The shard Discord sends the events of `guild_id` to"""
+  return (guild_id >> 22) % shard_count
+
+
+def parse_shard_ids(spec: str | int | None) -> list[int] | None:
+  """Parses a shard range such as `"0-3,8"`, `None` meaning every shard"""
+  if spec is None or spec == "":
+    return None
+  if isinstance(spec, int):
+    return [spec]
+  ids: set[int] = set()
+  for part in spec.split(","):
+    part = part.strip()
+    if not part:
+      continue
+    start, sep, end = part.partition("-")
+    if sep:
+      if int(end) < int(start):
+        raise ValueError(f"shard range `{part}` is backwards")
+      ids.update(range(int(start), int(end) + 1))
+    else:
+      ids.add(int(start))
+  return sorted(ids)
+
+
+def count_event(shard_id: int | None):
+  METRICS.inc(f"shard.{shard_id or 0}.events")
+
+
+def count_farmed(shard_id: int | None, amount: int = 1):
+  METRICS.inc(f"shard.{shard_id or 0}.farmed", amount)
+
+
+@dataclass
+class ShardRate:
+  shard_id: int
+  latency: float # seconds, `nan` until the first heartbeat
+  events: int
+  farmed: int
+  events_per_second: float
+  farmed_per_second: float
+
+
+class ShardRates:
+  """Per-shard rates since the last call to `sample`"""
+
+  def __init__(self):
+    self._last: dict[int, tuple[int, int]] = {}
+    self._last_time = perf_counter()
+
+  def reset(self):
+    """Starts over from zero, for when the shard counters in `METRICS` are reset"""
+    self._last.clear()
+    self._last_time = perf_counter()
+
+  def sample(self, latencies: list[tuple[int, float]]) -> list[ShardRate]:
+    now = perf_counter()
+    elapsed = now - self._last_time
+    self._last_time = now
+    counters = METRICS.counters
+    rates = []
+    for shard_id, latency in latencies:
+      events = counters.get(f"shard.{shard_id}.events", 0)
+      farmed = counters.get(f"shard.{shard_id}.farmed", 0)
+      last_events, last_farmed = self._last.get(shard_id, (0, 0))
+      self._last[shard_id] = (events, farmed)
+      rates.append(ShardRate(
+        shard_id,
+        latency,
+        events,
+        farmed,
+        (events - last_events) / elapsed if elapsed else 0.0,
+        (farmed - last_farmed) / elapsed if elapsed else 0.0
+      ))
+    return rates
+
+  def summary(self, latencies: list[tuple[int, float]]) -> str:
+    lines = [f"{'shard':<8}{'latency':>10}{'events':>10}{'events/s':>10}{'farmed':>10}{'farms/s':>10}"]
+    for rate in self.sample(latencies):
+      lines.append(
+        f"{rate.shard_id:<8}{rate.latency * 1000:>8.1f}ms{rate.events:>10}"
+        f"{rate.events_per_second:>10.2f}{rate.farmed:>10}{rate.farmed_per_second:>10.2f}"
+      )
+    return "\n".join(lines)
@@ -1,19 +1,37 @@
 from __future__ import annotations
+import asyncio
+import logging
 from collections import Counter
 from dataclasses import dataclass
+from datetime import datetime, timedelta
 from operator import itemgetter
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterator
 
-from motor import motor_asyncio
+import bson
 
+from bot.errors import DuplicateDocument
+from bot.metrics import METRICS
+from bot.shards import shard_for
 from bot.shroom.farm import Farm
+from bot.shroom.loader import BatchLoader
 from bot.shroom.ranks import Rank
-from bot.shroom.stats import DailyStats
+from bot.shroom.rollover import PendingDay, RolloverScheduler, read_journal, write_journal
+from bot.shroom.stats import DailyStats, DailyFarmStats, WeeklyTotals
+from bot.shroom.storage import MemoryBackend, MongoBackend
 from bot.shroom.user import User
+from bot.utils import str_key_to_int
 
 if TYPE_CHECKING:
-  from bot.shroom.stats import DailyStatsDict, DailyFarmStats
+  from bot.shroom.snapshot import Snapshot
+  from bot.shroom.storage import StorageBackend
+
+_log = logging.getLogger(__name__)
+
+SAVE_ATTEMPTS = 5 # Times a farm is reloaded and saved again when another process wrote it first
+PERSIST_BACKOFF = (1.0, 60.0) # First and longest wait in seconds between attempts to save a day that ended
+RECOVER_ATTEMPTS = 3 # Attempts at saving the days in the rollover journal on startup before carrying on without them
+
 
 @dataclass
 class FarmResult:
@@ -26,23 +44,156 @@ class FarmResult:
 
 
 class ShroomFarm:
-  def __init__(self, url: str = "localhost"):
-    self.db_url = url
-    self._db_client = motor_asyncio.AsyncIOMotorClient(url)
-    self.shroom_db: motor_asyncio.AsyncIOMotorDatabase = self._db_client["ShroomDB"]
-
-    self.farm_db: motor_asyncio.AsyncIOMotorCollection = self.shroom_db["Farm"]
-    self.user_db: motor_asyncio.AsyncIOMotorCollection = self.shroom_db["Users"]
-    self.stats_db: motor_asyncio.AsyncIOMotorCollection = self.shroom_db["Stats"]
+  def __init__(
+      self,
+      backend: StorageBackend | None = None,
+      shard_count: int | None = None,
+      shard_ids: list[int] | None = None,
+      process_id: str | None = None,
+      journal_path: str | None = None
+  ):
+    self.backend: StorageBackend = backend if backend is not None else MongoBackend()
+    self.process_id = process_id # Set when running in a cluster, see `bot.cluster`
+    self.daily_stats = self.new_daily_stats()
+    self.rollovers = RolloverScheduler() # When each farm's day ends
+    self.pending_days: list[PendingDay] = [] # UTC days that ended but aren't saved yet, oldest first
+    self.journal_path = journal_path # Where `pending_days` are kept until they are saved
+    self._stats_lock = asyncio.Lock() # Keeps `Stats` writes in order
+    self._journal_lock = asyncio.Lock()
+    self._persist_task: asyncio.Task | None = None
+    # Lookups that miss the caches are batched, see `bot.shroom.loader`. The
+    # memory backend answers without a round trip, so there it only costs time
+    self._batch_lookups = not isinstance(self.backend, MemoryBackend)
+    self.farm_loader: BatchLoader[int] = BatchLoader("farms", self.backend.find_farms)
+    self.user_loader: BatchLoader[int] = BatchLoader("users", self.backend.find_users)
+
+    # Caches, until they are prewarmed lookups fall back to the database.
+    # Farms are partitioned by shard and only the shards in `shard_ids` are cached
+    self.shard_count = shard_count or 1
+    self.shard_ids: frozenset[int] | None = frozenset(shard_ids) if shard_ids is not None else None
+    self._partitions: dict[int, dict[int, Farm]] = {}
+    self._farms_warm = False # Every owned farm is cached, so a miss means there is no farm
+    self.farm_channels: dict[int, int] = {} # Farm channel ID -> farm ID
+    self._weekly: WeeklyTotals | None = None
 
     super().__init__()
 
   async def setup(self):
+    await self.connect()
+    await self.recover_pending_days()
+    await asyncio.gather(
+      self.restore_daily_stats(),
+      self.prewarm_farms(),
+      self.prewarm_weekly_totals()
+    )
+
+  async def connect(self):
+    await self.backend.connect()
+
+  async def restore_daily_stats(self):
     latest_stats = await self.get_latest_daily_stats()
     if latest_stats is not None and latest_stats.is_today:
       self.daily_stats = latest_stats
     else:
-      self.daily_stats = DailyStats()
+      self.daily_stats = self.new_daily_stats()
+      if latest_stats is not None:
+        # Farm days don't end with the UTC day, the ones that ended since are ended right away
+        self.daily_stats.farms = latest_stats.farms
+    self.reschedule_rollovers()
+
+  def restore_snapshot(self, snapshot: Snapshot):
+    """Takes today's stats and every cache from `snapshot` instead of the database"""
+    self.daily_stats = snapshot.daily_stats
+    self._partitions.clear()
+    self.farm_channels.clear()
+    for farm in snapshot.farms:
+      if self.owns(farm._id):
+        self._cache_farm(farm)
+    self._farms_warm = True
+    self._weekly = snapshot.weekly
+    self.reschedule_rollovers()
+
+  async def prewarm_farms(self) -> int:
+    """|coro|
+
+    Caches every farm of the owned shards and indexes their channels,
+    returns how many there are
+    """
+    async for d in self.backend.iter_farms():
+      if self.owns(d["_id"]):
+        self._cache_farm(Farm(**d))
+    self._farms_warm = True
+    return self.cached_farm_count
+
+  async def reload_shards(self, shard_ids: list[int]) -> int:
+    """|coro|
+
+    Drops the cached farms of `shard_ids` and loads them again, for when
+    another process may have changed them. Returns how many there are now.
+    """
+    shards = set(shard_ids)
+    for shard_id in shards:
+      for farm in self._partitions.pop(shard_id, {}).values():
+        if farm.farm_channel is not None:
+          self.farm_channels.pop(farm.farm_channel, None)
+    loaded = 0
+    async for d in self.backend.iter_farms():
+      if self.shard_of(d["_id"]) in shards:
+        self._cache_farm(Farm(**d))
+        loaded += 1
+    return loaded
+
+  async def prewarm_weekly_totals(self):
+    """|coro|
+
+    Adds up every day of this week except today, which is kept in `daily_stats`
+    """
+    weekly = WeeklyTotals()
+    async for d in self.backend.iter_stats():
+      stats = DailyStats.from_db(d)
+      if not stats.is_today:
+        weekly.add(stats)
+    self._weekly = weekly
+
+  async def close(self):
+    # Whatever is still pending stays in the journal for the next start
+    if self._persist_task is not None:
+      self._persist_task.cancel()
+    await self.backend.close()
+
+  def new_daily_stats(self) -> DailyStats:
+    return DailyStats(process=self.process_id)
+
+  def reschedule_rollovers(self):
+    """Schedules the end of every running farm day in `daily_stats`"""
+    fallback = datetime.combine(datetime.utcnow().date() + timedelta(days=1), datetime.min.time())
+    self.rollovers.reset(
+      (d.get("ends") or fallback, farm_id)
+      for farm_id, d in self.daily_stats.farms.items()
+    )
+
+  def _end_due_farm_days(self, now: datetime) -> int:
+    ended = 0
+    for ends, farm_id in self.rollovers.pop_due(now):
+      d = self.daily_stats.farms.get(farm_id)
+      if d is None or d.get("ends") not in (None, ends):
+        continue # Already ended
+      self.daily_stats.close_farm(farm_id)
+      ended += 1
+    if ended:
+      METRICS.inc("shroom.farm_days_ended", ended)
+    return ended
+
+  async def rollover_farms(self, now: datetime | None = None) -> int:
+    """|coro|
+
+    Ends every farm day that is over and saves them, returns how many ended
+    """
+    ended = self._end_due_farm_days(now or datetime.utcnow())
+    if ended:
+      with METRICS.span("shroom.rollover_farms"):
+        await self.save_daily_stats(self.daily_stats)
+    return ended
 
 
 
@@ -52,44 +203,159 @@ class ShroomFarm:
 
 
 
+  def shard_of(self, farm_id: int) -> int:
+    return shard_for(farm_id, self.shard_count)
+
+  def owns(self, farm_id: int) -> bool:
+    """Whether the farm belongs to one of the shards this process runs"""
+    return self.shard_ids is None or self.shard_of(farm_id) in self.shard_ids
+
+  def assign_shards(self, shard_count: int, shard_ids: list[int] | None = None):
+    """Repartitions the farm cache, dropping farms of shards that are no longer owned
+
+    Used when the shard count is only known once Discord recommends one.
+    """
+    farms = list(self.cached_farms())
+    self.shard_count = shard_count
+    self.shard_ids = frozenset(shard_ids) if shard_ids is not None else None
+    self._partitions.clear()
+    self.farm_channels.clear()
+    for farm in farms:
+      if self.owns(farm._id):
+        self._cache_farm(farm)
+
+  def cached_farms(self, shard_id: int | None = None) -> Iterator[Farm]:
+    """Iterates over the cached farms of `shard_id`, or of every shard"""
+    if shard_id is not None:
+      yield from self._partitions.get(shard_id, {}).values()
+      return
+    for partition in self._partitions.values():
+      yield from partition.values()
+
+  @property
+  def cached_farm_count(self) -> int:
+    return sum(len(partition) for partition in self._partitions.values())
+
+  def _cache_farm(self, farm: Farm) -> Farm:
+    shard_id = self.shard_of(farm._id)
+    try:
+      self._partitions[shard_id][farm._id] = farm
+    except KeyError:
+      self._partitions[shard_id] = {farm._id: farm}
+    if farm.farm_channel is not None:
+      self.farm_channels[farm.farm_channel] = farm._id
+    return farm
+
   async def save_farm(self, farm: Farm) -> bool:
-    result = await self.farm_db.update_one(
-      {
-        "_id": farm._id
-      },
-      {
-        "$set": farm.to_dict(include_id=False, include_time=False),
-        "$currentDate": {"updated": True}
-      }
+    """|coro|
+
+    Saves the farm if nobody else has written it since it was read,
+    returns `False` if they have or it does not exist
+    """
+    saved = await self.backend.update_farm(
+      farm._id,
+      farm.to_dict(include_id=False, include_time=False, include_version=False),
+      farm.version
     )
-    return result.modified_count == 1
+    self.farm_loader.forget(farm._id)
+    if saved:
+      farm.version += 1
+    return saved
+
+  async def reload_farm(self, farm: Farm) -> bool:
+    """|coro|
+
+    Updates `farm` in place with what is in the database, the cached farm
+    is the same object so it is updated too. Returns `False` if it is gone.
+    """
+    d = await self.backend.find_farm(farm._id)
+    if d is None:
+      return False
+    fresh = Farm(**d)
+    for name in fresh.__dataclass_fields__:
+      setattr(farm, name, getattr(fresh, name))
+    return True
 
   async def get_farm(self, farm_id: int) -> Farm | None:
-    d = await self.farm_db.find_one({"_id": farm_id})
+    partition = self._partitions.get(self.shard_of(farm_id))
+    farm = partition.get(farm_id) if partition is not None else None
+    if farm is not None:
+      return farm
+    owned = self.owns(farm_id)
+    if owned and self._farms_warm:
+      return None
+    if self._batch_lookups:
+      d = await self.farm_loader.load(farm_id)
+    else:
+      d = await self.backend.find_farm(farm_id)
     if d is None:
       return None
-    return Farm(**d)
+    farm = Farm(**d)
+    return self._cache_farm(farm) if owned else farm
+
+  def cached_farm(self, farm_id: int) -> Farm | None:
+    """The farm if it is cached, never hits the database"""
+    partition = self._partitions.get(self.shard_of(farm_id))
+    return partition.get(farm_id) if partition is not None else None
+
+  def ignores_shroom(self, farm_id: int, channel_id: int) -> bool:
+    """Whether a 🍄 in `channel_id` would be ignored, going by the cache alone
+
+    It is when the farm is cached and farms in another channel. A farm that
+    isn't cached or has no channel yet has to be looked up, and may need a
+    reply, so it is never ignored here.
+    """
+    if self.farm_channels.get(channel_id) == farm_id:
+      return False
+    farm = self.cached_farm(farm_id)
+    return farm is not None and farm.farm_channel is not None and farm.farm_channel != channel_id
 
   async def create_farm(self, server_id: int, channel: int | None = None) -> Farm:
     if await self.get_farm(server_id) is not None:
       raise ValueError(f"farm with ID `{server_id}` already exists")
     farm = Farm(server_id, farm_channel=channel)
-    await self.farm_db.insert_one(farm.to_dict())
-    return farm
+    await self.backend.insert_farm(farm.to_dict())
+    self.farm_loader.forget(server_id)
+    return self._cache_farm(farm) if self.owns(server_id) else farm
 
-  async def set_farm_channel(self, farm_id: int, channel_id: int):
+  async def set_farm_channel(self, farm_id: int, channel_id: int) -> bool:
     farm = await self.get_farm(farm_id)
     if farm is None:
       raise ValueError(f"server with ID `{farm_id}` does not exist")
-    farm.farm_channel = channel_id
-    await self.save_farm(farm)
+    if farm.farm_channel is not None:
+      self.farm_channels.pop(farm.farm_channel, None)
+    if self.owns(farm_id):
+      self.farm_channels[channel_id] = farm_id
+    return await self._save_field(farm, "farm_channel", channel_id)
 
-  async def set_daily_goal(self, farm_id: int, daily_goal: int | None):
+  async def set_daily_goal(self, farm_id: int, daily_goal: int | None) -> bool:
     farm = await self.get_farm(farm_id)
     if farm is None:
       raise ValueError(f"server with ID `{farm_id}` does not exist")
-    farm.daily_goal = daily_goal
-    await self.save_farm(farm)
+    return await self._save_field(farm, "daily_goal", daily_goal)
+
+  async def set_farm_timezone(self, farm_id: int, timezone: str) -> bool:
+    """|coro|
+
+    Sets the timezone the farm's days start at midnight in, from its next day
+    on, returns whether it was saved
+    """
+    farm = await self.get_farm(farm_id)
+    if farm is None:
+      raise ValueError(f"server with ID `{farm_id}` does not exist")
+    return await self._save_field(farm, "timezone", timezone)
+
+  async def _save_field(self, farm: Farm, name: str, value: Any) -> bool:
+    """Sets one field of `farm` and saves it on top of whatever another process wrote, returns whether it was saved"""
+    for _ in range(SAVE_ATTEMPTS):
+      setattr(farm, name, value)
+      if await self.save_farm(farm):
+        return True
+      METRICS.inc("shroom.farm_conflicts")
+      if not await self.reload_farm(farm):
+        return False
+    _log.error(f"Gave up saving the {name} of farm {farm._id} after {SAVE_ATTEMPTS} conflicting writes")
+    return False
 
 
 
@@ -100,18 +366,23 @@ class ShroomFarm:
 
 
   async def save_user(self, user: User) -> bool:
-    result = await self.user_db.update_one(
-      {
-        "_id": user._id
-      },
-      {
-        "$set": user.to_dict(include_id=False)
-      }
-    )
-    return result.modified_count == 1
+    return await self._update_user(user._id, user.to_dict(include_id=False))
+
+  async def _update_user(self, user_id: int, fields: dict[str, Any]) -> bool:
+    saved = await self.backend.update_user(user_id, fields)
+    self.user_loader.forget(user_id)
+    return saved
+
+  async def _inc_user(self, user_id: int, fields: dict[str, int]) -> bool:
+    saved = await self.backend.inc_user(user_id, fields)
+    self.user_loader.forget(user_id)
+    return saved
 
   async def get_user(self, user_id: int) -> User | None:
-    d = await self.user_db.find_one({"_id": user_id})
+    if self._batch_lookups:
+      d = await self.user_loader.load(user_id)
+    else:
+      d = await self.backend.find_user(user_id)
     if d is None:
       return None
     return User(**d)
@@ -120,16 +391,32 @@ class ShroomFarm:
     if await self.get_user(user_id) is not None:
       raise ValueError(f"user with ID `{user_id}` already exists")
     user = User(user_id)
-    await self.user_db.insert_one(user.to_dict())
+    await self.backend.insert_user(user.to_dict())
+    self.user_loader.forget(user_id)
+    return user
+
+  async def get_or_create_user(self, user_id: int) -> User:
+    user = await self.get_user(user_id)
+    if user is not None:
+      return user
+    user = User(user_id)
+    try:
+      await self.backend.insert_user(user.to_dict())
+    except DuplicateDocument:
+      # They farmed somewhere else at the same time and that insert won, read it back
+      self.user_loader.forget(user_id)
+      user = await self.get_user(user_id)
+      if user is None:
+        raise
+      return user
+    self.user_loader.forget(user_id)
     return user
   
   async def inc_user_farmed(self, user_id: int, amount: int = 1) -> bool:
-    result = await self.user_db.update_one({"_id": user_id}, {"$inc": {"farmed": amount}})
-    return result.modified_count == 1
+    return await self._inc_user(user_id, {"farmed": amount})
   
   async def inc_user_tokens(self, user_id: int, tokens: int = 1) -> bool:
-    result = await self.user_db.update_one({"_id": user_id}, {"$inc": {"tokens": tokens, "lifetime_tokens": tokens}})
-    return result.modified_count == 1
+    return await self._inc_user(user_id, {"tokens": tokens, "lifetime_tokens": tokens})
   
   async def set_user_tokens(self, user_id: int, tokens: int | None = None) -> bool:
     """|coro|
@@ -137,8 +424,7 @@ class ShroomFarm:
     Directly set the number of tokens a user has.
     NOTE: This does not check if the user exists in the database
     """
-    result = await self.user_db.update_one({"_id": user_id}, {"$set": {"tokens": tokens}})
-    return result.modified_count == 1
+    return await self._update_user(user_id, {"tokens": tokens})
   
   async def set_user_rank(self, user_id: int, rank_or_int: Rank | int) -> bool:
     """|coro|
@@ -153,8 +439,7 @@ class ShroomFarm:
     else:
       raise TypeError("value must be either a `Rank` or `int` type")
 
-    result = await self.user_db.update_one({"_id": user_id}, {"$set": {"rank_enum": enum}})
-    return result.modified_count == 1
+    return await self._update_user(user_id, {"rank_enum": enum})
 
 
 
@@ -165,20 +450,26 @@ class ShroomFarm:
 
 
   async def get_latest_daily_stats(self) -> DailyStats | None:
-    stats: DailyStatsDict | None = await self.stats_db.find_one({}, sort=[("$natural", -1)])
+    stats = await self.backend.latest_stats(self.process_id)
     if stats is None:
       return None
     else:
       return DailyStats.from_db(stats)
     
   async def save_daily_stats(self, stats: DailyStats) -> bool:
-    latest_stats = await self.get_latest_daily_stats()
-    if latest_stats is not None and latest_stats.date.date() == stats.date.date():
-      result = await self.stats_db.replace_one({"_id": latest_stats._id}, stats.to_dict())
-      return result.modified_count == 1
+    async with self._stats_lock:
+      # `Stats` is kept in date order, so the days that ended are saved first
+      while self.pending_days:
+        await self._save_pending_day()
+      return await self._write_daily_stats(stats)
+
+  async def _write_daily_stats(self, stats: DailyStats) -> bool:
+    # Only the `_id` and `date` are needed, so this skips building a `DailyStats`
+    latest_stats = await self.backend.latest_stats(self.process_id)
+    if latest_stats is not None and latest_stats["date"].date() == stats.date.date():
+      return await self.backend.replace_stats(latest_stats["_id"], stats.to_dict()) # type: ignore
     else:
-      result = await self.stats_db.insert_one(stats.to_dict())
-      return bool(result)
+      return bool(await self.backend.insert_stats(stats.to_dict()))
 
   async def clear_daily_stats(self):
     """|coro|
@@ -187,20 +478,132 @@ class ShroomFarm:
     WARNING: This function is extremely destructive and will wipe out
     1 week's worth of farming data.
     """
-    await self.stats_db.delete_many({}) # rip
+    async with self._stats_lock:
+      await self.backend.clear_stats() # rip
+
+  def roll_day(self) -> PendingDay:
+    """Swaps in a fresh `DailyStats` and queues the day that ended to be saved
+
+    Nothing here awaits, so every farm event lands either in the day that
+    ended or in the new one, and the weekly totals already include the day
+    that ended.
+    """
+    # Farm days ending at midnight UTC belong to the day that is ending
+    self._end_due_farm_days(datetime.utcnow())
+    ended = self.daily_stats
+    running = ended.farms
+    ended.farms = dict(running)
+    self.daily_stats = self.new_daily_stats()
+    self.daily_stats.farms = running
+    # If it's a Sunday, the `Stats` collection is cleared instead
+    day = PendingDay(ended, clear=ended.date.isoweekday() == 7)
+    if self._weekly is not None:
+      if day.clear:
+        self._weekly = WeeklyTotals()
+      else:
+        self._weekly.add(ended)
+    self.pending_days.append(day)
+    METRICS.inc("shroom.days_rolled")
+    return day
 
   async def update_daily_stats(self) -> bool:
-    if self.daily_stats.date.isoweekday() == 7:
-      # If it's a Sunday, we have to clear the `Stats` collection
-      await self.clear_daily_stats()
-      # We can't tell if it is successful since we don't know how many
-      # documents are in the collection, so we just assume it worked
-      result = True
-    else:
-      result = await self.save_daily_stats(self.daily_stats)
-    self.daily_stats = DailyStats()
-    return result
+    """|coro|
+
+    Starts a new UTC day and saves the one that ended in the background,
+    returns whether it made it into the journal
+    """
+    self.roll_day()
+    journaled = await self.write_journal()
+    self.persist_pending_days()
+    return journaled
+
+  def persist_pending_days(self) -> asyncio.Task:
+    """Starts saving `pending_days` in the background, unless that is already running"""
+    if self._persist_task is None or self._persist_task.done():
+      self._persist_task = asyncio.create_task(self._persist_pending_days(), name="shroom-persist-days")
+    return self._persist_task
+
+  async def _persist_pending_days(self, attempts: int | None = None) -> bool:
+    """Saves `pending_days` in order, returns `False` once `attempts` saves in a row failed"""
+    delay = PERSIST_BACKOFF[0]
+    failed = 0
+    while self.pending_days:
+      day = self.pending_days[0]
+      try:
+        # Taken for each save only, so other `Stats` writes aren't held up by the retries
+        async with self._stats_lock:
+          if self.pending_days: # `save_daily_stats` may have saved them meanwhile
+            await self._save_pending_day()
+      except Exception as e:
+        METRICS.inc("shroom.persist_day_retries")
+        failed += 1
+        if attempts is not None and failed >= attempts:
+          _log.warning(f"Could not save the stats of {day.stats.date:%Y-%m-%d}: {e!r}")
+          return False
+        _log.warning(f"Could not save the stats of {day.stats.date:%Y-%m-%d}, retrying in {delay:g}s: {e!r}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, PERSIST_BACKOFF[1])
+        continue
+      delay = PERSIST_BACKOFF[0]
+      failed = 0
+    return True
+
+  async def _save_pending_day(self):
+    """Saves the oldest of `pending_days`, the caller holds `_stats_lock`"""
+    day = self.pending_days[0]
+    with METRICS.span("shroom.persist_day"):
+      if day.clear:
+        # We can't tell if it is successful since we don't know how many
+        # documents are in the collection, so we just assume it worked
+        await self.backend.clear_stats()
+      else:
+        # A replace that changes nothing means the day was saved before the
+        # journal was last written, which counts as saved too
+        await self._write_daily_stats(day.stats)
+    self.pending_days.pop(0)
+    _log.info(f"Saved the stats of {day.stats.date:%Y-%m-%d}")
+    await self.write_journal()
+
+  async def write_journal(self) -> bool:
+    """|coro|
+
+    Writes `pending_days` to the journal, returns whether that worked
+    """
+    if not self.journal_path:
+      return True
+    async with self._journal_lock:
+      try:
+        await asyncio.to_thread(write_journal, self.journal_path, list(self.pending_days))
+      except OSError as e:
+        _log.warning(f"Could not write the rollover journal: {e}")
+        return False
+    return True
+
+  async def recover_pending_days(self) -> int:
+    """|coro|
 
+    Saves the days a previous run ended but didn't get to save, returns how many were saved
+
+    If they can't be saved in `RECOVER_ATTEMPTS` attempts, they stay in the
+    journal and keep being retried in the background so startup can go on.
+    """
+    if not self.journal_path:
+      return 0
+    try:
+      days = await asyncio.to_thread(read_journal, self.journal_path)
+    except (OSError, KeyError, TypeError, bson.errors.BSONError) as e:
+      _log.warning(f"Ignoring rollover journal `{self.journal_path}`: {e}")
+      return 0
+    if days:
+      _log.info(f"Saving {len(days)} day(s) left in the rollover journal")
+      self.pending_days[:0] = days
+      if not await self._persist_pending_days(RECOVER_ATTEMPTS):
+        _log.error(
+          f"Gave up saving the rollover journal on startup after {RECOVER_ATTEMPTS} attempts, "
+          f"{len(self.pending_days)} day(s) are kept in it and retried in the background"
+        )
+        self.persist_pending_days()
+    return len(days) - len(self.pending_days)
 
   def get_server_farmed_today(self, farm_id: int) -> int:
     farm_stats = self.daily_stats.get_farm_stats(farm_id)
@@ -210,16 +613,45 @@ class ShroomFarm:
     return self.daily_stats.get_user_farmed(user_id)
 
 
+  async def _earlier_days(self, *fields: str) -> AsyncIterator[dict[str, Any]]:
+    """The `fields` of every day of this week before today, for when the weekly totals aren't cached
+
+    Like the cached totals, this includes the days that ended but aren't saved
+    yet, and leaves out today's document, which `daily_stats` is ahead of.
+    """
+    pending = list(self.pending_days)
+    cleared = max((i for i, day in enumerate(pending) if day.clear), default=None)
+    if cleared is not None:
+      # Everything up to that Sunday is about to be wiped
+      pending = pending[cleared + 1:]
+    else:
+      today = self.daily_stats.date.date()
+      unsaved = {(day.stats.date.date(), day.stats.process) for day in pending}
+      async for d in self.backend.iter_stats(("date", "process", *fields)):
+        day = d["date"].date()
+        # A day still pending may have been saved already, the pending copy counts
+        if day != today and (day, d.get("process")) not in unsaved:
+          yield d # type: ignore
+    for day in pending:
+      yield day.stats.to_dict() # type: ignore
+
   async def get_total_weekly_farmed(self) -> int:
     total = self.daily_stats.total
-    async for stat in self.stats_db.find({}, projection=("total",)):
+    if self._weekly is not None:
+      return total + self._weekly.total
+    async for stat in self._earlier_days("total"):
       total += stat["total"]
     return total
   
   async def get_server_weekly_farmed(self, farm_id: int) -> int:
     total = self.get_server_farmed_today(farm_id)
-    async for farm_stats in self.stats_db.find({}, projection=("farms",)):
-      farm_stats = farm_stats["farms"].get(str(farm_id))
+    ended = self.daily_stats.closed.get(farm_id)
+    if ended is not None:
+      total += ended["farmed"]
+    if self._weekly is not None:
+      return total + self._weekly.farms[farm_id]
+    async for farm_stats in self._earlier_days(f"farms.{farm_id}"):
+      farm_stats = farm_stats.get("farms", {}).get(str(farm_id))
       if farm_stats is None:
         continue
       else:
@@ -228,8 +660,10 @@ class ShroomFarm:
   
   async def get_user_weekly_farmed(self, user_id: int) -> int:
     total = self.daily_stats.get_user_farmed(user_id)
-    async for user_stats in self.stats_db.find({}, projection=("users",)):
-      total += user_stats["users"].get(str(user_id), 0)
+    if self._weekly is not None:
+      return total + self._weekly.users[user_id]
+    async for user_stats in self._earlier_days(f"users.{user_id}"):
+      total += user_stats.get("users", {}).get(str(user_id), 0)
     return total
 
 
@@ -239,13 +673,16 @@ class ShroomFarm:
       contributors = Counter()
     else:
       contributors = Counter(farm_stats.contributors)
-    async for farm_stats in self.stats_db.find({}, projection=("farms",)):
-      farm_stats = farm_stats.get(str(farm_id))
+    ended = self.daily_stats.closed.get(farm_id)
+    if ended is not None:
+      contributors.update(str_key_to_int(ended["contributors"]))
+    async for farm_stats in self._earlier_days(f"farms.{farm_id}"):
+      farm_stats = farm_stats.get("farms", {}).get(str(farm_id))
       if farm_stats is None:
         continue
       else:
-        contributors.update(farm_stats["contributors"])
-    return {int(k): v for k, v in contributors.items()}
+        contributors.update(str_key_to_int(farm_stats["contributors"]))
+    return dict(contributors)
   
 
 
@@ -260,66 +697,42 @@ class ShroomFarm:
 
     Returns a list of the top `limit` servers farmed
     """
-    cursor = self.farm_db.find({}, sort=[("total_farmed", -1)], limit=limit)
-    farms = []
-    async for farm in cursor:
-      farms.append(Farm(**farm))
-    return farms
+    return [Farm(**farm) for farm in await self.backend.top_farms("total_farmed", limit)]
   
   async def get_top_most_daily_farmed_servers(self, limit: int = 10) -> list[Farm]:
     """|coro|
 
     Returns a list of the top `limit` servers farmed today
     """
-    cursor = self.farm_db.find({}, sort=[("most_farmed_daily", -1)], limit=limit)
-    farms = []
-    async for farm in cursor:
-      farms.append(Farm(**farm))
-    return farms
+    return [Farm(**farm) for farm in await self.backend.top_farms("most_farmed_daily", limit)]
   
   async def get_top_weekly_farmed_servers(self, limit: int = 10) -> list[Farm]:
     """|coro|
 
     Returns a list of the top `limit` servers farmed this week
     """
-    cursor = self.farm_db.find({}, sort=[("most_farmed_weekly", -1)], limit=limit)
-    farms = []
-    async for farm in cursor:
-      farms.append(Farm(**farm))
-    return farms
+    return [Farm(**farm) for farm in await self.backend.top_farms("most_farmed_weekly", limit)]
   
   async def get_top_lifetime_farmed_users(self, limit: int = 10) -> list[User]:
     """|coro|
 
     Returns a list of the top `limit` users farmed
     """
-    cursor = self.user_db.find({}, sort=[("farmed", -1)], limit=limit)
-    users = []
-    async for user in cursor:
-      users.append(User(**user))
-    return users
+    return [User(**user) for user in await self.backend.top_users("farmed", limit)]
   
   async def get_top_tokens_users(self, limit: int = 10) -> list[User]:
     """|coro|
 
     Returns a list of the top `limit` users with the most tokens
     """
-    cursor = self.user_db.find({}, sort=[("tokens", -1)], limit=limit)
-    users = []
-    async for user in cursor:
-      users.append(User(**user))
-    return users
+    return [User(**user) for user in await self.backend.top_users("tokens", limit)]
   
   async def get_top_lifetime_tokens_users(self, limit: int = 10) -> list[User]:
     """|coro|
 
     Returns a list of the top `limit` users with the most lifetime tokens
     """
-    cursor = self.user_db.find({}, sort=[("lifetime_tokens", -1)], limit=limit)
-    users = []
-    async for user in cursor:
-      users.append(User(**user))
-    return users
+    return [User(**user) for user in await self.backend.top_users("lifetime_tokens", limit)]
   
   def get_top_daily_farmed_servers(self, limit: int = 10) -> list[DailyFarmStats]:
     """Returns a list of the top `limit` servers farmed today"""
@@ -358,22 +771,41 @@ class ShroomFarm:
       await self.inc_user_tokens(user_id, amount)
     self.daily_stats.save_farm_stats(farm_stats)
 
+  async def _save_farmed(self, farm: Farm, user_id: int, amount: int, farmed_today: int, farmed_weekly: int) -> bool:
+    """Applies a farm of `amount` to `farm` and saves it
+
+    If another process wrote the farm in between, it is reloaded and the farm
+    applied again on top of what they wrote.
+    """
+    for _ in range(SAVE_ATTEMPTS):
+      farm.total_farmed += amount
+      farm.last_farmer = user_id
+      if farmed_today > farm.most_farmed_daily:
+        farm.most_farmed_daily = farmed_today
+      if farmed_weekly > farm.most_farmed_weekly:
+        farm.most_farmed_weekly = farmed_weekly
+      if await self.save_farm(farm):
+        return True
+      METRICS.inc("shroom.farm_conflicts")
+      if not await self.reload_farm(farm):
+        return False
+    _log.error(f"Gave up saving farm {farm._id} after {SAVE_ATTEMPTS} conflicting writes")
+    return False
+
   async def farm(self, farm: Farm, user_id: int, amount: int = 1) -> FarmResult:
+    new_day = farm._id not in self.daily_stats.farms
     farm_stats = self.daily_stats.inc_shroom_count(farm, user_id, amount)
+    if new_day:
+      self.rollovers.schedule(farm_stats.ends, farm._id) # type: ignore
 
-    farm.total_farmed += amount
-    farm.last_farmer = user_id
-
-    if farm_stats.farmed > farm.most_farmed_daily:
-      farm.most_farmed_daily = farm_stats.farmed
+    with METRICS.span("shroom.weekly_farmed"):
+      weekly = await self.get_server_weekly_farmed(farm._id)
 
-    # This is most definitely readable
-    if (weekly := await self.get_server_weekly_farmed(farm._id)) > farm.most_farmed_weekly:
-      # It might be inefficient to keep making a database call just to get the amount farmed weekly
-      # It will probably be wise to implement a cache system sometime in the future
-      farm.most_farmed_weekly = weekly
+    with METRICS.span("shroom.save_farm"):
+      await self._save_farmed(farm, user_id, amount, farm_stats.farmed, weekly)
 
-    user = await self.get_user(user_id) or await self.create_user(user_id)
+    with METRICS.span("shroom.get_user"):
+      user = await self.get_or_create_user(user_id)
     user.farmed += amount
     user.tokens += amount
     user.lifetime_tokens += amount
@@ -385,7 +817,8 @@ class ShroomFarm:
       user
     )
 
-    if user.ranked_up:
+    ranked_up = user.ranked_up
+    if ranked_up:
       user = user.update_rank()
       result.user_ranked_up = True
 
@@ -394,10 +827,14 @@ class ShroomFarm:
       farm_stats.daily_goal_reached,
       not farm_stats.awarded_daily
     )):
-      await self.award_contributors(farm_stats)
+      with METRICS.span("shroom.award_contributors"):
+        await self.award_contributors(farm_stats)
       result.awarding_daily = True
 
-    await self.save_user(user)
-    await self.save_farm(farm)
+    with METRICS.span("shroom.save_user"):
+      # Incremented rather than set, the user may be farming in a farm another process runs too
+      await self._inc_user(user_id, {"farmed": amount, "tokens": amount, "lifetime_tokens": amount})
+      if ranked_up:
+        await self.set_user_rank(user_id, user.rank_enum)
 
     return result
\ No newline at end of file
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, time, timedelta, timezone
 from typing import TYPE_CHECKING, TypedDict
+from zoneinfo import ZoneInfo
 
 
 class FarmDict(TypedDict):
@@ -18,10 +19,12 @@ class FarmDict(TypedDict):
   farm_channel: int | None
   daily_goal: int | None
   updated: datetime | None
+  version: int # Bumped by every write, missing on farms that were never written since it was added
+  timezone: str # IANA name, the farm's day starts at midnight there
 
 
 
-@dataclass
+@dataclass(slots=True)
 class Farm:
   _id: int
   total_farmed: int = 0
@@ -31,18 +34,29 @@ class Farm:
   farm_channel: int | None = None
   daily_goal: int | None = None
   updated: datetime = field(default_factory=datetime.utcnow)
+  version: int = 0
+  timezone: str = "UTC"
 
-  def to_dict(self, include_id=True, include_time=True) -> FarmDict:
+  def next_rollover(self, after: datetime) -> datetime:
+    """The first midnight in the farm's timezone after `after`, both naive UTC"""
+    local = after.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(self.timezone))
+    midnight = datetime.combine(local.date() + timedelta(days=1), time(), ZoneInfo(self.timezone))
+    return midnight.astimezone(timezone.utc).replace(tzinfo=None)
+
+  def to_dict(self, include_id=True, include_time=True, include_version=True) -> FarmDict:
     d = {
       "total_farmed": self.total_farmed,
       "most_farmed_daily": self.most_farmed_daily,
       "most_farmed_weekly": self.most_farmed_weekly,
       "last_farmer": self.last_farmer,
       "farm_channel": self.farm_channel,
-      "daily_goal": self.daily_goal
+      "daily_goal": self.daily_goal,
+      "timezone": self.timezone
     }
     if include_id:
       d["_id"] = self._id
     if include_time:
       d["updated"] = self.updated
+    if include_version:
+      d["version"] = self.version
     return d # type: ignore
\ No newline at end of file
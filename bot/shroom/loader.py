@@ -0,0 +1,143 @@
+"""
+Coalescing concurrent lookups into batched queries
+
+During a burst many tasks look up the same few users and farms at once.
+A `BatchLoader` queues every key asked for in the same event loop tick and
+fetches them with one `$in` query on the next, instead of one `find_one`
+each. A key that is already queued or being fetched is not asked for again,
+its callers wait on the same future. Each caller gets the document fanned
+back out to it, or `None` if there is none.
+
+Writes go around the loader, so anything that changes a document calls
+`forget` on it; the next lookup then starts a fresh fetch instead of joining
+one that may have been sent before the write.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections import Counter
+from typing import Any, Awaitable, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+MAX_BATCH = 500 # Keys per query, bigger batches are split
+
+
+class LoaderStats:
+  __slots__ = ("name", "loads", "deduped", "batches", "failed", "sizes")
+
+  def __init__(self, name: str):
+    self.name = name
+    self.reset()
+
+  def reset(self):
+    self.loads = 0 # Lookups asked for
+    self.deduped = 0 # Lookups that joined one already queued or in flight
+    self.batches = 0 # Queries sent
+    self.failed = 0 # Queries that raised
+    self.sizes: Counter[int] = Counter() # Keys per query -> number of queries
+
+  @property
+  def round_trips_saved(self) -> int:
+    return self.loads - self.batches
+
+  @property
+  def mean_batch_size(self) -> float:
+    keys = sum(size * n for size, n in self.sizes.items())
+    return keys / self.batches if self.batches else 0.0
+
+  def summary(self) -> str:
+    max_size = max(self.sizes, default=0)
+    return (
+      f"{self.name:<8}{self.loads:>8} lookups{self.batches:>8} queries{self.round_trips_saved:>8} saved"
+      f"{self.deduped:>8} deduped  batch mean {self.mean_batch_size:.1f} max {max_size}"
+      + (f"  {self.failed} failed" if self.failed else "")
+    )
+
+
+class BatchLoader(Generic[K]):
+  def __init__(
+      self,
+      name: str,
+      fetch: Callable[[list[K]], Awaitable[list[dict[str, Any]]]],
+      max_batch: int = MAX_BATCH
+  ):
+    self.fetch = fetch # Returns the documents that exist out of those asked for, in any order
+    self.max_batch = max_batch
+    self.stats = LoaderStats(name)
+    self._queued: dict[K, asyncio.Future] = {}
+    self._in_flight: dict[K, asyncio.Future] = {}
+    self._tasks: set[asyncio.Task] = set()
+
+  async def load(self, key: K) -> dict[str, Any] | None:
+    """|coro|
+
+    The document with `_id` `key`, or `None` if there is none
+    """
+    self.stats.loads += 1
+    future = self._queued.get(key) or self._in_flight.get(key)
+    if future is not None:
+      self.stats.deduped += 1
+      # A caller that gets cancelled must not cancel the lookup for everyone else
+      return await asyncio.shield(future)
+    self._queued[key] = future = asyncio.get_running_loop().create_future()
+    if len(self._queued) > 1:
+      return await asyncio.shield(future) # The first lookup of this tick sends the batch
+
+    # This is the first lookup of the tick, it sends the batch itself once
+    # everything else in this tick has queued up behind it
+    try:
+      await asyncio.sleep(0)
+    except asyncio.CancelledError:
+      self._dispatch()
+      raise
+    batches = self._take_batches()
+    for batch in batches[1:]:
+      self._spawn(batch)
+    await self._run(batches[0]) # Keys stay in the order they were asked for, so this one is in the first batch
+    return future.result()
+
+  def forget(self, key: K):
+    """Makes the next lookup of `key` fetch it again instead of joining a fetch already sent"""
+    self._in_flight.pop(key, None)
+
+  def _take_batches(self) -> list[dict[K, asyncio.Future]]:
+    queued, self._queued = self._queued, {}
+    keys = list(queued)
+    return [{key: queued[key] for key in keys[i:i + self.max_batch]} for i in range(0, len(keys), self.max_batch)]
+
+  def _dispatch(self):
+    for batch in self._take_batches():
+      self._spawn(batch)
+
+  def _spawn(self, batch: dict[K, asyncio.Future]):
+    task = asyncio.create_task(self._run(batch))
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+  async def _run(self, batch: dict[K, asyncio.Future]):
+    self._in_flight.update(batch)
+    self.stats.batches += 1
+    self.stats.sizes[len(batch)] += 1
+    try:
+      docs = await self.fetch(list(batch))
+    except asyncio.CancelledError:
+      # The lookup sending the batch was cancelled, the others still need theirs
+      self._spawn({key: future for key, future in batch.items() if not future.done()})
+      raise
+    except Exception as e:
+      self.stats.failed += 1
+      for future in batch.values():
+        if not future.done():
+          future.set_exception(e)
+          future.exception() # Callers that were cancelled won't retrieve it
+    else:
+      found = {d["_id"]: d for d in docs}
+      for key, future in batch.items():
+        if not future.done():
+          future.set_result(found.get(key))
+    finally:
+      for key, future in batch.items():
+        if self._in_flight.get(key) is future:
+          del self._in_flight[key]
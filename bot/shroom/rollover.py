@@ -0,0 +1,91 @@
+"""
+Scheduling when each farm's day ends
+
+A farm's day starts at midnight in its own timezone, so days end at all hours
+instead of all at 00:00 UTC. Every running farm day is in a min-heap keyed by
+when it ends, so finding the next one is O(1) and scheduling or ending one is
+O(log n), with n the number of farms that farmed today.
+
+The UTC day ends differently. The new `DailyStats` is swapped in without an
+await, so no farm event can land between the two days, and the day that
+ended is saved in the background. Until it is, it is kept in a journal file
+so a restart can still save it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable
+
+import bson
+
+from bot.shroom.stats import DailyStats
+
+
+class RolloverScheduler:
+  def __init__(self):
+    self._heap: list[tuple[datetime, int]] = [] # (ends, farm ID)
+    self.wake = asyncio.Event() # Set when a day that ends sooner than every other one is scheduled
+
+  def __len__(self) -> int:
+    return len(self._heap)
+
+  def schedule(self, ends: datetime, farm_id: int):
+    if not self._heap or ends < self._heap[0][0]:
+      self.wake.set()
+    heapq.heappush(self._heap, (ends, farm_id))
+
+  def reset(self, days: Iterable[tuple[datetime, int]]):
+    """Replaces everything scheduled with `days`, in O(n)"""
+    self._heap = list(days)
+    heapq.heapify(self._heap)
+    self.wake.set()
+
+  @property
+  def next_due(self) -> datetime | None:
+    return self._heap[0][0] if self._heap else None
+
+  def pop_due(self, now: datetime) -> list[tuple[datetime, int]]:
+    """Removes and returns every day that ended by `now`"""
+    due = []
+    while self._heap and self._heap[0][0] <= now:
+      due.append(heapq.heappop(self._heap))
+    return due
+
+
+@dataclass
+class PendingDay:
+  """A UTC day that ended but isn't saved yet"""
+  stats: DailyStats
+  clear: bool = False # Sundays clear the `Stats` collection instead of saving the day
+
+
+def write_journal(path: str, days: list[PendingDay]):
+  """Atomically writes `days` to the journal at `path`, removing it when there are none"""
+  if not days:
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+    return
+  data = bson.encode({"days": [{"stats": day.stats.to_dict(), "clear": day.clear} for day in days]})
+  tmp = f"{path}.tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, path)
+
+
+def read_journal(path: str) -> list[PendingDay]:
+  """The days in the journal at `path`, oldest first"""
+  try:
+    with open(path, "rb") as f:
+      data = bson.decode(f.read())
+  except FileNotFoundError:
+    return []
+  return [PendingDay(DailyStats.from_db(d["stats"]), d["clear"]) for d in data["days"]]
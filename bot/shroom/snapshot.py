@@ -0,0 +1,160 @@
+"""
+Snapshots of the in-memory farm state for fast restarts
+
+On shutdown today's stats, the farm cache and the weekly totals are written to
+a local file. The next start memory-maps it and only uses it when the header,
+checksum, source database and day all match and it is recent enough, otherwise
+everything is loaded from the database as usual.
+
+The file is a fixed header followed by a BSON payload:
+
+  magic    4s   b"SHRM"
+  version  H    `VERSION`, bumped whenever the payload changes shape
+  reserved H
+  created  d    Unix time the snapshot was written
+  day      I    Proleptic Gregorian ordinal of the day the stats belong to
+  length   Q    Length of the payload
+  digest   32s  BLAKE2b-256 of the payload
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+import bson
+
+from bot.shroom.farm import Farm
+from bot.shroom.stats import DailyStats, WeeklyTotals
+from bot.utils import int_key_to_str, str_key_to_int
+
+if TYPE_CHECKING:
+  from bot.shroom.core import ShroomFarm
+
+_log = logging.getLogger(__name__)
+
+MAGIC = b"SHRM"
+VERSION = 1
+HEADER = struct.Struct("<4sHHdIQ32s")
+
+
+class SnapshotError(Exception):
+  pass
+
+
+@dataclass
+class Snapshot:
+  created: float
+  daily_stats: DailyStats
+  farms: list[Farm]
+  weekly: WeeklyTotals
+
+
+def source_id(source: str) -> str:
+  """Identifies the database a snapshot belongs to without storing its URL, which may hold credentials"""
+  return hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+
+
+def encode(shroom_farm: ShroomFarm, source: str) -> bytes:
+  stats = shroom_farm.daily_stats
+  weekly = shroom_farm._weekly
+  if weekly is None or not shroom_farm._farms_warm:
+    raise SnapshotError("caches are not warm")
+
+  payload = bson.encode({
+    "source": source_id(source),
+    "daily_stats": {**stats.to_dict(), "_id": stats._id},
+    "farms": [farm.to_dict() for farm in shroom_farm.cached_farms()],
+    "weekly": {
+      "total": weekly.total,
+      "farms": int_key_to_str(weekly.farms),
+      "users": int_key_to_str(weekly.users)
+    }
+  })
+  header = HEADER.pack(
+    MAGIC, VERSION, 0, time.time(), stats.date.date().toordinal(),
+    len(payload), hashlib.blake2b(payload, digest_size=32).digest()
+  )
+  return header + payload
+
+
+def decode(data: bytes | memoryview | mmap.mmap, source: str, max_age: float) -> Snapshot:
+  """Validates and decodes a snapshot, raising `SnapshotError` when it can't be used"""
+  if len(data) < HEADER.size:
+    raise SnapshotError("file is too short")
+  magic, version, _, created, day, length, digest = HEADER.unpack_from(data)
+  if magic != MAGIC:
+    raise SnapshotError("not a snapshot")
+  if version != VERSION:
+    raise SnapshotError(f"version {version} is not supported")
+  age = time.time() - created
+  if not 0 <= age <= max_age:
+    raise SnapshotError(f"snapshot is {age:.0f}s old")
+
+  payload = memoryview(data)[HEADER.size:HEADER.size + length]
+  try:
+    if len(payload) != length:
+      raise SnapshotError("file is truncated")
+    if hashlib.blake2b(payload, digest_size=32).digest() != digest:
+      raise SnapshotError("checksum mismatch")
+    doc: dict[str, Any] = bson.decode(payload)
+  finally:
+    payload.release()
+
+  if doc["source"] != source_id(source):
+    raise SnapshotError("snapshot is from a different database")
+  stats = DailyStats.from_db(doc["daily_stats"])
+  if stats.date.date().toordinal() != day or not stats.is_today:
+    raise SnapshotError("snapshot is from another day")
+
+  weekly = doc["weekly"]
+  return Snapshot(
+    created,
+    stats,
+    [Farm(**farm) for farm in doc["farms"]],
+    WeeklyTotals(
+      weekly["total"],
+      Counter(str_key_to_int(weekly["farms"])),
+      Counter(str_key_to_int(weekly["users"]))
+    )
+  )
+
+
+def write(path: str, shroom_farm: ShroomFarm, source: str):
+  """Atomically writes a snapshot of `shroom_farm` to `path`"""
+  data = encode(shroom_farm, source)
+  tmp = f"{path}.tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, path)
+
+
+def load(path: str, source: str, max_age: float) -> Snapshot | None:
+  """Reads and deletes the snapshot at `path`, returning `None` if there is none or it can't be used
+
+  Deleting it means only a clean shutdown leaves one behind, so the state
+  from before a crash is never picked up.
+  """
+  try:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      return decode(data, source, max_age)
+  except FileNotFoundError:
+    return None
+  except (SnapshotError, ValueError, KeyError, TypeError, bson.errors.BSONError) as e:
+    # An empty file can't be mapped, which raises ValueError too
+    _log.warning(f"Ignoring snapshot `{path}`: {e}")
+    return None
+  finally:
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+from collections import Counter
 from dataclasses import dataclass, field
 from datetime import datetime, date
-from typing import TYPE_CHECKING, TypedDict
+from typing import TYPE_CHECKING, Any, Mapping, TypedDict
 
+import bson
 from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
 
 from bot.utils import str_key_to_int, int_key_to_str
 
@@ -17,22 +20,33 @@ class DailyFarmStatsDict(TypedDict):
   daily_goal: int | None
   awarded_daily: bool
   contributors: dict[str, int]
+  ends: datetime | None # When the farm's day ends, naive UTC
 
 class DailyStatsDict(TypedDict):
   date: datetime
   total: int
-  farms: dict[str, DailyFarmStatsDict]
+  farms: dict[str, DailyFarmStatsDict] # Farm days that ended on this day, what weekly totals count
+  open: dict[str, DailyFarmStatsDict] # Farm days still running, missing on stats from before farms rolled over on their own
   users: dict[str, int]
+  # process: str, only set on the stats of a process in a cluster
 
 
 
-@dataclass
+def _decoded(d: Mapping[str, Any]) -> dict[str, Any]:
+  # The Mongo backend hands back stats as `RawBSONDocument`s, which decode
+  # field by field in Python. A map that is read whole decodes much faster
+  # in one go with the C decoder.
+  return bson.decode(d.raw) if isinstance(d, RawBSONDocument) else d # type: ignore
+
+
+@dataclass(slots=True)
 class DailyFarmStats:
   id: int
   farmed: int = 0
   daily_goal: int | None = None
   awarded_daily: bool = False # This is needed to ensure we don't award contributors twice
   contributors: dict[int, int] = field(default_factory=dict)
+  ends: datetime | None = None
 
   @classmethod
   def from_db(cls, d: DailyFarmStatsDict):
@@ -41,7 +55,8 @@ class DailyFarmStats:
       farmed=d["farmed"],
       daily_goal=d["daily_goal"],
       awarded_daily=d["awarded_daily"],
-      contributors=str_key_to_int(d["contributors"])
+      contributors=str_key_to_int(d["contributors"]),
+      ends=d.get("ends")
     )
 
   @property
@@ -61,28 +76,45 @@ class DailyFarmStats:
       "farmed": self.farmed,
       "daily_goal": self.daily_goal,
       "awarded_daily": self.awarded_daily,
-      "contributors": int_key_to_str(self.contributors)
+      "contributors": int_key_to_str(self.contributors),
+      "ends": self.ends
     }
 
 
 
-@dataclass
+@dataclass(slots=True)
 class DailyStats:
+  """The stats of one UTC day
+
+  Each farm's day runs from midnight to midnight in its own timezone, so
+  `farms` holds the farm days still running, which carry over into the next
+  `DailyStats`, and `closed` the ones that ended during this day.
+  """
   date: datetime = field(default_factory=datetime.utcnow)
   total: int = 0
   farms: dict[int, DailyFarmStatsDict] = field(default_factory=dict)
   users: dict[int, int] = field(default_factory=dict)
+  closed: dict[int, DailyFarmStatsDict] = field(default_factory=dict)
   _id: ObjectId | None = None
+  process: str | None = None # In a cluster every process keeps the stats of its own farms
 
   @classmethod
   def from_db(cls, d: DailyStatsDict):
-    return cls(
+    stats = cls(
       date=d["date"],
       total=d["total"],
-      farms=str_key_to_int(d["farms"]),
-      users=str_key_to_int(d["users"]),
-      _id=d.get("_id")
+      farms=str_key_to_int(_decoded(d.get("open", {}))),
+      users=str_key_to_int(_decoded(d["users"])),
+      closed=str_key_to_int(_decoded(d["farms"])),
+      _id=d.get("_id"),
+      process=d.get("process")
     )
+    if "open" not in d and stats.is_today:
+      # Before farms rolled over on their own, every farm day ran until the UTC
+      # day did, so today's are still running. Ending them now would award
+      # their goals a second time.
+      stats.farms, stats.closed = stats.closed, stats.farms
+    return stats
 
   @property
   def is_today(self) -> bool:
@@ -96,7 +128,23 @@ class DailyStats:
       return DailyFarmStats.from_db(farm)
     
   def save_farm_stats(self, farm_stats: DailyFarmStats):
-    self.farms[farm_stats.id] = farm_stats.to_dict()
+    # The farm's day may have ended while its contributors were being awarded
+    farms = self.farms if farm_stats.id in self.farms or farm_stats.id not in self.closed else self.closed
+    farms[farm_stats.id] = farm_stats.to_dict()
+
+  def close_farm(self, farm_id: int) -> DailyFarmStats | None:
+    """Ends the farm's day, its next farm starts a new one"""
+    d = self.farms.pop(farm_id, None)
+    if d is None:
+      return None
+    farm_stats = DailyFarmStats.from_db(d)
+    earlier = self.closed.get(farm_id)
+    if earlier is not None:
+      # Two of the farm's days can end on one UTC day when its clocks go back
+      farm_stats.farmed += earlier["farmed"]
+      farm_stats.contributors = dict(Counter(str_key_to_int(earlier["contributors"])) + Counter(farm_stats.contributors))
+    self.closed[farm_id] = farm_stats.to_dict()
+    return farm_stats
     
   def get_user_farmed(self, user_id: int) -> int:
     return self.users.get(user_id, 0)
@@ -104,7 +152,11 @@ class DailyStats:
   def inc_shroom_count(self, farm: Farm, user_id: int, amount: int = 1) -> DailyFarmStats:
     self.total += amount
 
-    farm_stats = self.get_farm_stats(farm._id) or DailyFarmStats(farm._id, daily_goal=farm.daily_goal)
+    farm_stats = self.get_farm_stats(farm._id) or DailyFarmStats(
+      farm._id,
+      daily_goal=farm.daily_goal,
+      ends=farm.next_rollover(datetime.utcnow())
+    )
     if not farm_stats.daily_goal_reached and farm_stats.daily_goal is not None:
       amt = min(
         farm_stats.daily_goal-farm_stats.farmed,
@@ -125,9 +177,27 @@ class DailyStats:
     return farm_stats
 
   def to_dict(self) -> DailyStatsDict:
-    return {
+    d = {
       "date": self.date,
       "total": self.total,
-      "farms": int_key_to_str(self.farms),
+      "farms": int_key_to_str(self.closed),
+      "open": int_key_to_str(self.farms),
       "users": int_key_to_str(self.users)
-    }
\ No newline at end of file
+    }
+    if self.process is not None:
+      d["process"] = self.process
+    return d # type: ignore
+
+
+@dataclass(slots=True)
+class WeeklyTotals:
+  """How much was farmed this week before today, so weekly lookups don't have to scan `Stats`"""
+  total: int = 0
+  farms: Counter[int] = field(default_factory=Counter)
+  users: Counter[int] = field(default_factory=Counter)
+
+  def add(self, stats: DailyStats):
+    self.total += stats.total
+    for farm_id, farm_stats in stats.closed.items():
+      self.farms[farm_id] += farm_stats["farmed"]
+    self.users.update(stats.users)
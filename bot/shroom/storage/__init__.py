@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+
+from bot.shroom.storage.base import StorageBackend
+from bot.shroom.storage.memory import MemoryBackend
+from bot.shroom.storage.mongo import MongoBackend
+from bot.shroom.storage.monitoring import COMMANDS
+from bot.shroom.storage.sqlite import SQLiteBackend
+
+if TYPE_CHECKING:
+  from bot.config import Config
+
+__all__ = (
+  "StorageBackend",
+  "MemoryBackend",
+  "MongoBackend",
+  "SQLiteBackend",
+  "create_backend",
+  "mongo_options"
+)
+
+
+def mongo_options(config: Config) -> dict[str, Any]:
+  """Motor client options from `config`, the ones left at `None` come from `MONGO_URL` or pymongo's defaults"""
+  options: dict[str, Any] = {
+    "maxPoolSize": config.mongo_max_pool_size,
+    "minPoolSize": config.mongo_min_pool_size,
+    "serverSelectionTimeoutMS": config.mongo_server_selection_timeout_ms,
+    "connectTimeoutMS": config.mongo_connect_timeout_ms,
+    "maxIdleTimeMS": config.mongo_max_idle_ms,
+    "waitQueueTimeoutMS": config.mongo_wait_queue_timeout_ms,
+    "socketTimeoutMS": config.mongo_socket_timeout_ms,
+    "compressors": config.mongo_compressors,
+    "w": config.mongo_write_concern
+  }
+  return {k: v for k, v in options.items() if v is not None}
+
+
+def create_backend(config: Config) -> StorageBackend:
+  """Creates the storage backend selected by `config.storage_backend`"""
+  kind = config.storage_backend.lower()
+  if kind == "mongo":
+    COMMANDS.slow_ms = config.slow_query_ms
+    return MongoBackend(config.mongo_url, config.mongo_database, **mongo_options(config))
+  elif kind == "memory":
+    return MemoryBackend()
+  elif kind == "sqlite":
+    return SQLiteBackend(config.sqlite_path)
+  raise ValueError(f"unknown storage backend `{config.storage_backend}`")
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, AsyncIterator, Protocol, runtime_checkable
+
+if TYPE_CHECKING:
+  from bson import ObjectId
+
+  from bot.shroom.farm import FarmDict
+  from bot.shroom.stats import DailyStatsDict
+  from bot.shroom.user import UserDict
+
+
+@runtime_checkable
+class StorageBackend(Protocol):
+  """The storage operations that `ShroomFarm` needs from a database
+
+  Every method works on plain documents (the `*Dict` types), building
+  the model objects is left to `ShroomFarm`. All backends are expected
+  to behave exactly like the Mongo one, including which updates count
+  as "modified".
+  """
+
+  async def connect(self) -> None:
+    """Connects and makes sure the database is reachable"""
+    ...
+
+  async def close(self) -> None:
+    ...
+
+  # Farms
+
+  async def find_farm(self, farm_id: int) -> FarmDict | None:
+    ...
+
+  async def find_farms(self, farm_ids: list[int]) -> list[FarmDict]:
+    """The farms of `farm_ids` that exist, in any order"""
+    ...
+
+  async def insert_farm(self, farm: FarmDict) -> None:
+    ...
+
+  async def update_farm(self, farm_id: int, fields: dict[str, Any], version: int | None = None) -> bool:
+    """Sets `fields` on the farm, stamps its `updated` time and bumps its `version`
+
+    With `version`, the farm is only updated if that is still its version
+    (a missing version counts as 0), so an update based on a stale read fails
+    instead of overwriting someone else's.
+    """
+    ...
+
+  async def top_farms(self, key: str, limit: int) -> list[FarmDict]:
+    ...
+
+  def iter_farms(self) -> AsyncIterator[FarmDict]:
+    ...
+
+  # Users
+
+  async def find_user(self, user_id: int) -> UserDict | None:
+    ...
+
+  async def find_users(self, user_ids: list[int]) -> list[UserDict]:
+    """The users of `user_ids` that exist, in any order"""
+    ...
+
+  async def insert_user(self, user: UserDict) -> None:
+    ...
+
+  async def update_user(self, user_id: int, fields: dict[str, Any]) -> bool:
+    ...
+
+  async def inc_user(self, user_id: int, fields: dict[str, int]) -> bool:
+    ...
+
+  async def top_users(self, key: str, limit: int) -> list[UserDict]:
+    ...
+
+  # Stats
+
+  async def latest_stats(self, process: str | None = None) -> DailyStatsDict | None:
+    """The most recently inserted stats, only counting those of `process` if given"""
+    ...
+
+  async def insert_stats(self, stats: DailyStatsDict) -> ObjectId:
+    ...
+
+  async def replace_stats(self, stats_id: ObjectId, stats: DailyStatsDict) -> bool:
+    ...
+
+  async def clear_stats(self) -> None:
+    ...
+
+  def iter_stats(self, projection: tuple[str, ...] | None = None) -> AsyncIterator[DailyStatsDict]:
+    ...
+
+
+def normalise_datetime(dt: datetime) -> datetime:
+  """Stores a datetime the way BSON does, naive UTC with millisecond precision"""
+  if dt.tzinfo is not None:
+    dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+  return dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+
+
+def normalise_document(d: dict[str, Any]) -> dict[str, Any]:
+  """Returns a copy of `d` that looks like it has been round tripped through BSON"""
+  out = {}
+  for k, v in d.items():
+    if isinstance(v, dict):
+      v = normalise_document(v)
+    elif isinstance(v, datetime):
+      v = normalise_datetime(v)
+    out[k] = v
+  return out
+
+
+def project(d: dict[str, Any], projection: tuple[str, ...] | None) -> dict[str, Any]:
+  """Keeps `_id` and the fields in `projection`, which can be dotted paths into nested documents like in Mongo"""
+  if projection is None:
+    return d
+  out = {"_id": d["_id"]} if "_id" in d else {}
+  for path in projection:
+    src, dst = d, out
+    *parents, name = path.split(".")
+    for key in parents:
+      src = src.get(key)
+      if not isinstance(src, dict):
+        break
+      dst = dst.setdefault(key, {})
+    else:
+      if name in src:
+        dst[name] = src[name]
+  return out
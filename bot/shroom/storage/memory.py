@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, AsyncIterator
+
+from bson import ObjectId
+
+from bot.errors import DuplicateDocument
+from bot.shroom.storage.base import normalise_datetime, normalise_document, project
+
+if TYPE_CHECKING:
+  from bot.shroom.farm import FarmDict
+  from bot.shroom.stats import DailyStatsDict
+  from bot.shroom.user import UserDict
+
+
+class MemoryBackend:
+  """Keeps every document in plain dictionaries
+
+  Nothing is persisted, this is meant for benchmarks and throwaway deployments.
+  Documents are copied on the way in and out so callers can never mutate
+  the stored state, the same as with a real database.
+  """
+
+  def __init__(self):
+    self.farms: dict[int, dict[str, Any]] = {}
+    self.users: dict[int, dict[str, Any]] = {}
+    self.stats: dict[ObjectId, dict[str, Any]] = {} # Insertion order is the natural order
+
+  async def connect(self) -> None:
+    pass
+
+  async def close(self) -> None:
+    pass
+
+
+
+  async def find_farm(self, farm_id: int) -> FarmDict | None:
+    farm = self.farms.get(farm_id)
+    return normalise_document(farm) if farm is not None else None # type: ignore
+
+  async def find_farms(self, farm_ids: list[int]) -> list[FarmDict]:
+    return [normalise_document(self.farms[i]) for i in farm_ids if i in self.farms] # type: ignore
+
+  async def insert_farm(self, farm: FarmDict) -> None:
+    if farm["_id"] in self.farms:
+      raise DuplicateDocument(f"farm with ID `{farm['_id']}` already exists")
+    self.farms[farm["_id"]] = normalise_document(farm) # type: ignore
+
+  async def update_farm(self, farm_id: int, fields: dict[str, Any], version: int | None = None) -> bool:
+    farm = self.farms.get(farm_id)
+    if farm is None:
+      return False
+    current = farm.get("version") or 0
+    if version is not None and current != version:
+      return False
+    farm.update(normalise_document(fields))
+    farm["version"] = current + 1
+    farm["updated"] = normalise_datetime(datetime.utcnow())
+    return True
+
+  async def top_farms(self, key: str, limit: int) -> list[FarmDict]:
+    farms = sorted(self.farms.values(), key=lambda d: (-d.get(key, 0), d["_id"]))[:limit]
+    return [normalise_document(farm) for farm in farms] # type: ignore
+
+  async def iter_farms(self) -> AsyncIterator[FarmDict]:
+    for farm in list(self.farms.values()):
+      yield normalise_document(farm) # type: ignore
+
+
+
+  async def find_user(self, user_id: int) -> UserDict | None:
+    user = self.users.get(user_id)
+    return normalise_document(user) if user is not None else None # type: ignore
+
+  async def find_users(self, user_ids: list[int]) -> list[UserDict]:
+    return [normalise_document(self.users[i]) for i in user_ids if i in self.users] # type: ignore
+
+  async def insert_user(self, user: UserDict) -> None:
+    if user["_id"] in self.users:
+      raise DuplicateDocument(f"user with ID `{user['_id']}` already exists")
+    self.users[user["_id"]] = normalise_document(user) # type: ignore
+
+  async def update_user(self, user_id: int, fields: dict[str, Any]) -> bool:
+    user = self.users.get(user_id)
+    if user is None:
+      return False
+    fields = normalise_document(fields)
+    if all(user.get(k) == v for k, v in fields.items()):
+      # Mongo does not count no-op updates as modified
+      return False
+    user.update(fields)
+    return True
+
+  async def inc_user(self, user_id: int, fields: dict[str, int]) -> bool:
+    user = self.users.get(user_id)
+    if user is None:
+      return False
+    for k, v in fields.items():
+      user[k] = user.get(k, 0) + v
+    return any(fields.values())
+
+  async def top_users(self, key: str, limit: int) -> list[UserDict]:
+    users = sorted(self.users.values(), key=lambda d: (-d.get(key, 0), d["_id"]))[:limit]
+    return [normalise_document(user) for user in users] # type: ignore
+
+
+
+  async def latest_stats(self, process: str | None = None) -> DailyStatsDict | None:
+    for stats in reversed(self.stats.values()):
+      if process is None or stats.get("process") == process:
+        return normalise_document(stats) # type: ignore
+    return None
+
+  async def insert_stats(self, stats: DailyStatsDict) -> ObjectId:
+    stats_id = stats.get("_id") or ObjectId() # type: ignore
+    if stats_id in self.stats:
+      raise DuplicateDocument(f"stats with ID `{stats_id}` already exists")
+    self.stats[stats_id] = {**normalise_document(stats), "_id": stats_id} # type: ignore
+    return stats_id
+
+  async def replace_stats(self, stats_id: ObjectId, stats: DailyStatsDict) -> bool:
+    old = self.stats.get(stats_id)
+    if old is None:
+      return False
+    new = {**normalise_document(stats), "_id": stats_id} # type: ignore
+    self.stats[stats_id] = new
+    return new != old
+
+  async def clear_stats(self) -> None:
+    self.stats.clear()
+
+  async def iter_stats(self, projection: tuple[str, ...] | None = None) -> AsyncIterator[DailyStatsDict]:
+    for stats in list(self.stats.values()):
+      yield project(normalise_document(stats), projection) # type: ignore
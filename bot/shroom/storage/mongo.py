@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, AsyncIterator
+
+from bson.raw_bson import RawBSONDocument
+from motor import motor_asyncio
+from pymongo.errors import DuplicateKeyError
+
+from bot.errors import DuplicateDocument
+from bot.shroom.storage.monitoring import COMMANDS, POOL
+from bot.tracing import trace_id
+
+if TYPE_CHECKING:
+  from bson import ObjectId
+
+  from bot.shroom.farm import FarmDict
+  from bot.shroom.stats import DailyStatsDict
+  from bot.shroom.user import UserDict
+
+
+def redact_url(url: str) -> str:
+  """Only the scheme and hosts of a connection string, which is safe to log
+
+  The user info holds the password, and options like `authMechanismProperties`
+  can hold secrets too.
+  """
+  scheme, sep, rest = url.partition("://")
+  if not sep:
+    return url.rpartition("@")[2] # A bare host
+  hosts = rest.partition("/")[0].partition("?")[0].rpartition("@")[2]
+  return f"{scheme}://{hosts}"
+
+
+class MongoBackend:
+  """Stores everything in the `ShroomDB` database of a MongoDB server"""
+
+  def __init__(self, url: str = "localhost", database: str = "ShroomDB", monitor: bool = True, **client_kwargs: Any):
+    self.db_url = url
+    if monitor:
+      # Process-wide, a client that must not show up in `$queries` and `$pool` turns this off
+      client_kwargs.setdefault("event_listeners", []).extend((COMMANDS, POOL))
+    self._db_client = motor_asyncio.AsyncIOMotorClient(url, **client_kwargs)
+    self.shroom_db: motor_asyncio.AsyncIOMotorDatabase = self._db_client[database]
+
+    self.farm_db: motor_asyncio.AsyncIOMotorCollection = self.shroom_db["Farm"]
+    self.user_db: motor_asyncio.AsyncIOMotorCollection = self.shroom_db["Users"]
+    self.stats_db: motor_asyncio.AsyncIOMotorCollection = self.shroom_db["Stats"]
+    # Stats documents hold every farm and user that farmed that day, but most
+    # reads of the latest one only look at its `_id` and `date`. Read raw, the
+    # rest of it is never decoded.
+    self.raw_stats_db: motor_asyncio.AsyncIOMotorCollection = self.stats_db.with_options(
+      codec_options=self.stats_db.codec_options.with_options(document_class=RawBSONDocument)
+    )
+
+  async def connect(self) -> None:
+    # Motor connects lazily, so this makes sure the server is actually there
+    await self._db_client.admin.command("ping")
+
+  async def close(self) -> None:
+    self._db_client.close()
+
+  async def drop(self) -> None:
+    """Drops the whole database, for throwaway ones like the load test's"""
+    await self._db_client.drop_database(self.shroom_db.name)
+
+
+
+  async def find_farm(self, farm_id: int) -> FarmDict | None:
+    return await self.farm_db.find_one({"_id": farm_id}, comment=trace_id.get())
+
+  async def find_farms(self, farm_ids: list[int]) -> list[FarmDict]:
+    cursor = self.farm_db.find({"_id": {"$in": farm_ids}}, batch_size=len(farm_ids), comment=trace_id.get())
+    return [farm async for farm in cursor]
+
+  async def insert_farm(self, farm: FarmDict) -> None:
+    try:
+      await self.farm_db.insert_one(farm, comment=trace_id.get())
+    except DuplicateKeyError as e:
+      raise DuplicateDocument(f"farm with ID `{farm['_id']}` already exists") from e
+
+  async def update_farm(self, farm_id: int, fields: dict[str, Any], version: int | None = None) -> bool:
+    query: dict[str, Any] = {"_id": farm_id}
+    if version is not None:
+      # `None` also matches farms that don't have a version yet
+      query["version"] = version if version else {"$in": [0, None]}
+    result = await self.farm_db.update_one(
+      query,
+      {
+        "$set": fields,
+        "$inc": {"version": 1},
+        "$currentDate": {"updated": True}
+      },
+      comment=trace_id.get()
+    )
+    return result.modified_count == 1
+
+  async def top_farms(self, key: str, limit: int) -> list[FarmDict]:
+    cursor = self.farm_db.find({}, sort=[(key, -1), ("_id", 1)], limit=limit, comment=trace_id.get())
+    return [farm async for farm in cursor]
+
+  async def iter_farms(self) -> AsyncIterator[FarmDict]:
+    async for farm in self.farm_db.find({}, batch_size=1000, comment=trace_id.get()):
+      yield farm
+
+
+
+  async def find_user(self, user_id: int) -> UserDict | None:
+    return await self.user_db.find_one({"_id": user_id}, comment=trace_id.get())
+
+  async def find_users(self, user_ids: list[int]) -> list[UserDict]:
+    cursor = self.user_db.find({"_id": {"$in": user_ids}}, batch_size=len(user_ids), comment=trace_id.get())
+    return [user async for user in cursor]
+
+  async def insert_user(self, user: UserDict) -> None:
+    try:
+      await self.user_db.insert_one(user, comment=trace_id.get())
+    except DuplicateKeyError as e:
+      raise DuplicateDocument(f"user with ID `{user['_id']}` already exists") from e
+
+  async def update_user(self, user_id: int, fields: dict[str, Any]) -> bool:
+    result = await self.user_db.update_one({"_id": user_id}, {"$set": fields}, comment=trace_id.get())
+    return result.modified_count == 1
+
+  async def inc_user(self, user_id: int, fields: dict[str, int]) -> bool:
+    result = await self.user_db.update_one({"_id": user_id}, {"$inc": fields}, comment=trace_id.get())
+    return result.modified_count == 1
+
+  async def top_users(self, key: str, limit: int) -> list[UserDict]:
+    cursor = self.user_db.find({}, sort=[(key, -1), ("_id", 1)], limit=limit, comment=trace_id.get())
+    return [user async for user in cursor]
+
+
+
+  async def latest_stats(self, process: str | None = None) -> DailyStatsDict | None:
+    query = {"process": process} if process is not None else {}
+    return await self.raw_stats_db.find_one(query, sort=[("$natural", -1)], comment=trace_id.get())
+
+  async def insert_stats(self, stats: DailyStatsDict) -> ObjectId:
+    result = await self.stats_db.insert_one(stats, comment=trace_id.get())
+    return result.inserted_id
+
+  async def replace_stats(self, stats_id: ObjectId, stats: DailyStatsDict) -> bool:
+    result = await self.stats_db.replace_one({"_id": stats_id}, stats, comment=trace_id.get())
+    return result.modified_count == 1
+
+  async def clear_stats(self) -> None:
+    await self.stats_db.delete_many({}, comment=trace_id.get())
+
+  async def iter_stats(self, projection: tuple[str, ...] | None = None) -> AsyncIterator[DailyStatsDict]:
+    async for stats in self.stats_db.find({}, projection=projection, comment=trace_id.get()):
+      yield stats
+
+
+
+  async def explain(self, method: str) -> dict[str, Any]:
+    """|coro|
+
+    Runs `explain` on the query behind the `ShroomFarm` method named `method`
+    """
+    try:
+      collection, command = EXPLAINABLE[method]
+    except KeyError:
+      raise ValueError(f"no query is known for `{method}`") from None
+    return await self.shroom_db.command({
+      "explain": {command[0]: collection, **command[1]},
+      "verbosity": "executionStats"
+    })
+
+
+def _leaderboard(collection: str, key: str) -> tuple[str, tuple[str, dict[str, Any]]]:
+  return collection, ("find", {"filter": {}, "sort": {key: -1, "_id": 1}, "limit": 10})
+
+def _by_id(collection: str) -> tuple[str, tuple[str, dict[str, Any]]]:
+  return collection, ("find", {"filter": {"_id": 0}, "limit": 1})
+
+def _by_ids(collection: str) -> tuple[str, tuple[str, dict[str, Any]]]:
+  return collection, ("find", {"filter": {"_id": {"$in": [0, 1]}}})
+
+def _update_by_id(collection: str) -> tuple[str, tuple[str, dict[str, Any]]]:
+  return collection, ("update", {"updates": [{"q": {"_id": 0}, "u": {"$inc": {"explain": 0}}}]})
+
+def _scan_stats(field: str) -> tuple[str, tuple[str, dict[str, Any]]]:
+  return "Stats", ("find", {"filter": {}, "projection": {field: 1}})
+
+# `ShroomFarm` method -> (collection, (command, arguments)) of the query it makes
+EXPLAINABLE: dict[str, tuple[str, tuple[str, dict[str, Any]]]] = {
+  "get_farm": _by_ids("Farm"), # Batched by `BatchLoader`
+  "save_farm": ("Farm", ("update", {"updates": [{"q": {"_id": 0, "version": 0}, "u": {"$inc": {"version": 1}}}]})),
+  "reload_farm": _by_id("Farm"),
+  "get_user": _by_ids("Users"),
+  "save_user": _update_by_id("Users"),
+  "get_latest_daily_stats": ("Stats", ("find", {"filter": {}, "sort": {"$natural": -1}, "limit": 1})),
+  "get_total_weekly_farmed": _scan_stats("total"),
+  "get_server_weekly_farmed": _scan_stats("farms.0"),
+  "get_user_weekly_farmed": _scan_stats("users.0"),
+  "get_server_contributors": _scan_stats("farms.0"),
+  "get_top_lifetime_farmed_servers": _leaderboard("Farm", "total_farmed"),
+  "get_top_most_daily_farmed_servers": _leaderboard("Farm", "most_farmed_daily"),
+  "get_top_weekly_farmed_servers": _leaderboard("Farm", "most_farmed_weekly"),
+  "get_top_lifetime_farmed_users": _leaderboard("Users", "farmed"),
+  "get_top_tokens_users": _leaderboard("Users", "tokens"),
+  "get_top_lifetime_tokens_users": _leaderboard("Users", "lifetime_tokens")
+}
+
+
+def summarise_plan(explain: dict[str, Any]) -> str:
+  """Turns the output of `explain` into a few readable lines"""
+  planner = explain.get("queryPlanner", {})
+  plan = planner.get("winningPlan", {})
+  plan = plan.get("queryPlan", plan) # Newer servers nest the classic plan here
+
+  stages = []
+  while plan:
+    stage = plan.get("stage", "?")
+    if plan.get("indexName"):
+      stage += f"({plan['indexName']})"
+    stages.append(stage)
+    plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+
+  lines = [
+    f"Namespace: {planner.get('namespace')}",
+    f"Plan: {' <- '.join(stages) or 'unknown'}"
+  ]
+  stats = explain.get("executionStats")
+  if stats:
+    lines.append(
+      f"Returned {stats.get('nReturned')} docs, examined {stats.get('totalKeysExamined')} keys "
+      f"and {stats.get('totalDocsExamined')} docs in {stats.get('executionTimeMillis')}ms"
+    )
+  if "COLLSCAN" in stages:
+    lines.append("Warning: this query scans the whole collection")
+  return "\n".join(lines)
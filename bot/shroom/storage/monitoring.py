@@ -0,0 +1,292 @@
+"""
+MongoDB command and connection pool monitoring
+
+`CommandMonitor` is registered on the motor client as a pymongo
+`CommandListener`. It aggregates latency per command shape, meaning the
+command, collection and filter with every value replaced by `?`, logs
+commands slower than a threshold and counts round trips per traced event.
+
+`PoolMonitor` is registered as a `ConnectionPoolListener`. It times how long
+each command waits to check a connection out of the pool, tracks how close
+every server's pool is to `maxPoolSize` and counts connections opened and
+closed, so a pool that is too small or keeps reconnecting shows up.
+
+pymongo calls listeners from motor's worker threads, so everything here is
+guarded by a lock. Traces are matched up through the `comment` that
+`MongoBackend` attaches to every command.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+from collections import Counter
+from time import perf_counter
+from typing import Any
+
+from pymongo import monitoring
+
+from bot.metrics import Histogram
+
+_log = logging.getLogger(__name__)
+
+MAX_SHAPES = 256
+MAX_TRACES = 4096
+
+# Where the filter lives in each command we send
+_FILTER_PATHS = {
+  "find": lambda c: c.get("filter"),
+  "update": lambda c: c["updates"][0].get("q") if c.get("updates") else None,
+  "delete": lambda c: c["deletes"][0].get("q") if c.get("deletes") else None,
+  "findAndModify": lambda c: c.get("query"),
+  "count": lambda c: c.get("query"),
+  "aggregate": lambda c: c.get("pipeline")
+}
+
+
+def query_shape(value: Any) -> Any:
+  """Replaces every value in a filter with `?`, keeping keys and operators"""
+  if isinstance(value, dict):
+    return {k: query_shape(v) for k, v in value.items()}
+  if isinstance(value, (list, tuple)):
+    return [query_shape(v) for v in value]
+  return "?"
+
+
+def command_shape(command_name: str, command: dict[str, Any]) -> str:
+  collection = command.get(command_name)
+  shape = f"{command_name} {collection}" if isinstance(collection, str) else command_name
+  get_filter = _FILTER_PATHS.get(command_name)
+  if get_filter is not None:
+    filter_ = get_filter(command)
+    if filter_ is not None:
+      shape += f" {query_shape(filter_)}"
+  if command.get("sort"):
+    shape += f" sort={list(command['sort'].keys())}"
+  return shape
+
+
+class CommandStats:
+  __slots__ = ("latency", "failures")
+
+  def __init__(self, shape: str):
+    self.latency = Histogram(shape)
+    self.failures = 0
+
+
+class CommandMonitor(monitoring.CommandListener):
+  def __init__(self, slow_ms: int = 100):
+    self.slow_ms = slow_ms
+    self.shapes: dict[str, CommandStats] = {}
+    self._pending: dict[tuple[Any, int], tuple[str, str | None]] = {}
+    self._traces: Counter[str] = Counter()
+    self.round_trips: Counter[int] = Counter() # Round trips per event -> number of events
+    self._lock = threading.Lock()
+
+  def _stats(self, shape: str) -> CommandStats:
+    stats = self.shapes.get(shape)
+    if stats is None:
+      if len(self.shapes) >= MAX_SHAPES:
+        shape = "other"
+        stats = self.shapes.get(shape)
+      if stats is None:
+        self.shapes[shape] = stats = CommandStats(shape)
+    return stats
+
+  def started(self, event: monitoring.CommandStartedEvent):
+    command = event.command
+    shape = command_shape(event.command_name, command)
+    comment = command.get("comment")
+    trace = comment if isinstance(comment, str) else None
+    with self._lock:
+      self._pending[(event.connection_id, event.request_id)] = (shape, trace)
+      if trace is not None:
+        self._traces[trace] += 1
+        if len(self._traces) > MAX_TRACES:
+          # Traces nobody ended, drop the oldest
+          del self._traces[next(iter(self._traces))]
+
+  def succeeded(self, event: monitoring.CommandSucceededEvent):
+    with self._lock:
+      pending = self._pending.pop((event.connection_id, event.request_id), None)
+      if pending is None:
+        return
+      shape, trace = pending
+      self._stats(shape).latency.observe(event.duration_micros / 1_000_000)
+    ms = event.duration_micros / 1000
+    # Listeners run on motor's threads, so the trace id is passed along explicitly
+    if ms >= self.slow_ms:
+      _log.warning(f"Slow query ({ms:.1f}ms): {shape}", extra={"trace_id": trace})
+    else:
+      _log.debug("Query took %.2fms: %s", ms, shape, extra={"trace_id": trace})
+
+  def failed(self, event: monitoring.CommandFailedEvent):
+    with self._lock:
+      pending = self._pending.pop((event.connection_id, event.request_id), None)
+      if pending is not None:
+        self._stats(pending[0]).failures += 1
+
+  def end_trace(self, trace: str) -> int:
+    """Stops counting round trips for `trace` and returns how many it made"""
+    with self._lock:
+      trips = self._traces.pop(trace, 0)
+      if trips:
+        self.round_trips[trips] += 1
+    return trips
+
+  def reset(self):
+    with self._lock:
+      self.shapes.clear()
+      self.round_trips.clear()
+
+  def summary(self) -> str:
+    with self._lock:
+      shapes = sorted(self.shapes.values(), key=lambda s: s.latency.sum, reverse=True)
+      lines = [f"{'count':>8}{'p50':>9}{'p99':>9}{'max':>9}{'fail':>6}  shape (ms)"]
+      for stats in shapes:
+        hist = stats.latency
+        lines.append(
+          f"{hist.count:>8}{hist.percentile(50) * 1000:>9.2f}{hist.percentile(99) * 1000:>9.2f}"
+          f"{hist.max * 1000:>9.2f}{stats.failures:>6}  {hist.name}"
+        )
+      events = sum(self.round_trips.values())
+      if events:
+        trips = sum(k * v for k, v in self.round_trips.items())
+        lines.append("")
+        lines.append(f"Round trips per farm event: {trips / events:.2f} avg, {max(self.round_trips)} max over {events} events")
+    return "\n".join(lines)
+
+
+class PoolStats:
+  __slots__ = ("max_size", "open", "in_use", "peak_in_use", "waiting", "peak_waiting")
+
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self.open = 0
+    self.in_use = 0
+    self.peak_in_use = 0
+    self.waiting = 0
+    self.peak_waiting = 0
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+  def __init__(self):
+    self.pools: dict[Any, PoolStats] = {} # Server address -> its pool
+    self.checkout = Histogram("checkout")
+    self.created = 0
+    self.closed: Counter[str] = Counter() # Reason -> connections closed
+    self.failed: Counter[str] = Counter() # Reason -> checkouts that failed
+    self.cleared = 0
+    # A checkout happens on the thread that runs the command, so that is how
+    # its start is matched up with its end
+    self._checkouts: dict[int, float] = {}
+    self._lock = threading.Lock()
+
+  def _pool(self, address: Any) -> PoolStats:
+    pool = self.pools.get(address)
+    if pool is None:
+      self.pools[address] = pool = PoolStats(100)
+    return pool
+
+  def pool_created(self, event: monitoring.PoolCreatedEvent):
+    with self._lock:
+      # Only options that differ from pymongo's defaults are in there
+      self._pool(event.address).max_size = event.options.get("maxPoolSize", 100)
+
+  def pool_ready(self, event: monitoring.PoolReadyEvent):
+    pass
+
+  def pool_cleared(self, event: monitoring.PoolClearedEvent):
+    with self._lock:
+      self.cleared += 1
+    _log.warning(f"Connection pool for {event.address} was cleared")
+
+  def pool_closed(self, event: monitoring.PoolClosedEvent):
+    with self._lock:
+      self.pools.pop(event.address, None)
+
+  def connection_created(self, event: monitoring.ConnectionCreatedEvent):
+    with self._lock:
+      self.created += 1
+      self._pool(event.address).open += 1
+
+  def connection_ready(self, event: monitoring.ConnectionReadyEvent):
+    pass
+
+  def connection_closed(self, event: monitoring.ConnectionClosedEvent):
+    with self._lock:
+      self.closed[event.reason] += 1
+      self._pool(event.address).open -= 1
+
+  def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent):
+    with self._lock:
+      self._checkouts[threading.get_ident()] = perf_counter()
+      pool = self._pool(event.address)
+      pool.waiting += 1
+      pool.peak_waiting = max(pool.peak_waiting, pool.waiting)
+
+  def _end_checkout(self, address: Any) -> PoolStats:
+    start = self._checkouts.pop(threading.get_ident(), None)
+    if start is not None:
+      self.checkout.observe(perf_counter() - start)
+    pool = self._pool(address)
+    pool.waiting = max(pool.waiting - 1, 0)
+    return pool
+
+  def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent):
+    with self._lock:
+      self._end_checkout(event.address)
+      self.failed[event.reason] += 1
+
+  def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent):
+    with self._lock:
+      pool = self._end_checkout(event.address)
+      pool.in_use += 1
+      pool.peak_in_use = max(pool.peak_in_use, pool.in_use)
+
+  def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent):
+    with self._lock:
+      pool = self._pool(event.address)
+      pool.in_use = max(pool.in_use - 1, 0)
+
+  @property
+  def saturation(self) -> float:
+    """The largest share of its `maxPoolSize` any server's pool has had checked out at once"""
+    with self._lock:
+      return max((pool.peak_in_use / pool.max_size for pool in self.pools.values()), default=0.0)
+
+  def reset(self):
+    with self._lock:
+      self.checkout = Histogram("checkout")
+      self.created = self.cleared = 0
+      self.closed.clear()
+      self.failed.clear()
+      for pool in self.pools.values():
+        pool.peak_in_use = pool.in_use
+        pool.peak_waiting = pool.waiting
+
+  def summary(self) -> str:
+    with self._lock:
+      hist = self.checkout
+      lines = [
+        f"Checkouts: {hist.count}, wait p50 {hist.percentile(50) * 1000:.2f}ms, "
+        f"p99 {hist.percentile(99) * 1000:.2f}ms, max {hist.max * 1000:.2f}ms",
+        f"Failed checkouts: {sum(self.failed.values())} {dict(self.failed) if self.failed else ''}".rstrip(),
+        f"Connections created: {self.created}, closed: {sum(self.closed.values())} "
+        f"{dict(self.closed) if self.closed else ''}".rstrip(),
+        f"Pool cleared: {self.cleared} times",
+        "",
+        f"{'server':<32}{'open':>6}{'in use':>8}{'peak':>6}{'max':>6}{'waiting':>9}{'peak':>6}"
+      ]
+      for address, pool in self.pools.items():
+        server = ":".join(str(part) for part in address) if isinstance(address, tuple) else str(address)
+        lines.append(
+          f"{server:<32}{pool.open:>6}{pool.in_use:>8}{pool.peak_in_use:>6}"
+          f"{pool.max_size:>6}{pool.waiting:>9}{pool.peak_waiting:>6}"
+        )
+    lines.append(f"\nPeak saturation: {self.saturation:.0%}")
+    return "\n".join(lines)
+
+
+COMMANDS = CommandMonitor()
+POOL = PoolMonitor()
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, TypeVar
+
+from bson import ObjectId
+
+from bot.errors import DuplicateDocument
+from bot.shroom.storage.base import normalise_datetime, normalise_document, project
+
+if TYPE_CHECKING:
+  from bot.shroom.farm import FarmDict
+  from bot.shroom.stats import DailyStatsDict
+  from bot.shroom.user import UserDict
+
+T = TypeVar("T")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS farms (id INTEGER PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stats (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  oid TEXT NOT NULL UNIQUE,
+  doc TEXT NOT NULL
+);
+"""
+
+
+def _default(o: Any):
+  if isinstance(o, datetime):
+    return {"$date": normalise_datetime(o).isoformat()}
+  if isinstance(o, ObjectId):
+    return {"$oid": str(o)}
+  raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+def _object_hook(d: dict[str, Any]):
+  if len(d) == 1:
+    if "$date" in d:
+      return datetime.fromisoformat(d["$date"])
+    if "$oid" in d:
+      return ObjectId(d["$oid"])
+  return d
+
+def dumps(doc: dict[str, Any]) -> str:
+  return json.dumps(doc, default=_default, separators=(",", ":"))
+
+def loads(s: str) -> dict[str, Any]:
+  return json.loads(s, object_hook=_object_hook)
+
+
+class SQLiteBackend:
+  """Stores documents as JSON in a local SQLite database running in WAL mode
+
+  `sqlite3` is blocking, so every query runs on a single worker thread
+  which also keeps the connection to one thread at a time.
+  """
+
+  def __init__(self, path: str = "shroom.db"):
+    self.path = path
+    self._conn: sqlite3.Connection | None = None
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shroom-sqlite")
+
+  def _connect(self):
+    conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    self._conn = conn
+
+  async def _run(self, func: Callable[[sqlite3.Connection], T]) -> T:
+    if self._conn is None:
+      raise RuntimeError("SQLiteBackend.connect() must be awaited first")
+    conn = self._conn
+    return await asyncio.get_running_loop().run_in_executor(self._executor, func, conn)
+
+  async def connect(self) -> None:
+    if self._conn is None:
+      await asyncio.get_running_loop().run_in_executor(self._executor, self._connect)
+
+  async def close(self) -> None:
+    if self._conn is not None:
+      conn, self._conn = self._conn, None
+      await asyncio.get_running_loop().run_in_executor(self._executor, conn.close)
+    self._executor.shutdown(wait=False)
+
+
+
+  async def _find(self, table: str, doc_id: int) -> dict[str, Any] | None:
+    def query(conn: sqlite3.Connection):
+      return conn.execute(f"SELECT doc FROM {table} WHERE id = ?", (doc_id,)).fetchone()
+    row = await self._run(query)
+    return loads(row[0]) if row is not None else None
+
+  async def _find_many(self, table: str, doc_ids: list[int]) -> list[dict[str, Any]]:
+    def query(conn: sqlite3.Connection):
+      placeholders = ",".join("?" * len(doc_ids))
+      return conn.execute(f"SELECT doc FROM {table} WHERE id IN ({placeholders})", doc_ids).fetchall()
+    return [loads(row[0]) for row in await self._run(query)]
+
+  async def _insert(self, table: str, doc: dict[str, Any]) -> None:
+    def query(conn: sqlite3.Connection):
+      conn.execute(f"INSERT INTO {table} (id, doc) VALUES (?, ?)", (doc["_id"], dumps(doc)))
+    try:
+      await self._run(query)
+    except sqlite3.IntegrityError as e:
+      raise DuplicateDocument(f"{table[:-1]} with ID `{doc['_id']}` already exists") from e
+
+  async def _update(self, table: str, doc_id: int, update: Callable[[dict[str, Any]], bool]) -> bool:
+    def query(conn: sqlite3.Connection):
+      row = conn.execute(f"SELECT doc FROM {table} WHERE id = ?", (doc_id,)).fetchone()
+      if row is None:
+        return False
+      doc = loads(row[0])
+      if not update(doc):
+        return False
+      conn.execute(f"UPDATE {table} SET doc = ? WHERE id = ?", (dumps(doc), doc_id))
+      return True
+    return await self._run(query)
+
+  async def _top(self, table: str, key: str, limit: int) -> list[dict[str, Any]]:
+    def query(conn: sqlite3.Connection):
+      return conn.execute(
+        f"SELECT doc FROM {table} ORDER BY json_extract(doc, ?) DESC, id ASC LIMIT ?",
+        (f"$.{key}", limit)
+      ).fetchall()
+    return [loads(row[0]) for row in await self._run(query)]
+
+
+
+  async def find_farm(self, farm_id: int) -> FarmDict | None:
+    return await self._find("farms", farm_id) # type: ignore
+
+  async def find_farms(self, farm_ids: list[int]) -> list[FarmDict]:
+    return await self._find_many("farms", farm_ids) # type: ignore
+
+  async def insert_farm(self, farm: FarmDict) -> None:
+    await self._insert("farms", farm) # type: ignore
+
+  async def update_farm(self, farm_id: int, fields: dict[str, Any], version: int | None = None) -> bool:
+    fields = {**fields, "updated": datetime.utcnow()}
+    def update(doc: dict[str, Any]):
+      current = doc.get("version") or 0
+      if version is not None and current != version:
+        return False
+      doc.update(fields)
+      doc["version"] = current + 1
+      return True
+    return await self._update("farms", farm_id, update)
+
+  async def top_farms(self, key: str, limit: int) -> list[FarmDict]:
+    return await self._top("farms", key, limit) # type: ignore
+
+  async def iter_farms(self) -> AsyncIterator[FarmDict]:
+    rows = await self._run(lambda conn: conn.execute("SELECT doc FROM farms ORDER BY id").fetchall())
+    for row in rows:
+      yield loads(row[0]) # type: ignore
+
+
+
+  async def find_user(self, user_id: int) -> UserDict | None:
+    return await self._find("users", user_id) # type: ignore
+
+  async def find_users(self, user_ids: list[int]) -> list[UserDict]:
+    return await self._find_many("users", user_ids) # type: ignore
+
+  async def insert_user(self, user: UserDict) -> None:
+    await self._insert("users", user) # type: ignore
+
+  async def update_user(self, user_id: int, fields: dict[str, Any]) -> bool:
+    fields = normalise_document(fields)
+    def update(doc: dict[str, Any]):
+      if all(doc.get(k) == v for k, v in fields.items()):
+        return False
+      doc.update(fields)
+      return True
+    return await self._update("users", user_id, update)
+
+  async def inc_user(self, user_id: int, fields: dict[str, int]) -> bool:
+    def update(doc: dict[str, Any]):
+      for k, v in fields.items():
+        doc[k] = doc.get(k, 0) + v
+      return any(fields.values())
+    return await self._update("users", user_id, update)
+
+  async def top_users(self, key: str, limit: int) -> list[UserDict]:
+    return await self._top("users", key, limit) # type: ignore
+
+
+
+  async def latest_stats(self, process: str | None = None) -> DailyStatsDict | None:
+    def query(conn: sqlite3.Connection):
+      if process is None:
+        return conn.execute("SELECT doc FROM stats ORDER BY seq DESC LIMIT 1").fetchone()
+      return conn.execute(
+        "SELECT doc FROM stats WHERE json_extract(doc, '$.process') = ? ORDER BY seq DESC LIMIT 1",
+        (process,)
+      ).fetchone()
+    row = await self._run(query)
+    return loads(row[0]) if row is not None else None # type: ignore
+
+  async def insert_stats(self, stats: DailyStatsDict) -> ObjectId:
+    stats_id = stats.get("_id") or ObjectId() # type: ignore
+    doc = {**stats, "_id": stats_id}
+    def query(conn: sqlite3.Connection):
+      conn.execute("INSERT INTO stats (oid, doc) VALUES (?, ?)", (str(stats_id), dumps(doc)))
+    try:
+      await self._run(query)
+    except sqlite3.IntegrityError as e:
+      raise DuplicateDocument(f"stats with ID `{stats_id}` already exists") from e
+    return stats_id
+
+  async def replace_stats(self, stats_id: ObjectId, stats: DailyStatsDict) -> bool:
+    new = dumps({**stats, "_id": stats_id})
+    def query(conn: sqlite3.Connection):
+      row = conn.execute("SELECT doc FROM stats WHERE oid = ?", (str(stats_id),)).fetchone()
+      if row is None or loads(row[0]) == loads(new):
+        return False
+      conn.execute("UPDATE stats SET doc = ? WHERE oid = ?", (new, str(stats_id)))
+      return True
+    return await self._run(query)
+
+  async def clear_stats(self) -> None:
+    await self._run(lambda conn: conn.execute("DELETE FROM stats"))
+
+  async def iter_stats(self, projection: tuple[str, ...] | None = None) -> AsyncIterator[DailyStatsDict]:
+    rows = await self._run(lambda conn: conn.execute("SELECT doc FROM stats ORDER BY seq").fetchall())
+    for row in rows:
+      yield project(loads(row[0]), projection) # type: ignore
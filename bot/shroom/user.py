@@ -20,7 +20,7 @@ class UserDict(TypedDict):
 
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
   _id: int
   joined: datetime = field(default_factory=datetime.utcnow)
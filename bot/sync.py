@@ -0,0 +1,112 @@
+"""
+Application command syncing that only talks to Discord when something changed
+
+The payload `CommandTree.sync` would send is hashed per scope (globally or one
+guild) and compared with the hash of the last successful sync, which is kept
+in a small JSON file. Scopes whose hash matches are skipped.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+  import discord
+  from discord import app_commands
+
+_log = logging.getLogger(__name__)
+
+
+@dataclass
+class SyncResult:
+  scope: str
+  synced: int | None # Number of commands synced, `None` when the sync was skipped
+  digest: str
+
+  @property
+  def skipped(self) -> bool:
+    return self.synced is None
+
+
+async def tree_payload(tree: app_commands.CommandTree, guild: discord.abc.Snowflake | None = None) -> list[dict[str, Any]]:
+  """The payload `tree.sync(guild=guild)` would send"""
+  commands = tree._get_all_commands(guild=guild)
+  translator = tree.translator
+  if translator:
+    return [await command.get_translated_payload(tree, translator) for command in commands]
+  return [command.to_dict(tree) for command in commands]
+
+
+def payload_digest(payload: list[dict[str, Any]]) -> str:
+  """A hash of `payload` that does not depend on the order commands were added in"""
+  ordered = sorted(payload, key=lambda c: (c.get("type", 1), c["name"]))
+  data = json.dumps(ordered, sort_keys=True, separators=(",", ":"), default=str)
+  return hashlib.sha256(data.encode()).hexdigest()
+
+
+class CommandSyncer:
+  def __init__(self, tree: app_commands.CommandTree, state_path: str | None = None):
+    self.tree = tree
+    self.state_path = state_path
+    self._hashes: dict[str, str] = self._load()
+
+  def _load(self) -> dict[str, str]:
+    if not self.state_path:
+      return {}
+    try:
+      with open(self.state_path) as f:
+        hashes = json.load(f)
+    except FileNotFoundError:
+      return {}
+    except (OSError, ValueError) as e:
+      _log.warning(f"Ignoring command sync state `{self.state_path}`: {e}")
+      return {}
+    return hashes if isinstance(hashes, dict) else {}
+
+  def _save(self):
+    if not self.state_path:
+      return
+    tmp = f"{self.state_path}.tmp"
+    with open(tmp, "w") as f:
+      json.dump(self._hashes, f, indent=2, sort_keys=True)
+    os.replace(tmp, self.state_path)
+
+  def _scope(self, guild: discord.abc.Snowflake | None) -> str:
+    # Keyed by application too, a different bot token means nothing is synced yet
+    return f"{self.tree.client.application_id}:{guild.id if guild is not None else 'global'}"
+
+  async def sync(self, guild: discord.abc.Snowflake | None = None, force: bool = False) -> SyncResult:
+    """|coro|
+
+    Syncs the commands of `guild`, or the global ones, unless they are the
+    same as the last time they were synced
+    """
+    scope = self._scope(guild)
+    digest = payload_digest(await tree_payload(self.tree, guild))
+    if not force and self._hashes.get(scope) == digest:
+      _log.info(f"Commands for `{scope}` are unchanged, skipping sync")
+      return SyncResult(scope, None, digest)
+
+    synced = await self.tree.sync(guild=guild)
+    self._hashes[scope] = digest
+    try:
+      self._save()
+    except OSError as e:
+      _log.warning(f"Could not save command sync state: {e}")
+    _log.info(f"Synced {len(synced)} commands for `{scope}`")
+    return SyncResult(scope, len(synced), digest)
+
+  async def sync_changed(self, guilds: tuple[discord.abc.Snowflake, ...] = ()) -> list[SyncResult]:
+    """|coro|
+
+    Syncs the global commands and the commands of each of `guilds` that changed
+    """
+    results = [await self.sync()]
+    for guild in guilds:
+      results.append(await self.sync(guild))
+    return results
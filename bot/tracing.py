@@ -0,0 +1,25 @@
+"""
+Trace IDs for correlating everything done on behalf of one event
+"""
+
+from __future__ import annotations
+
+import os
+from contextvars import ContextVar
+
+trace_id: ContextVar[str | None] = ContextVar("trace_id", default=None)
+
+
+def new_trace_id() -> str:
+  return os.urandom(6).hex()
+
+
+def start_trace() -> str:
+  """Starts a new trace for the current task and returns its ID
+
+  Every task runs in a copy of its parent's context, so this never leaks
+  into other events.
+  """
+  tid = new_trace_id()
+  trace_id.set(tid)
+  return tid
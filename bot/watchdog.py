@@ -0,0 +1,107 @@
+"""
+Event loop lag monitoring
+
+A task on the loop sleeps for a fixed interval and measures how late it wakes
+up, which is the delay every other callback on the loop is seeing too. A helper
+thread watches the task's heartbeat, and once the loop has not come back for
+longer than the threshold it grabs the loop thread's stack with
+`sys._current_frames()`. That is the code that is blocking the loop, caught
+while it is still running rather than after the fact.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import threading
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from time import perf_counter
+
+from bot.metrics import METRICS
+
+_log = logging.getLogger(__name__)
+
+
+@dataclass
+class Stall:
+  lag: float # seconds
+  task: str | None
+  stack: str
+
+
+class LoopWatchdog:
+  def __init__(self, threshold: float = 0.1, interval: float = 0.05):
+    self.threshold = threshold
+    self.interval = interval
+    self.stalls: deque[Stall] = deque(maxlen=20)
+    self._heartbeat = 0.0
+    self._captured: tuple[str | None, str] | None = None
+    self._loop: asyncio.AbstractEventLoop | None = None
+    self._loop_thread = 0
+    self._task: asyncio.Task | None = None
+    self._thread: threading.Thread | None = None
+    self._stop = threading.Event()
+
+  async def _tick(self):
+    histogram = METRICS.histogram("loop.lag")
+    interval = self.interval
+    while True:
+      expected = perf_counter() + interval
+      await asyncio.sleep(interval)
+      now = perf_counter()
+      self._heartbeat = now
+      lag = max(0.0, now - expected)
+      histogram.observe(lag)
+      if lag >= self.threshold:
+        self._report(lag)
+
+  def _report(self, lag: float):
+    METRICS.inc("loop.stalls")
+    captured, self._captured = self._captured, None
+    # Stalls just over the threshold can end before the helper thread looks
+    task, stack = captured if captured is not None else (None, "")
+    self.stalls.append(Stall(lag, task, stack))
+    _log.warning(
+      f"Event loop was blocked for {lag * 1000:.1f}ms"
+      + (f" by task `{task}`" if task else "")
+      + (f", stack while blocked:\n{stack}" if stack else "")
+    )
+
+  def _watch(self):
+    while not self._stop.wait(self.interval / 2):
+      heartbeat = self._heartbeat
+      if self._captured is not None or perf_counter() - heartbeat < self.interval + self.threshold:
+        continue
+      frame = sys._current_frames().get(self._loop_thread)
+      if frame is None or self._heartbeat != heartbeat:
+        continue
+      task = asyncio.current_task(self._loop)
+      self._captured = (
+        task.get_name() if task is not None else None,
+        "".join(traceback.format_stack(frame))
+      )
+      del frame
+
+  def start(self):
+    """Starts watching the running loop, must be called from the loop's thread"""
+    if self._task is not None:
+      return
+    self._loop = asyncio.get_running_loop()
+    self._loop_thread = threading.get_ident()
+    self._heartbeat = perf_counter()
+    self._stop.clear()
+    self._task = asyncio.create_task(self._tick(), name="shroom-watchdog")
+    self._thread = threading.Thread(target=self._watch, name="shroom-watchdog", daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+    if self._thread is not None:
+      self._stop.set()
+      self._thread.join()
+      self._thread = None
@@ -1,15 +1,24 @@
 from __future__ import annotations
 
-import discord
+import asyncio
 
-from bot import ShroomBot, get_config_from_env
+from bot import bot_class, client_options, get_config_from_env
+from bot.log import setup_logging
 
 config = get_config_from_env()
+listener = setup_logging(config.log_level.upper(), config.log_json, config.log_rate_limit)
 
-bot = ShroomBot(
+if config.uvloop:
+  import uvloop
+  asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+bot = bot_class(config)(
   config=config,
-  intents=discord.Intents.all(),
-  owner_ids=(751768586699276342, 759195783597129760)
+  owner_ids=(751768586699276342, 759195783597129760),
+  **client_options(config)
 )
 
-bot.run(root_logger=True)
+try:
+  bot.run(log_handler=None) # Logging was set up above
+finally:
+  listener.stop()
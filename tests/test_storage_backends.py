@@ -0,0 +1,367 @@
+"""
+Conformance tests every `StorageBackend` has to pass
+
+Each scenario runs against the memory and SQLite backends, and against a
+throwaway database on the Mongo server at `MONGO_URL` (localhost by default)
+when one answers, so the backends can't drift apart from the Mongo one.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable
+
+import pytest
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from bot.errors import DuplicateDocument
+from bot.shroom import ShroomFarm
+from bot.shroom.farm import Farm
+from bot.shroom.rollover import PendingDay
+from bot.shroom.stats import DailyFarmStats, DailyStats
+from bot.shroom.storage import MemoryBackend, MongoBackend, SQLiteBackend, StorageBackend
+from bot.shroom.storage.base import normalise_datetime
+from bot.shroom.user import User
+
+MONGO_URL = os.getenv("MONGO_URL", "localhost")
+
+Scenario = Callable[[StorageBackend], Awaitable[None]]
+
+
+@functools.cache
+def mongo_available() -> bool:
+  client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=500)
+  try:
+    client.admin.command("ping")
+  except PyMongoError:
+    return False
+  finally:
+    client.close()
+  return True
+
+
+@pytest.fixture(params=["memory", "sqlite", "mongo"])
+def run(request, tmp_path) -> Callable[[Scenario], None]:
+  """Runs a scenario against a fresh backend of each kind, which is dropped afterwards"""
+  kind = request.param
+  if kind == "mongo" and not mongo_available():
+    pytest.skip(f"no MongoDB server at `{MONGO_URL}`")
+  database = f"ShroomDB_test_{uuid.uuid4().hex[:12]}"
+
+  def create() -> StorageBackend:
+    if kind == "memory":
+      return MemoryBackend()
+    if kind == "sqlite":
+      return SQLiteBackend(str(tmp_path / "shroom.db"))
+    return MongoBackend(MONGO_URL, database, serverSelectionTimeoutMS=2000)
+
+  def runner(scenario: Scenario):
+    async def main():
+      backend = create()
+      await backend.connect()
+      try:
+        await scenario(backend)
+      finally:
+        await backend.close()
+    asyncio.run(main())
+
+  yield runner
+  if kind == "mongo":
+    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000)
+    client.drop_database(database)
+    client.close()
+
+
+def farm_doc(farm_id: int, **fields: Any) -> dict[str, Any]:
+  return {**Farm(farm_id, updated=datetime(2023, 5, 1, 12, 30, 15, 123456)).to_dict(), **fields}
+
+
+def user_doc(user_id: int, **fields: Any) -> dict[str, Any]:
+  return {**User(user_id, joined=datetime(2023, 5, 1, 8, 0, 0, 999999)).to_dict(), **fields}
+
+
+def stats_doc(
+    days_ago: int,
+    farms: dict[int, int] | None = None,
+    users: dict[int, int] | None = None,
+    process: str | None = None,
+    contributors: dict[int, dict[int, int]] | None = None
+) -> dict[str, Any]:
+  """The stats of `days_ago` days ago, with `farms` and `users` mapping IDs to how much they farmed
+
+  `contributors` maps farm IDs to the contributors of their day.
+  """
+  farms = farms or {}
+  users = users or {}
+  contributors = contributors or {}
+  stats = DailyStats(
+    date=datetime.utcnow() - timedelta(days=days_ago),
+    total=sum(users.values()),
+    users=users,
+    closed={farm_id: DailyFarmStats(farm_id, farmed=farmed, contributors=contributors.get(farm_id, {})).to_dict() for farm_id, farmed in farms.items()},
+    process=process
+  )
+  return stats.to_dict() # type: ignore
+
+
+# Farms
+
+def test_farm_round_trips(run):
+  async def scenario(backend: StorageBackend):
+    doc = farm_doc(1, total_farmed=5)
+    await backend.insert_farm(doc) # type: ignore
+    found = await backend.find_farm(1)
+    assert found is not None
+    # Stored the way BSON does, naive UTC with millisecond precision
+    assert found == {**doc, "updated": normalise_datetime(doc["updated"])}
+    assert await backend.find_farm(2) is None
+
+  run(scenario)
+
+
+def test_farm_insert_rejects_duplicates(run):
+  async def scenario(backend: StorageBackend):
+    await backend.insert_farm(farm_doc(1)) # type: ignore
+    with pytest.raises(DuplicateDocument):
+      await backend.insert_farm(farm_doc(1, total_farmed=9)) # type: ignore
+    farm = await backend.find_farm(1)
+    assert farm is not None and farm["total_farmed"] == 0
+
+  run(scenario)
+
+
+def test_find_farms_skips_missing(run):
+  async def scenario(backend: StorageBackend):
+    for farm_id in (1, 2, 3):
+      await backend.insert_farm(farm_doc(farm_id)) # type: ignore
+    farms = await backend.find_farms([3, 1, 42])
+    assert sorted(f["_id"] for f in farms) == [1, 3]
+    assert await backend.find_farms([42]) == []
+
+  run(scenario)
+
+
+def test_update_farm_bumps_version_and_stamps_time(run):
+  async def scenario(backend: StorageBackend):
+    await backend.insert_farm(farm_doc(1)) # type: ignore
+    before = datetime.utcnow() - timedelta(seconds=1)
+    assert await backend.update_farm(1, {"total_farmed": 3, "last_farmer": 7})
+    farm = await backend.find_farm(1)
+    assert farm is not None
+    assert farm["total_farmed"] == 3 and farm["last_farmer"] == 7
+    assert farm["version"] == 1
+    assert farm["updated"] > before
+    assert not await backend.update_farm(2, {"total_farmed": 1})
+
+  run(scenario)
+
+
+def test_update_farm_compare_and_set(run):
+  async def scenario(backend: StorageBackend):
+    await backend.insert_farm(farm_doc(1)) # type: ignore
+    assert await backend.update_farm(1, {"total_farmed": 1}, version=0)
+    # A write based on the stale version 0 must not land
+    assert not await backend.update_farm(1, {"total_farmed": 99}, version=0)
+    assert await backend.update_farm(1, {"total_farmed": 2}, version=1)
+    farm = await backend.find_farm(1)
+    assert farm is not None and farm["total_farmed"] == 2 and farm["version"] == 2
+
+  run(scenario)
+
+
+def test_update_farm_without_version_counts_as_zero(run):
+  async def scenario(backend: StorageBackend):
+    doc = farm_doc(1)
+    del doc["version"] # Farms written before versions were added
+    await backend.insert_farm(doc) # type: ignore
+    assert not await backend.update_farm(1, {"total_farmed": 1}, version=1)
+    assert await backend.update_farm(1, {"total_farmed": 1}, version=0)
+    farm = await backend.find_farm(1)
+    assert farm is not None and farm["version"] == 1
+
+  run(scenario)
+
+
+def test_top_and_iter_farms(run):
+  async def scenario(backend: StorageBackend):
+    weekly = {1: 5, 2: 9, 3: 5, 4: 0}
+    for farm_id, farmed in weekly.items():
+      await backend.insert_farm(farm_doc(farm_id, most_farmed_weekly=farmed)) # type: ignore
+    top = await backend.top_farms("most_farmed_weekly", 3)
+    # Ties are broken by ID
+    assert [f["_id"] for f in top] == [2, 1, 3]
+    assert sorted([f["_id"] async for f in backend.iter_farms()]) == [1, 2, 3, 4]
+
+  run(scenario)
+
+
+# Users
+
+def test_user_round_trips(run):
+  async def scenario(backend: StorageBackend):
+    doc = user_doc(7, farmed=2)
+    await backend.insert_user(doc) # type: ignore
+    assert await backend.find_user(7) == {**doc, "joined": normalise_datetime(doc["joined"])}
+    assert await backend.find_user(8) is None
+    with pytest.raises(DuplicateDocument):
+      await backend.insert_user(user_doc(7)) # type: ignore
+    users = await backend.find_users([8, 7])
+    assert [u["_id"] for u in users] == [7]
+
+  run(scenario)
+
+
+def test_update_user_reports_modified(run):
+  async def scenario(backend: StorageBackend):
+    await backend.insert_user(user_doc(7)) # type: ignore
+    assert await backend.update_user(7, {"rank_enum": 2, "tokens": 5})
+    # Setting the values it already has is not a modification
+    assert not await backend.update_user(7, {"rank_enum": 2})
+    assert not await backend.update_user(8, {"rank_enum": 1})
+    user = await backend.find_user(7)
+    assert user is not None and user["rank_enum"] == 2 and user["tokens"] == 5
+
+  run(scenario)
+
+
+def test_inc_user(run):
+  async def scenario(backend: StorageBackend):
+    await backend.insert_user(user_doc(7, tokens=3)) # type: ignore
+    assert await backend.inc_user(7, {"tokens": 2, "lifetime_tokens": 2})
+    assert await backend.inc_user(7, {"tokens": -1})
+    assert not await backend.inc_user(8, {"tokens": 1})
+    user = await backend.find_user(7)
+    assert user is not None and user["tokens"] == 4 and user["lifetime_tokens"] == 2
+
+  run(scenario)
+
+
+def test_top_users(run):
+  async def scenario(backend: StorageBackend):
+    for user_id, tokens in {1: 4, 2: 4, 3: 10, 4: 1}.items():
+      await backend.insert_user(user_doc(user_id, tokens=tokens)) # type: ignore
+    assert [u["_id"] for u in await backend.top_users("tokens", 3)] == [3, 1, 2]
+
+  run(scenario)
+
+
+# Stats
+
+def test_latest_stats(run):
+  async def scenario(backend: StorageBackend):
+    assert await backend.latest_stats() is None
+    await backend.insert_stats(stats_doc(2, users={1: 1})) # type: ignore
+    await backend.insert_stats(stats_doc(1, users={1: 2}, process="a")) # type: ignore
+    await backend.insert_stats(stats_doc(0, users={1: 3}, process="b")) # type: ignore
+    latest = await backend.latest_stats()
+    assert latest is not None and latest["total"] == 3
+    latest = await backend.latest_stats("a")
+    assert latest is not None and latest["total"] == 2
+    assert await backend.latest_stats("c") is None
+
+  run(scenario)
+
+
+def test_replace_stats(run):
+  async def scenario(backend: StorageBackend):
+    stats_id = await backend.insert_stats(stats_doc(0, users={1: 1})) # type: ignore
+    assert isinstance(stats_id, ObjectId)
+    latest = await backend.latest_stats()
+    assert latest is not None and latest["_id"] == stats_id
+
+    stats = DailyStats.from_db(dict(latest)) # type: ignore
+    stats.users[1] += 4
+    stats.total += 4
+    assert await backend.replace_stats(stats_id, stats.to_dict())
+    # Replacing it with what it already holds is not a modification
+    assert not await backend.replace_stats(stats_id, stats.to_dict())
+    assert not await backend.replace_stats(ObjectId(), stats.to_dict())
+    latest = await backend.latest_stats()
+    assert latest is not None and latest["_id"] == stats_id and latest["total"] == 5
+
+  run(scenario)
+
+
+def test_clear_stats(run):
+  async def scenario(backend: StorageBackend):
+    for days_ago in (2, 1):
+      await backend.insert_stats(stats_doc(days_ago, users={1: 1})) # type: ignore
+    await backend.clear_stats()
+    assert await backend.latest_stats() is None
+    assert [d async for d in backend.iter_stats()] == []
+
+  run(scenario)
+
+
+def test_iter_stats_projections(run):
+  """The projections the weekly lookups read with"""
+  async def scenario(backend: StorageBackend):
+    await backend.insert_stats(stats_doc(2, farms={5: 3, 6: 1}, users={7: 3, 8: 1})) # type: ignore
+    await backend.insert_stats(stats_doc(1, farms={6: 2}, users={8: 2})) # type: ignore
+
+    totals = [d async for d in backend.iter_stats(("total",))]
+    assert [set(d) for d in totals] == [{"_id", "total"}] * 2
+    assert [d["total"] for d in totals] == [4, 2]
+
+    farms = [d.get("farms", {}) async for d in backend.iter_stats(("farms.5",))]
+    assert [set(f) for f in farms] == [{"5"}, set()]
+    assert farms[0]["5"]["farmed"] == 3
+
+    users = [d.get("users", {}) async for d in backend.iter_stats(("users.8",))]
+    assert users == [{"8": 1}, {"8": 2}]
+
+    full = [d async for d in backend.iter_stats()]
+    assert [sorted(d["farms"]) for d in full] == [["5", "6"], ["6"]]
+
+  run(scenario)
+
+
+def test_weekly_totals(run):
+  """`ShroomFarm`'s weekly lookups agree on every backend, read straight from `Stats` or cached"""
+  async def scenario(backend: StorageBackend):
+    await backend.insert_stats(stats_doc(3, farms={5: 3, 6: 1}, users={7: 3, 8: 1})) # type: ignore
+    await backend.insert_stats(stats_doc(2, farms={6: 2}, users={8: 2})) # type: ignore
+    shroom_farm = ShroomFarm(backend)
+    await shroom_farm.create_farm(5, channel=50)
+    await shroom_farm.farm(Farm(5), 7, 4) # Today's farming, only in memory
+
+    async def weekly() -> tuple[int, int, int, int]:
+      return (
+        await shroom_farm.get_total_weekly_farmed(),
+        await shroom_farm.get_server_weekly_farmed(5),
+        await shroom_farm.get_user_weekly_farmed(7),
+        await shroom_farm.get_user_weekly_farmed(8)
+      )
+
+    assert await weekly() == (10, 7, 7, 3)
+    await shroom_farm.prewarm_weekly_totals()
+    assert await weekly() == (10, 7, 7, 3)
+
+
+  run(scenario)
+
+
+def test_weekly_contributors(run):
+  """Contributors add up over the days saved, the days not saved yet and today"""
+  async def scenario(backend: StorageBackend):
+    await backend.insert_stats(stats_doc(3, farms={5: 3, 6: 1}, contributors={5: {7: 2, 8: 1}, 6: {9: 1}})) # type: ignore
+    # Today's document is behind `daily_stats`, which counts instead
+    await backend.insert_stats(stats_doc(0, farms={5: 9}, contributors={5: {9: 9}})) # type: ignore
+    shroom_farm = ShroomFarm(backend)
+    pending = stats_doc(1, farms={5: 4}, contributors={5: {8: 4}})
+    shroom_farm.pending_days.append(PendingDay(DailyStats.from_db(pending))) # type: ignore
+    await shroom_farm.create_farm(5, channel=50)
+    farm = Farm(5, daily_goal=10)
+    await shroom_farm.farm(farm, 7, 1)
+    shroom_farm.daily_stats.close_farm(5) # The farm's day ended earlier today
+    await shroom_farm.farm(farm, 8, 2)
+
+    assert await shroom_farm.get_server_contributors(5) == {7: 3, 8: 7}
+
+  run(scenario)